@@ -1,21 +1,84 @@
 #!/usr/bin/env python
-from __future__ import unicode_literals
-
-__version__ = "20211010.0"
+__version__ = "20261018.0"
 __author__ = "Justin Winokur"
 
 import copy
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import uuid
 import types
 import sys
-
-if sys.version_info[0] > 2:
-    unicode = str
+import bisect
+import numbers
+import gc
+import contextlib
+import functools
+import operator
+import threading
+import asyncio
+from threading import get_ident as _get_ident
+import itertools
+import os
+import zlib
+import struct
+import mmap
+from array import array
+from collections.abc import Mapping
+import pickle
+try:
+    import numpy as np
+except ImportError: # Optional. See numeric_attributes
+    np = None
 
 class ExcludedAttributeError(ValueError):
     pass
 
+class DuplicateKeyError(ValueError):
+    pass
+
+_SAVE_MAGIC = b'DICTTABLE\x00'
+_SAVE_VERSION = 1
+_JOURNAL_MAGIC = b'DICTJRNL'
+_JOURNAL_HEADER = struct.Struct('<Q') # generation (see checkpoint())
+_JOURNAL_RECORD = struct.Struct('<II') # length and crc32 of each entry
+_MAPPED_MAGIC = b'DICTMAP\x00'
+_MAPPED_HEADER = struct.Struct('<QQ') # directory offset and length
+_ASYNC_CHUNK_SIZE = 10000 # Items per chunk of aquery(), aadd(), and areindex()
+_ASYNC_RESTARTS = 3 # Times areindex() starts again before it reindexes at once
+
+class _Unbounded(object):
+    """Sentinel for an unbounded end of a range"""
+    def __repr__(self):
+        return '_UNBOUNDED'
+_UNBOUNDED = _Unbounded()
+
+def _reads(method):
+    """Hold the shared lock while calling method if the DB is concurrent"""
+    @functools.wraps(method)
+    def locked(self,*args,**kwargs):
+        lock = self._lock
+        if lock is None:
+            return method(self,*args,**kwargs)
+        lock.acquire_read()
+        try:
+            return method(self,*args,**kwargs)
+        finally:
+            lock.release_read()
+    return locked
+
+def _writes(method):
+    """Hold the exclusive lock while calling method if the DB is concurrent"""
+    @functools.wraps(method)
+    def locked(self,*args,**kwargs):
+        lock = self._lock
+        if lock is None:
+            return method(self,*args,**kwargs)
+        lock.acquire_write()
+        try:
+            return method(self,*args,**kwargs)
+        finally:
+            lock.release_write()
+    return locked
+
 class DictTable(object):
     """
     DictTable:
@@ -42,6 +105,86 @@ class DictTable(object):
     exclude_attributes [ *empty* ] (list)
         Attributes that shouldn't ever be added even if attributes=None for 
         dynamic addition of attributes.
+    
+    sorted_attributes [ *empty* ] (list)
+        Attributes to additionally keep in a sorted index. Range queries 
+        (<, <=, >, >=, between) on these are O(log N + k) rather than O(N).
+        See add_sorted_attribute()
+    
+    string_attributes [ *empty* ] (list)
+        Attributes to additionally keep in a string index so that 
+        DB.Q.attrib.startswith(prefix) and DB.Q.attrib.contains(substring)
+        do not check every unique value. See add_string_attribute()
+    
+    primary_key [None] (str)
+        Attribute that uniquely identifies each item. Every item must have
+        it (not a list) and adding an item with an existing key raises a
+        DuplicateKeyError. Enables DB.get(key) and DB.upsert(item)
+    
+    composite_indexes [ *empty* ] (list of tuples)
+        Combinations of attributes to also index together so that querying
+        for all of them is a single lookup. See create_index()
+    
+    vacuum_threshold [None] (float, None)
+        If set, automatically call vacuum() after remove() or pop() when the
+        fraction of deleted slots exceeds this. Note that this changes the 
+        indices of items. It waits until no query() is being iterated. See
+        vacuum()
+    
+    bitmaps [False] (bool)
+        Represent large sets of items in queries (at least 1/64 of the 
+        items) as compressed bitmaps rather than Python sets. Boolean 
+        operations (&, |, ~, !=) are then done a word at a time and use ~1 
+        bit per item instead of ~30+ bytes. This is much better for queries
+        that match a large number of items. The bitmaps of postings are 
+        cached (least-recently-used) and rebuilt in O(N/64) after a change.
+    
+    cache_size [0] (int)
+        Cache the results of up to this many queries (least-recently-used). 
+        An entry is only invalidated when an attribute it depends on is 
+        changed (or items are added/removed if it depends on all items).
+        Queries with filters or vfilters (or on attributes that are not 
+        indexed) are not cached. See cache_info()
+    
+    compact_rows [False] (bool)
+        Store the items as compact, read-only records rather than dicts.
+        Items with the same keys share one schema and only store a tuple
+        of the values. Queries and iteration return these records which 
+        act like (read-only) dicts. Use dict(item) or item.copy() to get a
+        real dict. update() replaces the record. Items can *not* be changed
+        in place
+    
+    numeric_attributes [None] (list)
+        Also keep the (real number) values of these attributes in NumPy 
+        arrays so that <, <=, >, >=, between, and vfilter() are vectorized.
+        If NumPy is not installed, these are evaluated item-by-item as 
+        usual. See add_numeric_attribute()
+    
+    concurrent [False] (bool)
+        Make the DB safe to use from multiple threads. Reads (query, count,
+        isin, iteration, etc) share a lock so they can run at the same time 
+        and changes (add, update, remove, pop, reindex, etc) are exclusive.
+        query() and iteration return the items as they were when called 
+        rather than lazily.
+    
+    prefer_writers [True] (bool)
+        If concurrent, whether a waiting change blocks new reads (so 
+        changes are not starved by a steady stream of reads). If False, 
+        reads are never blocked by a *waiting* change.
+    
+    intern_values [False] (bool)
+        Replace each indexed value with a single shared (canonical) object 
+        for all equal values of the same type, across all attributes. Saves 
+        memory when many items have equal but separate values (e.g. strings
+        read from a file). Note that this replaces the values in the items 
+        (and in lists) that are added
+    
+    workers [None] (int)
+        Build the index of many items (when constructed, added in bulk, or 
+        reindexed) in this many processes. The items are split into chunks
+        that are indexed separately and then merged. Only used where 
+        processes can be forked (e.g. not Windows) and not with 
+        intern_values. Also see the workers attribute
         
     Multiple Values per attribute
     -----------------------------
@@ -61,7 +204,7 @@ class DictTable(object):
 
     Tips:
     ------
-    * You can simply dump the DB with JSON using the DB.items()
+    * You can simply dump the DB with JSON using the DB.items(dicts=True)
       and then reload it with a new DB
     
     * There is also an attribute called `_index` which can be used to
@@ -69,12 +212,33 @@ class DictTable(object):
 
     """
     def __init__(self, items=None, 
-                 fixed_attributes=None,exclude_attributes=None):
+                 fixed_attributes=None,exclude_attributes=None,
+                 sorted_attributes=None,vacuum_threshold=None,
+                 bitmaps=False,cache_size=0,compact_rows=False,
+                 intern_values=False,numeric_attributes=None,
+                 concurrent=False,prefer_writers=True,workers=None,
+                 string_attributes=None,composite_indexes=None,
+                 primary_key=None):
+        
+        # Reader/writer lock if concurrent. The cache has its own lock since
+        # reads can update it
+        self._lock = _RWLock(prefer_writers) if concurrent else None
+        self._cache_lock = threading.Lock()
+        self._iterators = 0 # Open query iterators. See _iterating()
         
         # These are used to make sure the DB.Query is (a) from this DB and (b)
-        # the DB hasn't changed. This *should* always be the case
-        self._id = unicode(uuid.uuid4()) 
+        # the DB hasn't changed. This *should* always be the case.
+        # _c is bumped on every change and _versions[dep] is the _c of the
+        # last change to dep (an attribute or _ROWS for adding/removing 
+        # items). A vacuum changes the index of every item
+        self._id = str(uuid.uuid4()) 
         self._c = 0
+        self._versions = {}
+        self._vacuumed = 0
+        
+        # Optional journal of changes. See open_journal()
+        self._journal = None
+        self._generation = 0
         
         # Handle inputs
         if items is None:
@@ -82,57 +246,290 @@ class DictTable(object):
             
         if exclude_attributes is None:
             exclude_attributes = set()
-        if isinstance(exclude_attributes,(str,unicode)):
+        if isinstance(exclude_attributes,str):
             exclude_attributes = [exclude_attributes]
         self.exclude_attributes = set(exclude_attributes)
         
         if fixed_attributes:
-            if isinstance(fixed_attributes,(str,unicode)):
+            if isinstance(fixed_attributes,str):
                 fixed_attributes = [fixed_attributes]
             self.fixed_attributes = list(fixed_attributes)
         else:
             self.fixed_attributes = list() 
         
         self.N = 0 # Will keep track
+        self.vacuum_threshold = vacuum_threshold
+        self.workers = workers
         self._list = []
-        self._lookup = defaultdict(_new_defaultdict_list)
+        self._lookup = defaultdict(_new_defaultdict_set)
 
         self._empty = _emptyList()
-        self._ix = set()
+        
+        # Shared schemas of compact rows. {keys:_Schema} or None for dicts
+        self._schemas = {} if compact_rows else None
+        
+        # Canonical values. {(type,val):val} or None. See _intern_item()
+        self._interned = {} if intern_values else None
+        
+        # Row sets. If using bitmaps, cache the bitmap of each (large) 
+        # posting set when it is used (least-recently-used up to 
+        # _BITMAP_CACHE_MEMORY). {(attrib,val):(_Bitmap,size)} and 
+        # {attrib:_Bitmap}
+        self._bitmaps = OrderedDict() if bitmaps else None
+        self._bitmaps_memory = 0
+        self._attr_bitmaps = {}
+        self._ix = _Bitmap() if bitmaps else set()
+        
+        # Query result cache. {key:(ixs,deps,size)} and {dep:set(keys)}
+        self._cache = OrderedDict() if cache_size else None
+        self._cache_deps = defaultdict(set)
+        self._cache_size = cache_size
+        self._cache_stats = dict.fromkeys(['hits','misses','evictions',
+                                           'invalidations','memory'],0)
+        
+        # Catalog of the number of items indexed for each attribute. Used for
+        # the (cached) attributes and statistics
+        self._counts = {}
+        self._attributes = None
+        
+        # Sorted keys for range queries. {attrib:{family:[sorted keys]}}. 
+        # New keys are kept in _sorted_new {attrib:set} and only merged in by
+        # the next range query of attrib so adding them is O(1)
+        self._sorted = {}
+        self._sorted_new = {}
+        if sorted_attributes:
+            if isinstance(sorted_attributes,str):
+                sorted_attributes = [sorted_attributes]
+            for attrib in sorted_attributes:
+                self.add_sorted_attribute(attrib)
+        
+        # Index of the unique string values for startswith and contains. 
+        # {attrib:_StringIndex}
+        self._strings = {}
+        if string_attributes:
+            if isinstance(string_attributes,str):
+                string_attributes = [string_attributes]
+            for attrib in string_attributes:
+                self.add_string_attribute(attrib)
+        
+        # Unique key. {key:ix}
+        if primary_key is not None and (primary_key in self.exclude_attributes or 
+                (self.fixed_attributes and primary_key not in self.fixed_attributes)):
+            raise ValueError("primary_key '{}' must be indexed".format(primary_key))
+        self.primary_key = primary_key
+        self._pk = {}
+        
+        # Composite indexes. {(attrib,...):{(val,...):set(ixs)}}
+        self._composites = {}
+        for attribs in composite_indexes or []:
+            self.create_index(attribs)
+        
+        # NumPy columns of numeric attributes. {attrib:_Column}. _numeric 
+        # is kept even without NumPy so the setting is preserved
+        self._numeric = []
+        self._columns = {}
+        if numeric_attributes:
+            if isinstance(numeric_attributes,str):
+                numeric_attributes = [numeric_attributes]
+            for attrib in numeric_attributes:
+                self.add_numeric_attribute(attrib)
 
         # Add the items
-        for item in items:
-            self.add(item)
+        self._bulk_add(items)
+    
+    @classmethod
+    def from_records(cls,items,**kwargs):
+        """
+        Build a DictTable from an iterable of dictionaries in a single
+        batched pass. kwargs are passed to DictTable().
+        
+        This is the same as DictTable(items,**kwargs) but is more explicit
+        """
+        return cls(items,**kwargs)
 
+    @_writes
     def add(self,item):
         """
-        Add an item or items to the DB
+        Add an item or items to the DB. Multiple items (list, tuple, or 
+        generator) are added in a single batched pass
         """
         if isinstance(item,(list,tuple,types.GeneratorType)):
-            for it in item:
-                self.add(it)
+            self._bulk_add(item)
             return
         
         ix = len(self._list) # The length will be 1+ the last ix so do not change this
+        if self.primary_key is not None:
+            self._check_keys([item])
                     
         # Add built in ones if it is there
         attribs = self.fixed_attributes if self.fixed_attributes else item.keys()
+        if self._interned is not None:
+            item = self._intern_item(item,attribs)
         
         for attrib in attribs:
             if attrib not in item or attrib in self.exclude_attributes:
                 continue
             self._append(attrib,item[attrib],ix) # Add it to the index
+        self._composite_add(item,ix)
 
         # Finally add it
-        self._list.append(item)
+        self._list.append(self._compact(item))
+        if self.primary_key is not None:
+            self._pk[item[self.primary_key]] = ix
+        for attrib,column in self._columns.items():
+            column.set_many(ix,[item.get(attrib)])
         self.N += 1
         self._ix.add(ix)
+        self._touched(_ROWS)
+        
+        if self._journal is not None:
+            self._journal.append(('add',[item]))
 
-    def query(self,*args,**kwargs):
+    def _bulk_add(self,items):
+        """
+        Add many items at once. This is the same as calling add() on each 
+        but all of the index work is done in one pass into new local maps 
+        that are then merged. It skips the per-item bookkeeping of _append 
+        and the DB is not modified if there is an error (e.g. unhashable 
+        value)
+        """
+        items = list(_flatten_items(items))
+        if not items:
+            return
+        if self._interned is not None:
+            items = [self._intern_item(item) for item in items]
+        
+        ix0 = len(self._list) 
+        maps,counts = self._build_maps(items,ix0,self.fixed_attributes)
+        
+        # Merge. Nothing above has modified the DB
+        self._extend(items,ix0,maps,counts)
+    
+    def _extend(self,items,ix0,maps,counts):
+        """
+        Add items, which start at ix0, with their index from _build_maps()
+        """
+        if self.primary_key is not None:
+            self._check_keys(items) # Before anything is changed
+            self._pk.update((item[self.primary_key],ix) for ix,item in enumerate(items,ix0))
+        self._merge_maps(maps,counts)
+        with _gc_paused():
+            for attribs,cmap in self._composites.items():
+                getter = operator.itemgetter(*attribs)
+                for ix,item in enumerate(items,ix0):
+                    for key in _composite_keys(item,getter,self._empty):
+                        cmap[key].add(ix)
+        
+        if self._schemas is not None:
+            self._list.extend(self._compact(item) for item in items)
+        else:
+            self._list.extend(items)
+        for attrib,column in self._columns.items():
+            column.set_many(ix0,[item.get(attrib) for item in items])
+        self._ix.update(range(ix0,ix0 + len(items)))
+        self._touched(_ROWS)
+        self.N += len(items)
+        
+        if self._journal is not None:
+            self._journal.append(('add',items))
+    
+    def _build_maps(self,items,ix0,attributes=None):
+        """
+        Index items (numbered from ix0) into new maps. Only attributes are
+        indexed if set. Returns ({attrib:defaultdict(set)},{attrib:count}).
+        
+        If workers is set and there are enough items, the items are split 
+        into chunks that are indexed in a pool of processes and the maps
+        are combined. Not with intern_values since the values from the 
+        workers would be copies
+        """
+        workers = self.workers
+        if (not workers or workers < 2 or len(items) < _PARALLEL_MIN_ITEMS 
+                or self._interned is not None or _fork_context() is None):
+            with _gc_paused():
+                return _build_maps(items,ix0,attributes,
+                                   self.exclude_attributes,self._empty)
+        
+        # The items are given to the workers of this pool when they are 
+        # forked (not pickled) so only the chunk bounds are sent and the
+        # maps sent back. Nothing is shared with other builds
+        size = -(-len(items)//workers)
+        chunks = [(start,min(start + size,len(items)),ix0 + start,
+                   attributes,self.exclude_attributes)
+                  for start in range(0,len(items),size)]
+        pool = _fork_context().Pool(workers,initializer=_init_worker,
+                                    initargs=(items,))
+        try:
+            parts = pool.map(_build_chunk,chunks,chunksize=1)
+        finally:
+            pool.terminate()
+        
+        maps = {}
+        counts = defaultdict(int)
+        with _gc_paused():
+            for packed,pcounts in parts:
+                for attrib,(vals,ixs,offsets) in packed.items():
+                    try:
+                        amap = maps[attrib]
+                    except KeyError:
+                        amap = maps[attrib] = defaultdict(set)
+                    for k,val in enumerate(vals):
+                        chunk = ixs[offsets[k]:offsets[k+1]]
+                        if val in amap:
+                            amap[val].update(chunk)
+                        else:
+                            amap[val] = set(chunk)
+                for attrib,count in pcounts.items():
+                    counts[attrib] += count
+        
+        # The [] key is a copy from the workers. Use this DB's
+        for amap in maps.values():
+            ixs = amap.pop(self._empty,None)
+            if ixs:
+                amap[self._empty] = ixs
+        return maps,counts
+    
+    def _merge_maps(self,maps,counts):
+        """Merge maps and counts from _build_maps() into the index"""
+        empty = self._empty
+        for attrib,amap in maps.items():
+            self._clear_bitmaps(attrib)
+            self._touched(attrib)
+            lookup = self._lookup.get(attrib)
+            if attrib in self._sorted or attrib in self._strings:
+                if lookup:
+                    newvals = [val for val in amap if not lookup.get(val)]
+                else:
+                    newvals = list(amap)
+                newvals = [val for val in newvals if val is not empty]
+                if attrib in self._sorted:
+                    self._sorted_insert_many(attrib,newvals)
+                if attrib in self._strings:
+                    self._strings[attrib].add_many(newvals)
+                
+            if not lookup:
+                self._lookup[attrib] = amap
+                continue
+            for val,ixs in amap.items():
+                if val in lookup:
+                    lookup[val].update(ixs)
+                else:
+                    lookup[val] = ixs
+            
+        for attrib,count in counts.items():
+            self._counts[attrib] = self._counts.get(attrib,0) + count
+        self._attributes = None
+    
+    def query(self,*args,dicts=False,**kwargs):
         """
         Query the value for attribute. Will always an iterator. Use
         `list(DB.query())` to return a list
         
+        Matches are found lazily as they are iterated (see _iter_ixs) so
+        it is cheap to only take the first few.
+        
+        If dicts, compact rows (see compact_rows) are returned as dicts
+        
         Usage
         -----
         
@@ -153,21 +550,48 @@ class DictTable(object):
         >>> DB.query( (DB.Q.attrib1 == val1) &  (DB.Q.attrib1 != val2) )
                                    
         """
-        ixs = self._ixs(*args,**kwargs)
-        for ix in ixs:
-            yield self._list[ix]
+        if self._lock is None:
+            items = self._query(*args,**kwargs)
+        else:
+            with self._lock.read(): # Do not hold the lock while it is iterated
+                items = iter(list(self._query(*args,**kwargs)))
+        if dicts:
+            return (_as_dict(item) for item in items)
+        return items
+    
+    def _query(self,*args,**kwargs):
+        node = self._query_node(*args,**kwargs)
+        ixs = self._cached(node) if self.N else None # Cached are not modified
+        if ixs is None:
+            ixs = self._iter_ixs(node,snapshot=True) # The DB may change
+        if self._lock is not None: # Iterated all at once by query()
+            for ix in ixs:
+                item = self._list[ix]
+                if item is not None:
+                    yield item
+            return
+        with self._iterating():
+            for ix in ixs:
+                item = self._list[ix]
+                if item is not None: # May have been removed while iterating
+                    yield item
     
+    @_reads
     def query_one(self,*args,**kwargs):
         """
         Return a single item from a query. See "query" for more details.
         
         Returns None if nothing matches
         """
-        try:
-            return next(self.query(*args,**kwargs))
-        except StopIteration:
-            return None
+        node = self._query_node(*args,**kwargs)
+        ixs = self._cached(node,store=False)
+        if ixs is None:
+            ixs = self._iter_ixs(node,snapshot=False)
+        for ix in ixs: # Stop at the first
+            return self._list[ix]
+        return None
 
+    @_writes
     def pop(self,*args,**kwargs):
         """
         Query, delete, and return item.
@@ -175,7 +599,8 @@ class DictTable(object):
         Will raise a ValueError if more than one item will be deleted 
         Will raise a KeyError if there is no item to delete. Does *NOT* support a default
         """
-        ixs = self._ixs(*args,**kwargs)
+        node = self._query_node(*args,**kwargs)
+        ixs = list(itertools.islice(self._iter_ixs(node,snapshot=False),2))
         if len(ixs) == 0:
             raise KeyError('No matching query')
         if len(ixs) > 1:
@@ -183,8 +608,13 @@ class DictTable(object):
         ix = ixs[0]
         item = self._list[ix]
         self._remove_ix(ix)
+        if self._journal is not None:
+            self._journal.append(('remove',ixs))
+        self._auto_vacuum()
+        self._prune_interned()
         return item
 
+    @_reads
     def count(self,*args,**kwargs):
         """
         Return the number of matched rows for a given query. See "query" for
@@ -192,14 +622,98 @@ class DictTable(object):
         """
         return len(self._ixs(*args,**kwargs))
     
+    @_reads
     def isin(self,*args,**kwargs):
         """
         Check if there is at least one item that matches the given query
         
-        see query() for usage
+        see query() for usage. Stops at the first match
         """
-        return self.count(*args,**kwargs) > 0
+        node = self._query_node(*args,**kwargs)
+        ixs = self._cached(node,store=False)
+        if ixs is None:
+            ixs = self._iter_ixs(node,snapshot=False)
+        for _ in ixs:
+            return True
+        return False
 
+    @_reads
+    def get(self,key,default=None):
+        """
+        Return the item with primary_key of key (or default). This is a 
+        single lookup rather than a query. See primary_key in DictTable
+        """
+        if self.primary_key is None:
+            raise ValueError('get() requires a primary_key')
+        ix = self._pk.get(key)
+        if ix is None:
+            return default
+        return self._list[ix]
+    
+    @_writes
+    def upsert(self,item):
+        """
+        Add item or, if there is already an item with the same primary_key,
+        replace it. Only the index of the attributes that changed is 
+        updated. See primary_key in DictTable
+        """
+        if self.primary_key is None:
+            raise ValueError('upsert() requires a primary_key')
+        ix = self._pk.get(_check_key(item,self.primary_key))
+        if ix is None:
+            self.add(item)
+            return
+        
+        old = self._list[ix]
+        attribs = self.fixed_attributes or set(old).union(item)
+        attribs = [attrib for attrib in attribs if attrib not in self.exclude_attributes]
+        if self._interned is not None:
+            item = self._intern_item(item,attribs)
+        changed = [attrib for attrib in attribs
+                   if (attrib in old) != (attrib in item) or old.get(attrib) != item.get(attrib)]
+        composites = {cattribs:cmap for cattribs,cmap in self._composites.items()
+                      if not set(cattribs).isdisjoint(changed)}
+        
+        self._composite_remove(old,ix,composites)
+        for attrib in changed:
+            if attrib in old:
+                self._remove(attrib,old[attrib],ix)
+            if attrib in item:
+                self._append(attrib,item[attrib],ix)
+            if attrib in self._columns:
+                self._columns[attrib].set_many(ix,[item.get(attrib)])
+        self._list[ix] = self._compact(item)
+        self._composite_add(item,ix,composites)
+        
+        if self._journal is not None:
+            self._journal.append(('upsert',item))
+        self._prune_interned()
+    
+    def _check_keys(self,items):
+        """
+        Raise an error if any of items do not have a primary_key or it is 
+        not unique
+        """
+        seen = set()
+        for item in items:
+            key = _check_key(item,self.primary_key)
+            if key in self._pk or key in seen:
+                raise DuplicateKeyError('Duplicate primary key {!r}'.format(key))
+            seen.add(key)
+    
+    def _pk_map(self):
+        """Build {key:ix} of the primary_key of the items"""
+        pk = {}
+        for ix,item in enumerate(self._list):
+            if item is None:
+                continue
+            key = _check_key(item,self.primary_key)
+            if key in pk:
+                raise DuplicateKeyError('Duplicate primary key {!r}'.format(key))
+            pk[key] = ix
+        return pk
+    
+    @_writes
     def reindex(self,*attributes):
         """
         Reindex the dictionary for specified attributes (or all)
@@ -211,25 +725,178 @@ class DictTable(object):
         >>> DB.reindex('attrib')        # Reindex 'attrib'
         >>> DB.reindex('attrib1','attrib2') # Multiple
         
+        The index is built in parallel if DB.workers is set
+        
         See Also
         --------
             update() method which does not require reindexing
         """
+        attributes = self._reindex_attributes(attributes)
+        if self.primary_key in attributes:
+            self._pk = self._pk_map() # Items may have been changed
+        if self._interned is not None:
+            for item in self._list:
+                if item is not None and not isinstance(item,_Record):
+                    self._intern_item(item,attributes) # May have been changed
+        
+        maps,counts = self._build_maps(self._list,0,attributes)
+        self._replace_index(attributes,maps,counts)
+    
+    def _reindex_attributes(self,attributes):
         if len(attributes) == 0:
             attributes = self.attributes
         
         if any(a in self.exclude_attributes for a in attributes):
             raise ValueError('Cannot reindex an excluded attribute')
-
+        return attributes
+    
+    def _replace_index(self,attributes,maps,counts):
+        """Replace the index of attributes with maps from _build_maps()"""
         for attribute in attributes:
-            self._lookup[attribute] = defaultdict(list) # Reset
+            self._lookup[attribute] = defaultdict(set) # Reset
+            if self._counts.pop(attribute,None) is not None:
+                self._attributes = None
+            self._clear_bitmaps(attribute)
+            self._touched(attribute)
+            if attribute in self._sorted:
+                self._sorted[attribute] = {}
+                self._sorted_new.pop(attribute,None)
+            if attribute in self._strings:
+                self._strings[attribute] = _StringIndex()
         
-        for ix,item in enumerate(self._list):
-            if item is None: continue
-            for attrib in attributes:
-                if attrib in item:
-                    self._append(attrib,item[attrib],ix)
+        self._merge_maps(maps,counts)
+        for attrib in attributes:
+            if attrib in self._columns:
+                self._build_column(attrib)
+        for attribs in list(self._composites):
+            if not set(attribs).isdisjoint(attributes):
+                self._build_composite(attribs)
+        self._prune_interned()
+    
+    def aquery(self,*args,chunk_size=_ASYNC_CHUNK_SIZE,**kwargs):
+        """
+        Query for use with asyncio. Await it for a list of the matching items
+        or iterate with `async for`:
+        
+        >>> items = await DB.aquery(attrib=val)
+        >>> async for item in DB.aquery(DB.Q.attrib > val):
+        ...     ...
+        
+        The query is evaluated like query() but at most chunk_size items are
+        checked at a time and it yields to the event loop between chunks so 
+        large filters and scans do not block it. Like query(), each chunk 
+        sees the DB as it is then (e.g. removed items are skipped)
+        """
+        return _AsyncQuery(self,self._query_node(*args,**kwargs),chunk_size)
+    
+    async def _aiter_query(self,node,chunk_size):
+        ixs = self._cached(node,store=False) if self.N else None
+        if ixs is not None:
+            chunks = _chunked(list(ixs),chunk_size)
+        else:
+            chunks = self._iter_chunks(node,snapshot=True,size=chunk_size)
+        with self._iterating():
+            while True:
+                items = self._next_items(chunks)
+                if items is None:
+                    return
+                for item in items:
+                    yield item
+                await asyncio.sleep(0)
+    
+    @_reads
+    def _next_items(self,chunks):
+        """The items of the next chunk of indices or None if done"""
+        ixs = next(chunks,None)
+        if ixs is None:
+            return None
+        items = (self._list[ix] for ix in ixs)
+        return [item for item in items if item is not None]
     
+    async def aadd(self,items,chunk_size=_ASYNC_CHUNK_SIZE):
+        """
+        Add items like add() but for use with asyncio. The index of the new 
+        items is built chunk_size items at a time, yielding to the event 
+        loop between chunks, and then added all at once (after any items
+        added in the meantime). Queries in the meantime do not see any of 
+        the new items. The chunks are built here (not by workers) since 
+        forking them would block the event loop.
+        """
+        if isinstance(items,dict) or isinstance(items,_Record):
+            items = [items]
+        items = _flatten_items(items)
+        ix0 = len(self._list)
+        added = []
+        maps,counts = {},defaultdict(int)
+        with _gc_paused(): # Otherwise it will run (slowly) between chunks
+            while True:
+                chunk = list(itertools.islice(items,chunk_size))
+                if not chunk:
+                    break
+                if self._interned is not None:
+                    chunk = [self._intern_item(item) for item in chunk]
+                _combine_maps(maps,counts,*_build_maps(
+                    chunk,ix0 + len(added),self.fixed_attributes,
+                    self.exclude_attributes,self._empty))
+                added.extend(chunk)
+                await asyncio.sleep(0)
+            self._finish_aadd(added,ix0,maps,counts)
+    
+    @_writes
+    def _finish_aadd(self,items,ix0,maps,counts):
+        if not items:
+            return
+        shift = len(self._list) - ix0
+        if shift: # Items were added (or vacuumed) since. Move after them
+            maps = _shift_maps(maps,shift)
+            ix0 += shift
+        self._extend(items,ix0,maps,counts)
+    
+    async def areindex(self,*attributes,chunk_size=_ASYNC_CHUNK_SIZE):
+        """
+        Reindex like reindex() but for use with asyncio. The new index is 
+        built chunk_size items at a time, yielding to the event loop 
+        between chunks, and then replaces the old one all at once. Queries
+        in the meantime use the old index.
+        
+        If the attributes are changed or items are added or removed while 
+        the index is being built, it is started again. If that happens
+        _ASYNC_RESTARTS times, it is reindexed with reindex() instead which 
+        blocks the event loop but can not be interrupted. As with aadd(), 
+        the chunks are not built by workers.
+        """
+        attributes = self._reindex_attributes(attributes)
+        deps = set(attributes) | {_ROWS}
+        for _ in range(_ASYNC_RESTARTS + 1):
+            c = self._c
+            maps,counts = {},defaultdict(int)
+            with _gc_paused():
+                for start in range(0,len(self._list),chunk_size):
+                    if self._changed_since(deps,c):
+                        break
+                    chunk = self._list[start:start + chunk_size]
+                    if self._interned is not None:
+                        for item in chunk:
+                            if item is not None and not isinstance(item,_Record):
+                                self._intern_item(item,attributes)
+                    _combine_maps(maps,counts,*_build_maps(chunk,start,attributes,
+                                                           self.exclude_attributes,self._empty))
+                    await asyncio.sleep(0)
+            if self._finish_areindex(attributes,deps,c,maps,counts):
+                return
+        self.reindex(*attributes) # Kept changing
+    
+    @_writes
+    def _finish_areindex(self,attributes,deps,c,maps,counts):
+        """Replace the index unless deps changed since c. Returns if it was"""
+        if self._changed_since(deps,c):
+            return False
+        if self.primary_key in attributes:
+            self._pk = self._pk_map() # Items may have been changed
+        self._replace_index(attributes,maps,counts)
+        return True
+    
+    @_writes
     def update(self,*args,**queryKWs):
         """
         Update an entry without needing to reindex the DB (or a specific
@@ -257,12 +924,10 @@ class DictTable(object):
     
         Notes:
         ------
-            * Updating an item requires a deletion in a list that has length n
-              equal to the number of items matching an attribute. This is O(n).
-              However changing the entry directly and reindexing is O(N) where
-              N is the size of the DB. If many items are changing and you do not
-              need to query them in between, it *may* be faster to directly
-              update the item and reindex
+            * Updating an item requires a deletion from the set of items 
+              matching each changed attribute. This is O(1) regardless of how
+              many items share the value. Changing the entry directly and
+              reindexing is O(N) where N is the size of the DB.
         """
         
         if len(args) == 1:
@@ -283,26 +948,62 @@ class DictTable(object):
             ixs = self._ixs(**queryKWs)
         else:
             raise ValueError('Unrecognized query {:s}. Must be a dict or Query',format(type(query)))
+        ixs = list(ixs) # Copy since it may be an internal set that is updated
         
         if len(ixs) == 0:
             raise ValueError('Query did not match any results')
         
+        if self.primary_key in updated_dict:
+            key = _check_key(updated_dict,self.primary_key)
+            if len(ixs) > 1 or self._pk.get(key,ixs[0]) != ixs[0]:
+                raise DuplicateKeyError('Duplicate primary key {!r}'.format(key))
+        
+        self._update_ixs(updated_dict,ixs)
+        if self._journal is not None:
+            self._journal.append(('update',updated_dict,ixs))
+        self._prune_interned()
+    
+    def _update_ixs(self,updated_dict,ixs):
+        """Update the items at ixs. See update()"""
+        # Allow the update to also include non DB attributes.
+        # The intersection will eliminate any exclude_attributes
+        attributes = set(updated_dict.keys()).intersection(self.attributes)
+        if self._interned is not None:
+            updated_dict = self._intern_item(dict(updated_dict),attributes)
+        composites = {attribs:cmap for attribs,cmap in self._composites.items()
+                      if not set(attribs).isdisjoint(updated_dict)}
+        
+        pk = self.primary_key
         for ix in ixs:
             # Get original item
             item = self._list[ix]
-            
-            # Allow the update to also include non DB attributes.
-            # The intersection will eliminate any exclude_attributes
-            attributes = set(updated_dict.keys()).intersection(self.attributes)
+            if composites:
+                self._composite_remove(item,ix,composites)
+            if pk in updated_dict:
+                del self._pk[item[pk]]
+                self._pk[updated_dict[pk]] = ix
             
             for attrib in attributes: # Only loop over the updated attribs
-                value = item[attrib] # get old value
-                self._remove(attrib,value,ix) # Remove any ix matching it
+                if attrib in item:
+                    value = item[attrib] # get old value
+                    self._remove(attrib,value,ix) # Remove any ix matching it
                 value = updated_dict[attrib] # Get new value
                 self._append(attrib,value,ix) # Add ix to any new value
                 
-            item.update(updated_dict) # Update the item
+            for attrib in attributes:
+                if attrib in self._columns:
+                    self._columns[attrib].set_many(ix,[updated_dict[attrib]])
+            
+            if self._schemas is not None: # Records are read-only. Replace it
+                item = dict(item)
+                item.update(updated_dict)
+                self._list[ix] = self._compact(item)
+            else:
+                item.update(updated_dict) # Update the item
+            if composites:
+                self._composite_add(item,ix,composites)
     
+    @_writes
     def add_fixed_attribute(self,attrib,force=False):
         """
         Adds a fixed attribute. If there are NO fixed attributes (i.e. it is
@@ -317,7 +1018,164 @@ class DictTable(object):
             self.fixed_attributes.append(attrib)
         
         self.reindex(attrib)
+        if self._journal is not None:
+            self._journal.append(('fixed',attrib,force))
+    
+    @_writes
+    def add_sorted_attribute(self,attrib):
+        """
+        Also keep a sorted index of the values of attrib so that range 
+        queries (<, <=, >, >=, and between) are O(log N + k) where k is the 
+        number of matches rather than O(N).
+        
+        Values are ordered within their own family (all real numbers 
+        together, otherwise by type) so mixed types will not cause errors.
+        A range query will only match values of the same family as the 
+        comparison value. Values that cannot be ordered at all are not 
+        range-indexed.
+        
+        Does not require a reindex. Existing values are sorted in O(V log V) 
+        where V is the number of unique values.
+        """
+        if attrib in self.exclude_attributes:
+            raise ExcludedAttributeError("'{}' is excludes".format(attrib))
+        if self.fixed_attributes and attrib not in self.fixed_attributes:
+            raise ValueError("'{}' is not an indexed attribute".format(attrib))
+        
+        self._sorted[attrib] = {}
+        self._sorted_new.pop(attrib,None)
+        self._sorted_insert_many(attrib,[val for val,ixs in self._lookup[attrib].items()
+                                         if ixs and val is not self._empty])
+        if self._journal is not None:
+            self._journal.append(('sorted',attrib))
+    
+    @property
+    def sorted_attributes(self):
+        return sorted(self._sorted)
+    
+    @_writes
+    def add_string_attribute(self,attrib):
+        """
+        Also keep an index of the unique string values of attrib: sorted 
+        for startswith() and by each 3 characters (trigram) for contains() 
+        so that they do not have to check every unique value.
+        
+        >>> DB.Q.path.startswith('/var/log/')
+        >>> DB.Q.name.contains('ell')
+        
+        Substrings of fewer than 3 characters still check every unique 
+        value. Takes (a lot) more memory for long strings. Does not require 
+        a reindex.
+        """
+        if attrib in self.exclude_attributes:
+            raise ExcludedAttributeError("'{}' is excludes".format(attrib))
+        if self.fixed_attributes and attrib not in self.fixed_attributes:
+            raise ValueError("'{}' is not an indexed attribute".format(attrib))
+        
+        self._strings[attrib] = _StringIndex(val for val,ixs in self._lookup[attrib].items()
+                                             if ixs and val is not self._empty)
+        if self._journal is not None:
+            self._journal.append(('string',attrib))
+    
+    @property
+    def string_attributes(self):
+        return sorted(self._strings)
+    
+    @_writes
+    def create_index(self,attributes):
+        """
+        Also index the values of attributes (two or more) together so that
+        a query for all of them is a single lookup rather than intersecting
+        the items for each. For example, 
+        
+        >>> DB.create_index(('first','last'))
+        >>> DB.query(first='George',last='Harrison') # Uses it
+        
+        It is used automatically when a query has == conditions on all of 
+        the attributes. Items with lists are indexed for every combination
+        of their values. O(N) to build.
+        """
+        attribs = () if isinstance(attributes,str) else tuple(attributes)
+        if len(attribs) < 2 or len(set(attribs)) != len(attribs):
+            raise ValueError('A composite index needs two or more different attributes')
+        for attrib in attribs:
+            if attrib in self.exclude_attributes:
+                raise ExcludedAttributeError("'{}' is excludes".format(attrib))
+            if self.fixed_attributes and attrib not in self.fixed_attributes:
+                raise ValueError("'{}' is not an indexed attribute".format(attrib))
+        
+        self._build_composite(attribs)
+        if self._journal is not None:
+            self._journal.append(('composite',attribs))
+    
+    @property
+    def composite_indexes(self):
+        return sorted(self._composites)
+    
+    def _build_composite(self,attribs):
+        cmap = self._composites[attribs] = defaultdict(set)
+        getter = operator.itemgetter(*attribs)
+        with _gc_paused():
+            for ix,item in enumerate(self._list):
+                if item is None:
+                    continue
+                for key in _composite_keys(item,getter,self._empty):
+                    cmap[key].add(ix)
+    
+    def _composite_add(self,item,ix,composites=None):
+        """Add item to the composite indexes (or only composites)"""
+        if composites is None:
+            composites = self._composites
+        for attribs,cmap in composites.items():
+            for key in _composite_keys(item,operator.itemgetter(*attribs),self._empty):
+                cmap[key].add(ix)
+    
+    def _composite_remove(self,item,ix,composites=None):
+        """Remove item from the composite indexes (or only composites)"""
+        if composites is None:
+            composites = self._composites
+        for attribs,cmap in composites.items():
+            for key in _composite_keys(item,operator.itemgetter(*attribs),self._empty):
+                ixs = cmap.get(key)
+                if ixs is not None:
+                    ixs.discard(ix)
+                    if not ixs:
+                        del cmap[key]
+    
+    @_writes
+    def add_numeric_attribute(self,attrib):
+        """
+        Also keep the values of attrib in a NumPy array aligned with the 
+        items so that range queries (<, <=, >, >=, and between) with a 
+        number and vfilter() are vectorized. Items where the value is not a
+        real number (e.g. strings or lists) are still checked one-by-one.
+        
+        Sorted attributes still use the sorted index for ranges. If NumPy 
+        is not installed, nothing is built and queries work as usual.
+        O(N) to build.
+        """
+        if attrib in self.exclude_attributes:
+            raise ExcludedAttributeError("'{}' is excludes".format(attrib))
+        if self.fixed_attributes and attrib not in self.fixed_attributes:
+            raise ValueError("'{}' is not an indexed attribute".format(attrib))
+        
+        if attrib not in self._numeric:
+            self._numeric.append(attrib)
+        if np is not None:
+            self._build_column(attrib)
+        if self._journal is not None:
+            self._journal.append(('numeric',attrib))
+    
+    @property
+    def numeric_attributes(self):
+        return sorted(self._numeric)
+    
+    def _build_column(self,attrib):
+        column = self._columns[attrib] = _Column()
+        column.set_many(0,[item.get(attrib) if item is not None else None 
+                           for item in self._list])
           
+    @_writes
     def remove(self,*args,**kwargs):
         """
         Remove item that matches a given attribute or dict. See query() for
@@ -335,24 +1193,365 @@ class DictTable(object):
             # not sure what is happening, but it seems that I need to make a copy
             # since Python is doing something strange here...
             self._remove_ix(ix)
+        if self._journal is not None:
+            self._journal.append(('remove',ixs))
+        self._auto_vacuum()
+        self._prune_interned()
             
     def _remove_ix(self,ix):
         item = self._list[ix]
-        for attrib in self.attributes:
-            if attrib in item:
+        # Loop the shorter of the item or indexed attributes. Matters for 
+        # wide, sparse tables
+        indexed = self._counts
+        for attrib in list(item if len(item) < len(indexed) else indexed):
+            if attrib in item and attrib in indexed:
                 self._remove(attrib,item[attrib],ix)
+        self._composite_remove(item,ix)
+        if self.primary_key is not None:
+            del self._pk[item[self.primary_key]]
             
         # Remove it from the list by setting to None. Do not reshuffle
         # the indices. A None check will be performed elsewhere
         self._list[ix] = None
-        self._ix.difference_update([ix])
+        self._ix.discard(ix)
+        for column in self._columns.values():
+            column.set_many(ix,[None])
+        self._touched(_ROWS)
         self.N -= 1
     
+    @_writes
+    def vacuum(self):
+        """
+        Reclaim the slots of deleted items. Deleted items are only marked 
+        (so that indices do not change) but they are still looped over by 
+        iteration, filters, unsorted ranges, and reindex.
+        
+        This rewrites the items and the entire index with new, dense 
+        indices so it is O(N).
+        
+        WARNING: This changes the index of items (DB[ix] and _index queries)
+                 and all existing Query objects are invalidated
+        """
+        if len(self._list) == self.N:
+            return
+        
+        remap = [None]*len(self._list) # old -> new
+        items = []
+        for ix,item in enumerate(self._list):
+            if item is None:
+                continue
+            remap[ix] = len(items)
+            items.append(item)
+        
+        with _gc_paused():
+            for amap in itertools.chain(self._lookup.values(),self._composites.values()):
+                for val,ixs in amap.items():
+                    amap[val] = set(remap[ix] for ix in ixs)
+        
+        self._list = items
+        self._ix = (_Bitmap if self._bitmaps is not None else set)(range(len(items)))
+        if self.primary_key is not None:
+            self._pk = self._pk_map()
+        for attrib in self._columns:
+            self._build_column(attrib)
+        self._clear_bitmaps()
+        self.cache_clear()
+        self._c += 1
+        self._vacuumed = self._c
+        
+        if self._journal is not None:
+            self._journal.append(('vacuum',))
+    
+    def _auto_vacuum(self):
+        if self.vacuum_threshold is None or not self._list or self._iterators:
+            return # Deferred until the iterators are done. See _iterating()
+        if len(self._list) - self.N > self.vacuum_threshold*len(self._list):
+            self.vacuum()
+    
+    @contextlib.contextmanager
+    def _iterating(self):
+        """
+        Mark a query (or iteration of the DB) as being iterated. A vacuum 
+        changes the indices that it still has to go through so auto-vacuum
+        waits until no queries are being iterated. 
+        
+        The count is released when the generator finishes, is closed, or is
+        garbage collected. One that is partly iterated and kept around 
+        defers auto-vacuum until then. vacuum() is not deferred
+        """
+        with self._cache_lock:
+            self._iterators += 1
+        try:
+            yield
+        finally:
+            with self._cache_lock:
+                self._iterators -= 1
+                done = not self._iterators
+            if done:
+                self._auto_vacuum()
+    
+    @_reads
     def copy(self):
         return DictTable(self,
                          exclude_attributes=copy.copy(self.exclude_attributes),
-                         fixed_attributes=copy.copy(self.fixed_attributes))
+                         fixed_attributes=copy.copy(self.fixed_attributes),
+                         sorted_attributes=self.sorted_attributes,
+                         vacuum_threshold=self.vacuum_threshold,
+                         bitmaps=self._bitmaps is not None,
+                         cache_size=self._cache_size,
+                         compact_rows=self._schemas is not None,
+                         intern_values=self._interned is not None,
+                         numeric_attributes=self._numeric,
+                         string_attributes=self.string_attributes,
+                         composite_indexes=self.composite_indexes,
+                         primary_key=self.primary_key,
+                         concurrent=self._lock is not None,
+                         prefer_writers=getattr(self._lock,'prefer_writers',True),
+                         workers=self.workers)
     __copy__ = copy
+    
+    @_reads
+    def save(self,path):
+        """
+        Save the DictTable, including the index, to path. Load it with 
+        DictTable.load(path). Query results that are cached are not saved.
+        
+        This uses pickle so the items must be picklable and, like pickle, 
+        only load files you trust.
+        """
+        with open(path,'wb') as fobj:
+            fobj.write(_SAVE_MAGIC)
+            pickle.dump((_SAVE_VERSION,self),fobj,protocol=pickle.HIGHEST_PROTOCOL)
+    
+    @classmethod
+    def load(cls,path):
+        """
+        Load a DictTable saved with DB.save(path). The index is loaded as 
+        saved and is not rebuilt. This uses pickle so only load files you 
+        trust.
+        """
+        with open(path,'rb') as fobj:
+            if fobj.read(len(_SAVE_MAGIC)) != _SAVE_MAGIC:
+                raise ValueError('Not a saved DictTable: {}'.format(path))
+            with _gc_paused():
+                version,DB = pickle.load(fobj)
+        if version != _SAVE_VERSION:
+            raise ValueError('Unsupported DictTable save version {}'.format(version))
+        return DB
+    
+    @_reads
+    def save_mapped(self,path):
+        """
+        Save the DictTable to path in the format read by MappedDictTable. 
+        Deleted items are not saved so the indices will be the same as after 
+        vacuum().
+        
+        Layout: magic, header, each item pickled, the (int64) file offset 
+        of each item, the (int64) posting lists of every attribute and 
+        value, then the directory of {attrib:{val:(start,count)}} into the 
+        posting lists with the rest of the settings.
+        """
+        for attrib in list(self._sorted_new):
+            self._sorted_merge(attrib)
+        remap = {}
+        with open(path,'wb') as fobj:
+            fobj.write(_MAPPED_MAGIC)
+            fobj.write(_MAPPED_HEADER.pack(0,0)) # Placeholder
+            
+            offsets = array('q',[fobj.tell()])
+            for ix,item in enumerate(self._list):
+                if item is None:
+                    continue
+                remap[ix] = len(remap)
+                fobj.write(pickle.dumps(item,protocol=pickle.HIGHEST_PROTOCOL))
+                offsets.append(fobj.tell())
+            fobj.write(b'\x00'*(-fobj.tell() % 8)) # Align the arrays
+            
+            rows_offset = fobj.tell()
+            offsets.tofile(fobj)
+            
+            postings_offset = fobj.tell()
+            lookup = {}
+            start = 0
+            for attrib,amap in self._lookup.items():
+                directory = lookup[attrib] = {}
+                for val,ixs in amap.items():
+                    posting = array('q',sorted(remap[ix] for ix in ixs))
+                    posting.tofile(fobj)
+                    directory[val] = (start,len(posting))
+                    start += len(posting)
+            
+            dir_offset = fobj.tell()
+            directory = dict(N=len(remap),
+                             byteorder=sys.byteorder,
+                             rows_offset=rows_offset,
+                             postings_offset=postings_offset,
+                             lookup=lookup,
+                             counts=self._counts,
+                             sorted=self._sorted,
+                             fixed_attributes=self.fixed_attributes,
+                             exclude_attributes=self.exclude_attributes)
+            pickle.dump(directory,fobj,protocol=pickle.HIGHEST_PROTOCOL)
+            dir_length = fobj.tell() - dir_offset
+            
+            fobj.seek(len(_MAPPED_MAGIC))
+            fobj.write(_MAPPED_HEADER.pack(dir_offset,dir_length))
+    
+    @_writes
+    def open_journal(self,snapshot,journal,sync_every=100,sync_interval=1.0):
+        """
+        Start journaling changes for recovery after a crash. The current
+        DB is saved to snapshot (see save()) and every add(), upsert(), 
+        update(), remove(), pop(), vacuum(), add_fixed_attribute(), 
+        add_sorted_attribute(), add_string_attribute(), 
+        add_numeric_attribute(), and create_index() is then appended to 
+        journal. Recover with DictTable.recover(snapshot,journal).
+        
+        Inputs:
+        -------
+        snapshot,journal
+            Paths of the snapshot and the journal. An existing journal is
+            replaced
+        
+        sync_every [100], sync_interval [1.0]
+            Changes are written (flushed) to the journal immediately so they
+            survive the process being killed but only synced to disk (fsync)
+            every sync_every entries or at most sync_interval seconds after
+            a change (group commit), even if no more changes are made. Set
+            sync_every=1 to sync every change. Call sync() to force it.
+        
+        Notes:
+        ------
+            * Changing items in place and reindex() are *not* journaled. 
+              Use update()
+            * The journal grows with every change. Call checkpoint() to 
+              save a new snapshot and empty it
+        """
+        self.close_journal()
+        self._journal_paths = (snapshot,journal)
+        self._journal_sync = (sync_every,sync_interval)
+        self.checkpoint()
+    
+    @_writes
+    def checkpoint(self):
+        """
+        Save a new snapshot of the DB and empty the journal. See 
+        open_journal()
+        """
+        if not hasattr(self,'_journal_paths'):
+            raise ValueError('No journal. Use open_journal()')
+        snapshot,journal = self._journal_paths
+        
+        # Save the snapshot first with the next generation. If it crashes
+        # before the journal is emptied, recover() will know the journal 
+        # is already in the snapshot
+        self.close_journal()
+        self._generation += 1
+        tmp = snapshot + '.tmp'
+        self.save(tmp)
+        with open(tmp,'rb') as fobj:
+            os.fsync(fobj.fileno())
+        os.replace(tmp,snapshot)
+        
+        self._journal = _Journal(journal,self._generation,*self._journal_sync,
+                                 truncate=0)
+    
+    @_writes
+    def sync(self):
+        """Flush the journal to disk. See open_journal()"""
+        if self._journal is not None:
+            self._journal.sync()
+    
+    @_writes
+    def close_journal(self):
+        """Sync and stop journaling changes"""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+    
+    @classmethod
+    def recover(cls,snapshot,journal,sync_every=100,sync_interval=1.0):
+        """
+        Load the snapshot and replay the journal written by a DB with 
+        open_journal(snapshot,journal). Continues journaling to the same
+        files. A partially written last entry (e.g. from a crash) is 
+        discarded
+        """
+        DB = cls.load(snapshot)
+        generation,entries,length = _read_journal(journal)
+        if generation == DB._generation: # Otherwise it is already in the snapshot
+            for entry in entries:
+                DB._replay(entry)
+        else:
+            length = 0
+        
+        DB._journal_paths = (snapshot,journal)
+        DB._journal_sync = (sync_every,sync_interval)
+        DB._journal = _Journal(journal,DB._generation,sync_every,sync_interval,
+                               truncate=length)
+        return DB
+    
+    def _replay(self,entry):
+        """Apply a journal entry"""
+        op = entry[0]
+        if op == 'add':
+            self._bulk_add(entry[1])
+        elif op == 'update':
+            self._update_ixs(entry[1],entry[2])
+        elif op == 'remove':
+            for ix in entry[1]:
+                self._remove_ix(ix)
+        elif op == 'vacuum':
+            self.vacuum()
+        elif op == 'fixed':
+            self.add_fixed_attribute(*entry[1:])
+        elif op == 'sorted':
+            self.add_sorted_attribute(entry[1])
+        elif op == 'numeric':
+            self.add_numeric_attribute(entry[1])
+        elif op == 'string':
+            self.add_string_attribute(entry[1])
+        elif op == 'composite':
+            self.create_index(entry[1])
+        elif op == 'upsert':
+            self.upsert(entry[1])
+        else:
+            raise ValueError('Unrecognized journal entry {}'.format(op))
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Locks can not be saved. Keep the settings
+        if self._lock is not None:
+            state['_lock'] = self._lock.prefer_writers
+        del state['_cache_lock']
+        state['_iterators'] = 0
+        # Files are not saved. Use recover()
+        state['_journal'] = None
+        state.pop('_journal_paths',None)
+        state.pop('_journal_sync',None)
+        # Do not save caches. They are rebuilt as needed
+        if self._bitmaps is not None:
+            state['_bitmaps'] = OrderedDict()
+        state['_bitmaps_memory'] = 0
+        state['_attr_bitmaps'] = {}
+        if self._cache is not None:
+            state['_cache'] = OrderedDict()
+        state['_cache_deps'] = defaultdict(set)
+        state['_cache_stats'] = dict.fromkeys(self._cache_stats,0)
+        return state
+    
+    def __setstate__(self,state):
+        state.setdefault('workers',None)
+        state.setdefault('_iterators',0)
+        state.setdefault('_sorted_new',{})
+        state['_bitmaps_memory'] = 0
+        if state.get('_bitmaps') is not None:
+            state['_bitmaps'] = OrderedDict()
+        self.__dict__.update(state)
+        if self._lock is not None:
+            self._lock = _RWLock(self._lock)
+        self._cache_lock = threading.Lock()
+        self._id = str(uuid.uuid4()) # Queries are not shared with the original
             
     @property
     def Query(self):
@@ -366,11 +1565,22 @@ class DictTable(object):
     
     def _ixs(self,*args,**kwargs):
         """
-        Get the inde(x/ies) of matching information
+        Get the inde(x/ies) of matching information. Do *NOT* modify the
+        result in place
         """
         if not hasattr(self,'_lookup') or self.N==0: # It may be empty
             return []
- 
+        node = self._query_node(*args,**kwargs)
+        ixs = self._cached(node)
+        if ixs is None:
+            ixs = self._evaluate(node)
+        return ixs
+    
+    def _query_node(self,*args,**kwargs):
+        """
+        Combine the inputs of a query (see query()) into a single 'and'
+        query node
+        """
         # Make the entire kwargs be lists with default of []. Edge case of
         # multiple items
         for key,val in kwargs.items():
@@ -378,13 +1588,13 @@ class DictTable(object):
                 kwargs[key] = [val]
         kwargs = defaultdict(list,kwargs)
         
-        Q = Query(self) # Empty object
+        nodes = []
         for arg in args:
             if isinstance(arg,Query):
                 if arg._id != self._id:
                     raise ValueError("Cannot use another DictTable's Query object")
-                
-                Q = Q & arg # Will add these conditions. If Q is empty, will just be arg
+                arg._valid()
+                nodes.append(arg._node)
                 continue
             if isinstance(arg,dict):
                 for key,val in arg.items(): # Add it rather than update in case it is already specified
@@ -397,27 +1607,533 @@ class DictTable(object):
             if isinstance(value,list) and len(value) == 0:
                 value = [self._empty]
             for val in _makelist(value):
-                Qtmp = Query(self)
-                Qtmp._attr = key
-                Q = Q & (Qtmp == val)
-
-        ixs = Q._ixs
-        return list(ixs)
-        
-    def _index(self,ix):
-        """
-        Return ix if it hasn't been deleted
+                for v in _makelist(val):
+                    if key == '_index':
+                        nodes.append(('index',v))
+                    else:
+                        nodes.append(('eq',key,v))
+        return _and(*nodes)
+    
+    def _evaluate(self,node,within=None):
         """
-        try:
-            item = self._list[ix]
-        except IndexError:
-            return []
+        Evaluate a query node (see Query) into the set of matching items. 
+        If within is specified, only return those in within. This is used to
+        only apply filters and scans to the items that could still match.
         
-        if item is None:
-            return []
-        return [ix]
-    
-    def _append(self,attrib,value,ix):
+        'and' nodes are planned: the cheapest (usually most selective) 
+        conditions are evaluated first, the rest only within the running 
+        result, and it stops as soon as that is empty.
+        
+        Do *NOT* modify the result in place
+        """
+        op = node[0]
+        if op == 'all':
+            return self._ix if within is None else within
+        
+        if op == 'and':
+            children = self._plan(node[1])
+            ixs = within
+            for child in children:
+                ixs = self._evaluate(child,ixs)
+                if not ixs:
+                    break
+            return ixs
+        
+        if op == 'or':
+            ixs = self._rowset()
+            for child in node[1]:
+                ixs = ixs | self._evaluate(child,within)
+            return ixs
+        
+        if op == 'not':
+            universe = self._ix if within is None else within
+            return universe - self._evaluate(node[1],within)
+        
+        if op == 'filter':
+            filter_func = node[1]
+            return self._scan(lambda item: filter_func(item),within)
+        
+        if op == 'range':
+            attrib,low,high,low_inclusive,high_inclusive = node[1:]
+            if attrib in self._sorted:
+                ixs = self._range(attrib,low,high,low_inclusive,high_inclusive)
+            elif attrib in self._numeric and _real_bounds(low,high):
+                return self._column_range(attrib,low,high,low_inclusive,high_inclusive,within)
+            else:
+                return self._scan_range(attrib,low,high,low_inclusive,high_inclusive,within)
+        elif op == 'vfilter':
+            return self._vfilter(node[1],node[2],within)
+        elif op == 'eq':
+            # Within a (sparse) set, do not build the bitmap
+            ixs = self._posting(node[1],node[2],
+                                bitmap=within is None or isinstance(within,_Bitmap))
+        elif op in ('startswith','contains'):
+            ixs = self._match_strings(op,node[1],node[2])
+        elif op == 'composite':
+            ixs = self._composites[node[1]].get(node[2])
+            if ixs is None:
+                ixs = _EMPTYSET
+            if self._bitmaps is not None:
+                ixs = self._rowset(ixs)
+        elif op == 'attr':
+            ixs = self._attr_rows(node[1])
+        elif op == 'index':
+            ix = node[1]
+            if isinstance(ix,tuple): # Several. Only made internally
+                ixs = self._rowset(i for i in ix if i >= 0 and self._index(i))
+            else:
+                ixs = self._rowset(self._index(ix) if isinstance(ix,int) and ix >= 0 else [])
+        else:
+            raise ValueError('Unrecognized query node {}'.format(op))
+        
+        if within is None:
+            return ixs
+        return within & ixs
+    
+    @_reads
+    def cache_info(self):
+        """
+        Return a dict of the query cache statistics: hits, misses, 
+        evictions (to stay within cache_size), invalidations (from changes), 
+        size (number of entries), maxsize, and memory (approximate bytes of 
+        the cached results)
+        """
+        info = dict(self._cache_stats)
+        info['size'] = len(self._cache) if self._cache is not None else 0
+        info['maxsize'] = self._cache_size
+        return info
+    
+    @_writes
+    def cache_clear(self):
+        """Clear the query cache. Does not reset the statistics"""
+        if self._cache is None:
+            return
+        self._cache.clear()
+        self._cache_deps.clear()
+        self._cache_stats['memory'] = 0
+    
+    def _cached(self,node,store=True):
+        """
+        Return the cached result of a query node. If it isn't cached, 
+        evaluate and store it unless store is False. Returns None if there 
+        is no cache, the node can't be cached, or it isn't cached and not 
+        store. The cached result is never modified
+        """
+        if self._cache is None:
+            return None
+        key,deps = _cache_key(node)
+        if key is None:
+            return None
+        if not all(dep is _ROWS or self._is_indexed(dep) for dep in deps):
+            return None # Changes to it are not tracked (e.g. range scans)
+        
+        with self._cache_lock:
+            entry = self._cache.pop(key,None)
+            if entry is not None:
+                self._cache[key] = entry # Most recently used
+                self._cache_stats['hits'] += 1
+                return entry[0]
+            if not store:
+                return None
+            self._cache_stats['misses'] += 1
+        
+        ixs = self._evaluate(node)
+        # Copy since it may be an internal (changing) set and so it can be 
+        # iterated while the DB changes
+        if isinstance(ixs,_Bitmap):
+            ixs = _Bitmap(bits=ixs.bits)
+        else:
+            ixs = frozenset(ixs)
+        
+        size = _sizeof(ixs)
+        with self._cache_lock:
+            self._drop_cached(key) # In case another read added it
+            self._cache[key] = (ixs,deps,size)
+            self._cache_stats['memory'] += size
+            for dep in deps:
+                self._cache_deps[dep].add(key)
+            
+            while len(self._cache) > self._cache_size:
+                key,_ = self._cache.popitem(last=False)
+                self._cache_stats['evictions'] += 1
+                self._drop_cached(key)
+        return ixs
+    
+    def _drop_cached(self,key):
+        """Remove key from the cache (if it is there) and its dependencies"""
+        entry = self._cache.pop(key,None)
+        if entry is None:
+            return
+        _,deps,size = entry
+        self._cache_stats['memory'] -= size
+        for dep in deps:
+            keys = self._cache_deps.get(dep)
+            if keys:
+                keys.discard(key)
+    
+    def _touched(self,dep):
+        """
+        Record that dep (an attribute or _ROWS) changed and drop cached 
+        queries that depend on it
+        """
+        self._c += 1
+        self._versions[dep] = self._c
+        self._invalidate(dep)
+    
+    def _changed_since(self,deps,c):
+        """
+        Whether any of deps (attributes and/or _ROWS) changed after _c was 
+        c. If deps is None, whether *anything* changed
+        """
+        if self._vacuumed > c:
+            return True
+        if deps is None:
+            return self._c > c
+        versions = self._versions
+        return any(versions.get(dep,0) > c for dep in deps)
+    
+    def _invalidate(self,dep):
+        """
+        Drop cached queries that depend on dep (an attribute or _ROWS)
+        """
+        if not self._cache:
+            return
+        keys = self._cache_deps.pop(dep,None)
+        if not keys:
+            return
+        for key in keys:
+            if key in self._cache:
+                self._cache_stats['invalidations'] += 1
+                self._drop_cached(key)
+        
+    def _compact(self,item):
+        """
+        Return the item as a _Record with a shared schema if using 
+        compact_rows. Otherwise, return it as is
+        """
+        if self._schemas is None or isinstance(item,_Record):
+            return item
+        keys = tuple(item)
+        try:
+            schema = self._schemas[keys]
+        except KeyError:
+            schema = self._schemas[keys] = _Schema(keys)
+        return _Record(schema,tuple(item.values()))
+    
+    def _intern_item(self,item,attribs=None):
+        """
+        Replace the values of attribs (or all) of item with their canonical
+        objects. The first of equal values (of the same type) becomes the 
+        canonical one. Values in lists are replaced in the list. Returns 
+        the item (a dict copy if it was a read-only _Record).
+        
+        The index is keyed by these same objects so each value is only 
+        stored once. Unlike a dictionary encoding with integer codes, 
+        there is nothing to translate when querying
+        """
+        if isinstance(item,_Record):
+            item = item.copy()
+        pool = self._interned
+        exclude = self.exclude_attributes
+        for attrib in (item if attribs is None else attribs):
+            if attrib not in item or attrib in exclude:
+                continue
+            value = item[attrib]
+            if isinstance(value,list):
+                value[:] = [pool.setdefault((type(val),val),val) for val in value]
+            else:
+                item[attrib] = pool.setdefault((type(value),value),value)
+        return item
+    
+    def _prune_interned(self):
+        """
+        Drop canonical values that are no longer indexed. Values are not 
+        reference counted. Instead, once there are many more canonical 
+        values than indexed ones, rebuild them from the index. Amortized O(1)
+        """
+        if self._interned is None:
+            return
+        nvals = sum(len(amap) for amap in self._lookup.values())
+        if len(self._interned) <= 2*nvals + 1024:
+            return
+        self._interned = dict(((type(val),val),val) 
+                              for amap in self._lookup.values()
+                              for val in amap if val is not self._empty)
+    
+    def _iter_ixs(self,node,snapshot=True):
+        """
+        Generator of the matching indices of a query node without 
+        evaluating the entire query.
+        
+        The cheapest condition (or everything if it is a filter, 'not', or
+        unsorted range) is looped in growing chunks and the rest of the 
+        conditions are evaluated only within each chunk. Stops as soon as 
+        the consumer does (e.g. query_one() and isin()).
+        
+        If snapshot, the looped condition is first copied. This is needed 
+        if the DB may be changed while iterating. Later chunks see the 
+        changes.
+        """
+        for ixs in self._iter_chunks(node,snapshot):
+            for ix in ixs:
+                yield ix
+    
+    def _iter_chunks(self,node,snapshot=True,size=None):
+        """
+        Generator of the matching indices of a query node in chunks. See 
+        _iter_ixs(). Each chunk is from at most size of the looped 
+        condition or, if size is None, growing chunks.
+        """
+        if not self.N:
+            return
+        
+        children = self._plan(node[1] if node[0] == 'and' else [node])
+        if self._is_scan(children[0]):
+            driver = self._ix
+        else:
+            driver = self._evaluate(children.pop(0))
+        
+        if snapshot and not isinstance(driver,_Bitmap): # Bitmaps are immutable
+            driver = list(driver)
+        
+        if not children and size is None:
+            yield driver
+            return
+        
+        driver = iter(driver)
+        grow = size is None
+        if grow:
+            size = _CHUNK_START
+        while True:
+            chunk = list(itertools.islice(driver,size))
+            if not chunk:
+                return
+            ixs = chunk
+            if children:
+                ixs = self._rowset(chunk)
+            for child in children:
+                ixs = self._evaluate(child,ixs)
+                if not ixs:
+                    break
+            yield ixs
+            if grow:
+                size = min(2*size,_CHUNK_MAX)
+    
+    def _plan(self,children):
+        """
+        Return the children of an 'and' node in the order to evaluate them:
+        cheapest first. == conditions on all of the attributes of a 
+        composite index are replaced with ('composite',attribs,key) lookups
+        """
+        if self._composites:
+            children = self._use_composites(children)
+        return sorted(children,key=self._cost)
+    
+    def _use_composites(self,children):
+        eqs = defaultdict(list)
+        for child in children:
+            if child[0] == 'eq':
+                eqs[child[1]].append(child[2])
+        if len(eqs) < 2:
+            return children
+        
+        used = set()
+        nodes = []
+        for attribs in sorted(self._composites,key=len,reverse=True): # Widest first
+            if not all(attrib in eqs for attrib in attribs) or not used.isdisjoint(attribs):
+                continue
+            used.update(attribs)
+            # Multiple == on an attribute (e.g. of a list) must all match
+            for key in itertools.product(*(eqs[attrib] for attrib in attribs)):
+                nodes.append(('composite',attribs,key))
+        if not nodes:
+            return children
+        return [child for child in children 
+                if not (child[0] == 'eq' and child[1] in used)] + nodes
+    
+    def _is_scan(self,node):
+        """
+        Whether the node is only cheap to evaluate within other results. 
+        """
+        op = node[0]
+        if op == 'range':
+            if node[1] in self._sorted:
+                return False
+            return node[1] not in self._columns or not _real_bounds(node[2],node[3])
+        if op == 'vfilter':
+            return not all(attrib in self._columns for attrib in node[2])
+        return op in ('all','not','filter')
+    
+    def _cost(self,node):
+        """
+        Estimate the cost (roughly the number of items) to evaluate a node.
+        Used to plan the order of 'and' nodes. Filters and unsorted ranges 
+        are always last since they get cheaper the fewer items are left
+        """
+        op = node[0]
+        if op == 'eq':
+            return len(self._lookup.get(node[1],{}).get(node[2],()))
+        if op == 'index':
+            return len(node[1]) if isinstance(node[1],tuple) else 1
+        if op == 'composite':
+            return len(self._composites[node[1]].get(node[2],()))
+        if op in ('attr','startswith','contains'):
+            return self._counts.get(node[1],0)
+        if op == 'range' and node[1] in self._sorted:
+            keys,i,j = self._range_keys(*node[1:])
+            return self._counts.get(node[1],0)*(j - i)//max(len(keys),1)
+        if op in ('range','vfilter') and not self._is_scan(node):
+            return self.N # Vectorized. Same as everything 
+        if op == 'and':
+            return min(self._cost(child) for child in node[1])
+        if op == 'or':
+            return min(sum(self._cost(child) for child in node[1]),self.N)
+        if op == 'not':
+            return max(self.N - self._cost(node[1]),0)
+        if op in ('filter','vfilter'):
+            return self.N + 2
+        if op == 'range': # Unsorted
+            return self.N + 1
+        return self.N # all
+    
+    def _column_range(self,attrib,low,high,low_inclusive,high_inclusive,within=None):
+        """
+        Range query on the NumPy column of attrib. Items with values that
+        are not in the column (e.g. lists) are checked one-by-one. Without
+        NumPy, all items are checked this way. Only numbers are compared 
+        (as with sorted attributes)
+        """
+        def test(values):
+            result = True
+            if low is not _UNBOUNDED:
+                result = (values >= low) if low_inclusive else (values > low)
+            if high is not _UNBOUNDED:
+                result = result & ((values <= high) if high_inclusive else (values < high))
+            return result
+        if attrib not in self._columns:
+            ixs = self._rowset()
+            other = within
+        else:
+            ixs = self._vector_eval([attrib],test,within)
+            other = self._columns[attrib].other
+            if within is not None:
+                other = within & other # Not `ix in within` since it may be a bitmap
+        
+        if other is None or other:
+            check = lambda val:isinstance(val,numbers.Real) and test(val)
+            ixs = ixs | self._scan(lambda item:attrib in item and \
+                                   any(check(val) for val in _makelist(item[attrib])),other)
+        return ixs
+    
+    def _vfilter(self,func,attributes,within=None):
+        """
+        Items where all attributes are (non-list) real numbers and 
+        func(*values) is True. Vectorized if all attributes are numeric
+        """
+        if not self._is_scan(('vfilter',func,attributes)):
+            return self._vector_eval(attributes,func,within)
+        def check_item(item):
+            values = [item.get(attrib) for attrib in attributes]
+            if not all(_is_number(val) for val in values):
+                return False
+            return bool(func(*values))
+        return self._scan(check_item,within)
+    
+    def _vector_eval(self,attributes,func,within=None):
+        """
+        Evaluate func on the column arrays of attributes (or only the 
+        items in within). func must return a boolean array (or bool). 
+        Returns the items where it is True and all values are in the columns
+        """
+        columns = [self._columns[attrib] for attrib in attributes]
+        n = len(self._list)
+        if within is None:
+            arrays = [column.values[:n] for column in columns]
+            valid = columns[0].valid[:n]
+            for column in columns[1:]:
+                valid = valid & column.valid[:n]
+        else:
+            idx = np.fromiter(within,dtype=np.int64,count=len(within))
+            arrays = [column.values[idx] for column in columns]
+            valid = columns[0].valid[idx]
+            for column in columns[1:]:
+                valid = valid & column.valid[idx]
+        
+        with np.errstate(all='ignore'): # Missing are NaN
+            result = np.asarray(func(*arrays),dtype=bool) & valid
+        
+        if within is not None:
+            return self._rowset(idx[result].tolist())
+        if self._bitmaps is not None: # Directly make the bits
+            bits = np.packbits(result,bitorder='little').tobytes()
+            return _Bitmap(bits=int.from_bytes(bits,'little'))
+        return set(np.flatnonzero(result).tolist())
+    
+    def _scan(self,check,within=None):
+        """
+        Loop all items (or those in within) and return those where 
+        check(item) is True. O(N) or O(len(within))
+        """
+        ixs = set()
+        if within is None:
+            for ix,item in enumerate(self._list): # loop all
+                if item is not None and check(item):
+                    ixs.add(ix)
+        else:
+            for ix in within:
+                if check(self._list[ix]):
+                    ixs.add(ix)
+        return self._rowset(ixs)
+        
+    def _scan_range(self,attrib,low,high,low_inclusive,high_inclusive,within=None):
+        """
+        Loop all items (or those in within) and return those where attrib
+        is within the range. Like _scan but the values are compared directly
+        since this is the hot loop of unindexed ranges. Lists match if any
+        value does
+        """
+        def check(val):
+            if low is not _UNBOUNDED and \
+                    ((val < low) if low_inclusive else (val <= low)):
+                return False
+            if high is not _UNBOUNDED and \
+                    ((val > high) if high_inclusive else (val >= high)):
+                return False
+            return True
+        
+        haslow,hashigh = low is not _UNBOUNDED,high is not _UNBOUNDED
+        items = self._list
+        ixs = set()
+        for ix in (range(len(items)) if within is None else within):
+            item = items[ix]
+            if item is None or attrib not in item:
+                continue
+            val = item[attrib]
+            if isinstance(val,list):
+                if any(check(v) for v in val):
+                    ixs.add(ix)
+                continue
+            if haslow and ((val < low) if low_inclusive else (val <= low)):
+                continue
+            if hashigh and ((val > high) if high_inclusive else (val >= high)):
+                continue
+            ixs.add(ix)
+        return self._rowset(ixs)
+        
+    def _index(self,ix):
+        """
+        Return ix if it hasn't been deleted
+        """
+        try:
+            item = self._list[ix]
+        except IndexError:
+            return []
+        
+        if item is None:
+            return []
+        return [ix]
+    
+    def _append(self,attrib,value,ix):
         """
         Add to the lookup and update the modify time
         """
@@ -426,91 +2142,1932 @@ class DictTable(object):
             #print('BAD! Should guard against this in public methods!')
             raise ValueError('Cannot reindex an excluded attribute')
         
+        issorted = attrib in self._sorted
+        strings = self._strings.get(attrib)
         valueL = _makelist(value)
+        if self._bitmaps is not None:
+            self._clear_bitmaps(attrib,valueL or [self._empty])
+        self._touched(attrib)
         for val in valueL:
-            self._lookup[attrib][val].append(ix)
+            ixs = self._lookup[attrib][val]
+            if not ixs: # New value
+                if issorted:
+                    self._sorted_insert(attrib,val)
+                if strings is not None:
+                    strings.add(val)
+            ixs.add(ix)
+        if len(valueL) == 0:
+            self._lookup[attrib][self._empty].add(ix) # empty list
+        
+        if attrib not in self._counts:
+            self._counts[attrib] = 0
+            self._attributes = None
+        self._counts[attrib] += 1
+    
+    def _remove(self,attrib,value,ix):
+        """
+        Remove from the lookup and update the modify time
+        """
+        issorted = attrib in self._sorted
+        strings = self._strings.get(attrib)
+        valueL = _makelist(value)
         if len(valueL) == 0:
-            self._lookup[attrib][self._empty].append(ix) # empty list
+            valueL = [self._empty] # empty list
+        elif len(valueL) > 1:
+            valueL = set(valueL) # Repeated values were only added once
+        if self._bitmaps is not None:
+            self._clear_bitmaps(attrib,valueL)
+        self._touched(attrib)
+        lookup = self._lookup.get(attrib,{})
+        for val in valueL:
+            ixs = lookup.get(val,())
+            if ix not in ixs:
+                raise ValueError('Item not found in internal lookup. May need to first call reindex()')
+            ixs.remove(ix)
+            if not ixs: # Last one. Remove so that len(lookup) is the cardinality
+                del lookup[val]
+                if issorted and val is not self._empty:
+                    self._sorted_remove(attrib,val)
+                if strings is not None:
+                    strings.remove(val)
+        
+        self._counts[attrib] -= 1
+        if not self._counts[attrib]:
+            del self._counts[attrib]
+            self._attributes = None
+    
+    def _sorted_insert(self,attrib,val):
+        """
+        Add a new unique value to the sorted index of attrib. It is only
+        merged in by the next range query. See _sorted_merge
+        """
+        self._sorted_new.setdefault(attrib,set()).add(val)
+
+    def _sorted_insert_many(self,attrib,vals):
+        """
+        Add many new unique values to the sorted index. Much faster than
+        bisect.insort for each since sort() will merge the sorted runs
+        """
+        families = defaultdict(list)
+        for val in vals:
+            families[_sort_family(val)].append(val)
+        for family,fvals in families.items():
+            keys = self._sorted[attrib].get(family,[])
+            try:
+                keys = sorted(keys + fvals)
+            except TypeError: # Not all orderable. Do them one-by-one
+                keys = list(keys)
+                for val in fvals:
+                    try:
+                        bisect.insort(keys,val)
+                    except TypeError: # Not orderable. Do not range-index it
+                        pass
+            self._sorted[attrib][family] = keys # Replaced for any readers
+    
+    def _sorted_merge(self,attrib):
+        """
+        Merge the new keys of attrib into its sorted index. O(V + P log P) 
+        for P new of V values. Readers may be concurrent so it is locked
+        """
+        if self._sorted_new.get(attrib):
+            with self._cache_lock:
+                vals = self._sorted_new.pop(attrib,None)
+                if vals:
+                    self._sorted_insert_many(attrib,vals)
+    
+    def _sorted_remove(self,attrib,val):
+        """Remove a value that no longer has any items from the sorted index"""
+        new = self._sorted_new.get(attrib)
+        if new and val in new: # Never merged in
+            new.discard(val)
+            return
+        keys = self._sorted[attrib].get(_sort_family(val),[])
+        try:
+            i = bisect.bisect_left(keys,val)
+        except TypeError:
+            return
+        if i < len(keys) and keys[i] == val:
+            del keys[i]
+    
+    def _range_keys(self,attrib,low=_UNBOUNDED,high=_UNBOUNDED,
+                    low_inclusive=True,high_inclusive=True):
+        """
+        Return (keys,i,j) where keys[i:j] are the sorted values of attrib
+        within the range. Only values of the same family as the bounds are 
+        considered.
+        """
+        family = _sort_family(low if low is not _UNBOUNDED else high)
+        self._sorted_merge(attrib)
+        keys = self._sorted[attrib].get(family,[])
+        try:
+            if low is _UNBOUNDED:
+                i = 0
+            elif low_inclusive:
+                i = bisect.bisect_left(keys,low)
+            else:
+                i = bisect.bisect_right(keys,low)
+            if high is _UNBOUNDED:
+                j = len(keys)
+            elif high_inclusive:
+                j = bisect.bisect_right(keys,high)
+            else:
+                j = bisect.bisect_left(keys,high)
+        except TypeError: # e.g. comparing two different non-number types
+            return keys,0,0
+        return keys,i,max(i,j)
+    
+    def _range(self,attrib,low=_UNBOUNDED,high=_UNBOUNDED,
+               low_inclusive=True,high_inclusive=True):
+        """
+        Return the set of indices where attrib is within the range using
+        the sorted index. See _range_keys
+        """
+        keys,i,j = self._range_keys(attrib,low,high,low_inclusive,high_inclusive)
+        lookup = self._lookup[attrib]
+        ixs = set()
+        for val in keys[i:j]:
+            ixs.update(lookup[val])
+        return self._rowset(ixs)
+    
+    def _match_strings(self,op,attrib,sub):
+        """
+        Return the set of indices where attrib is a string that starts with
+        (op='startswith') or contains sub. Uses the string index if there is
+        one. Otherwise, each unique value is checked
+        """
+        lookup = self._lookup.get(attrib,{})
+        index = self._strings.get(attrib)
+        if index is not None:
+            vals = index.startswith(sub) if op == 'startswith' else index.contains(sub)
+        elif op == 'startswith':
+            vals = [val for val in lookup if isinstance(val,str) and val.startswith(sub)]
+        else:
+            vals = [val for val in lookup if isinstance(val,str) and sub in val]
+        ixs = set()
+        for val in vals:
+            ixs.update(lookup[val])
+        return self._rowset(ixs)
+    
+    def _rowset(self,ixs=()):
+        """
+        Return a new set of item indices in the representation used for
+        queries: a set or, if using bitmaps and there are enough of them 
+        (see _dense()), a _Bitmap
+        """
+        if self._bitmaps is None:
+            return set(ixs)
+        if not isinstance(ixs,(set,frozenset,list,tuple,range,_Bitmap)):
+            ixs = list(ixs)
+        if isinstance(ixs,_Bitmap) or self._dense(len(ixs)):
+            return _Bitmap(ixs)
+        return set(ixs)
+    
+    def _dense(self,n):
+        """
+        Whether n items are enough for a bitmap (which takes one bit for 
+        every item) to be smaller and faster than a set
+        """
+        return n*_BITMAP_DENSITY >= len(self._list)
+    
+    def _posting(self,attrib,val,bitmap=True):
+        """
+        Return the set of items where attrib has val in the representation
+        used for queries. With bitmap=False, it is always a set (e.g. to 
+        intersect with a small set). Do *NOT* modify it in place
+        """
+        ixs = self._lookup.get(attrib,{}).get(val)
+        if not ixs:
+            return _EMPTYSET
+        if self._bitmaps is None or not bitmap or not self._dense(len(ixs)):
+            return ixs
+        
+        key = (attrib,val)
+        with self._cache_lock:
+            entry = self._bitmaps.pop(key,None)
+            if entry is not None:
+                self._bitmaps[key] = entry # Most recently used
+                return entry[0]
+        bitmap = _Bitmap(ixs)
+        size = _sizeof(bitmap)
+        with self._cache_lock:
+            entry = self._bitmaps.pop(key,None) # In case another read added it
+            if entry is not None:
+                self._bitmaps_memory -= entry[1]
+            self._bitmaps[key] = (bitmap,size)
+            self._bitmaps_memory += size
+            while self._bitmaps_memory > _BITMAP_CACHE_MEMORY and len(self._bitmaps) > 1:
+                _,(_,size) = self._bitmaps.popitem(last=False)
+                self._bitmaps_memory -= size
+        return bitmap
+    
+    def _attr_rows(self,attrib):
+        """
+        Return the set of items that have attrib. Do *NOT* modify it in place
+        """
+        if self._bitmaps is not None and attrib in self._attr_bitmaps:
+            return self._attr_bitmaps[attrib]
+        
+        ixs = set()
+        for vals in self._lookup.get(attrib,{}).values():
+            ixs.update(vals)
+        ixs = self._rowset(ixs)
+        if self._bitmaps is not None and ixs:
+            self._attr_bitmaps[attrib] = ixs
+        return ixs
+    
+    def _clear_bitmaps(self,attrib=None,vals=None):
+        """
+        Invalidate the cached bitmaps of attrib (or all) for vals (or all)
+        """
+        if self._bitmaps is None:
+            return
+        with self._cache_lock:
+            if attrib is None:
+                self._bitmaps.clear()
+                self._bitmaps_memory = 0
+                self._attr_bitmaps.clear()
+                return
+            self._attr_bitmaps.pop(attrib,None)
+            if vals is None:
+                keys = [key for key in self._bitmaps if key[0] == attrib]
+            else:
+                keys = [(attrib,val) for val in vals]
+            for key in keys:
+                entry = self._bitmaps.pop(key,None)
+                if entry is not None:
+                    self._bitmaps_memory -= entry[1]
+    
+    def __contains__(self,check_diff):
+        if not ( isinstance(check_diff,dict) or isinstance(check_diff,Query)):
+            raise ValueError('Python `in` queries should be a of {attribute:value} or Query')
+        return self.isin(check_diff)
+
+    def __len__(self):
+        return self.N
+
+    @_reads
+    def __getitem__(self,item):
+        if isinstance(item,dict) or isinstance(item,Query):
+            return self.query_one(item)
+        elif isinstance(item,int): # numbered item
+            if self._list[item] is not None:
+                return self._list[item]
+            else:
+                raise ValueError("Index has been deleted")
+        else:
+            raise ValueError("Must specify DB[{'attribute':val}] or DB[index]'")
+    __call__ = query
+    __delitem__ = remove
+    
+    def __iter__(self):
+        if self._lock is None:
+            return self._iter_items()
+        with self._lock.read():
+            return iter([item for item in self._list if item is not None])
+    
+    def _iter_items(self):
+        with self._iterating(): # So the list is not replaced by a vacuum
+            for item in self._list:
+                if item is not None: # May have been removed while iterating
+                    yield item
+    
+    def items(self,dicts=False):
+        """
+        Iterate the items. If dicts, compact rows (see compact_rows) are
+        returned as dicts (e.g. for json.dumps)
+        """
+        if dicts:
+            return (_as_dict(item) for item in self)
+        return iter(self)
+    
+    @property
+    @_reads
+    def attributes(self):
+        # The attributes are kept in the catalog by _append and _remove. The
+        # sorted list is cached until an attribute is added or removed
+        if self.fixed_attributes:
+            return self.fixed_attributes
+        
+        if self._attributes is None:
+            self._attributes = sorted(self._counts)
+        return self._attributes
+    
+    @_reads
+    def cardinality(self,attrib):
+        """
+        Return the number of unique values of attrib. An empty list counts
+        as a value. O(1)
+        """
+        return len(self._lookup.get(attrib,()))
+    
+    @_reads
+    def density(self,attrib):
+        """
+        Return the fraction of items that have attrib indexed. O(1)
+        """
+        if not self.N:
+            return 0.0
+        return self._counts.get(attrib,0) / float(self.N)
+
+    @_reads
+    def distinct(self,attrib,*args,**kwargs):
+        """
+        Return a list of the unique values of attrib of the items that match
+        the query (or all items). See query() for usage. Values in lists
+        are each included.
+
+        Answered from the index (see value_counts())
+        """
+        return list(self.value_counts(attrib,*args,**kwargs))
+
+    @_reads
+    def value_counts(self,attrib,*args,**kwargs):
+        """
+        Return {value:count} of the number of items that match the query
+        (or all items) with each value of attrib. See query() for usage.
+
+            >>> DB.value_counts('role',born=1943)
+
+        An item with a list is counted for each of its values. Items without
+        attrib (or with an empty list) are not counted.
+
+        Answered from the index rather than the items. Without a query, this
+        is the length of each posting list. With one, the posting lists are
+        intersected with the matching items (or, if fewer items match than
+        there are values, only the matching items are read).
+        """
+        node = self._query_node(*args,**kwargs)
+        if node == _ALL:
+            self._check_indexed(attrib)
+            return {val:len(ixs) for val,ixs in self._lookup.get(attrib,{}).items()
+                    if ixs and not isinstance(val,_emptyList)}
+        return {val:len(ixs) for val,ixs in self._groups(attrib,node).items()}
+
+    @_reads
+    def group_by(self,attrib,*args,**kwargs):
+        """
+        Return {value:[items]} of the items that match the query (or all
+        items) grouped by their value of attrib. See value_counts() for
+        how they are found.
+        """
+        groups = self._groups(attrib,self._query_node(*args,**kwargs))
+        return {val:[self._list[ix] for ix in sorted(ixs)] for val,ixs in groups.items()}
+
+    @_reads
+    def aggregate(self,attrib,func,*args,of=None,**kwargs):
+        """
+        Return {value:result} of func ('count', 'sum', 'min', or 'max') of
+        the values of the `of` attribute of the items that match the query
+        (or all items) for each value of attrib. See value_counts()
+
+            >>> DB.aggregate('role','min',of='born')
+            >>> DB.aggregate('role','count',DB.Q.born > 1941)
+
+        'count' without `of` is the number of items (like value_counts())
+        and with it, the number that have `of`. An item with a list of
+        values of `of` includes each unique value. min and max are None for
+        groups without any values.
+
+        If `of` has few unique values, the results are found by intersecting
+        their posting lists with each group. Otherwise, the values are read
+        from the items in the groups.
+        """
+        if func not in ('count','sum','min','max'):
+            raise ValueError("func must be 'count', 'sum', 'min', or 'max'")
+        if of is None and func != 'count':
+            raise ValueError("Must specify `of` for '{}'".format(func))
+
+        groups = self._groups(attrib,self._query_node(*args,**kwargs))
+        if of is None:
+            return {val:len(ixs) for val,ixs in groups.items()}
+        self._check_indexed(of)
+        if func == 'count':
+            rows = self._attr_rows(of)
+            return {val:len(ixs & rows) for val,ixs in groups.items()}
+
+        # Find the (value,count) of `of` for each group
+        lookup = self._lookup.get(of,{})
+        values = {val:[] for val in groups}
+        if len(lookup) * len(groups) <= sum(len(ixs) for ixs in groups.values()):
+            for ofval in lookup:
+                if isinstance(ofval,_emptyList):
+                    continue
+                posting = self._posting(of,ofval)
+                for val,ixs in groups.items():
+                    n = len(posting & ixs)
+                    if n:
+                        values[val].append((ofval,n))
+        else:
+            for val,ixs in groups.items():
+                counts = defaultdict(int)
+                for ix in ixs:
+                    item = self._list[ix]
+                    if of in item:
+                        for ofval in set(_makelist(item[of])):
+                            counts[ofval] += 1
+                values[val] = list(counts.items())
+
+        if func == 'sum':
+            return {val:sum(ofval*n for ofval,n in vals) for val,vals in values.items()}
+        agg = min if func == 'min' else max
+        return {val:agg(ofval for ofval,_ in vals) if vals else None
+                for val,vals in values.items()}
+
+    def _groups(self,attrib,node):
+        """
+        Return {value:ixs} of the (non-empty) set of items matching the
+        query node for each value of attrib. Do *NOT* modify them in place
+        """
+        self._check_indexed(attrib)
+        lookup = self._lookup.get(attrib,{})
+        if node == _ALL:
+            return {val:self._posting(attrib,val) for val in lookup
+                    if not isinstance(val,_emptyList)}
+
+        ixs = self._node_ixs(node)
+        if not ixs:
+            return {}
+        if len(ixs) < len(lookup): # Cheaper to read the values of the items
+            groups = defaultdict(list)
+            for ix in ixs:
+                item = self._list[ix]
+                if attrib in item:
+                    for val in set(_makelist(item[attrib])):
+                        groups[val].append(ix)
+            return {val:self._rowset(group) for val,group in groups.items()}
+
+        groups = {}
+        for val in lookup:
+            if isinstance(val,_emptyList):
+                continue
+            group = self._posting(attrib,val) & ixs
+            if group:
+                groups[val] = group
+        return groups
+
+    def _node_ixs(self,node):
+        """
+        Return the (possibly cached) set of items matching a query node. Do 
+        *NOT* modify it in place
+        """
+        if not self.N:
+            return self._rowset()
+        ixs = self._cached(node)
+        if ixs is None:
+            ixs = self._evaluate(node)
+        return ixs
+
+    def _is_indexed(self,attrib):
+        """Whether attrib is (or will be when added) indexed"""
+        if attrib in self.exclude_attributes:
+            return False
+        return not self.fixed_attributes or attrib in self.fixed_attributes
+    
+    def _check_indexed(self,attrib):
+        """Raise an error if attrib is not (or can not be) indexed"""
+        if attrib in self.exclude_attributes:
+            raise ExcludedAttributeError("'{}' is excludes".format(attrib))
+        if self.fixed_attributes and attrib not in self.fixed_attributes:
+            raise ValueError("'{}' is not an indexed attribute".format(attrib))
+
+class MappedDictTable(DictTable):
+    """
+    MappedDictTable:
+    A read-only DictTable backed by a memory-mapped file written with
+    DB.save_mapped(path). 
+    
+    The posting lists of the index are read directly from the file and 
+    the items are only decoded when they are returned (or checked by a 
+    filter or unsorted range). Since it is mapped, multiple processes can 
+    share one copy through the page cache.
+    
+    The directory of every attribute and unique value (with the counts and
+    sorted keys) *is* loaded into memory when it is opened. That is O(V) 
+    Python objects for V unique values so an attribute with a unique value
+    for every item is O(N) like a DictTable (but still without the items
+    or posting lists).
+    
+    The directory and the items are read with pickle so, as with load(),
+    only open files you trust.
+    
+    All queries, count(), isin(), etc work as with a DictTable. Methods 
+    that change the DB raise a ValueError. Use copy() to get a (regular) 
+    DictTable.
+    
+    Inputs:
+    -------
+    path
+        File written by DB.save_mapped(path)
+    
+    bitmaps [False]
+        Represent query results as bitmaps. See DictTable
+    
+    cache_size [0]
+        Cache the results of this many queries. See DictTable
+    """
+    def __init__(self,path,bitmaps=False,cache_size=0):
+        self._lock = None
+        self._cache_lock = threading.Lock()
+        self._iterators = 0
+        self._id = str(uuid.uuid4())
+        self._c = 0
+        self._versions = {}
+        self._vacuumed = 0
+        self._journal = None
+        self.workers = None
+        self._generation = 0
+        self._schemas = None
+        self._interned = None
+        self._numeric = []
+        self._columns = {}
+        self._strings = {}
+        self._composites = {}
+        self.primary_key = None
+        self._pk = {}
+        
+        self._file = open(path,'rb')
+        self._mmap = mmap.mmap(self._file.fileno(),0,access=mmap.ACCESS_READ)
+        if self._mmap[:len(_MAPPED_MAGIC)] != _MAPPED_MAGIC:
+            self.close()
+            raise ValueError('Not a mapped DictTable: {}'.format(path))
+        dir_offset,dir_length = _MAPPED_HEADER.unpack_from(self._mmap,len(_MAPPED_MAGIC))
+        directory = pickle.loads(self._mmap[dir_offset:dir_offset + dir_length])
+        if directory['byteorder'] != sys.byteorder:
+            self.close()
+            raise ValueError('Mapped DictTable was saved with a different byte order')
+        
+        self.N = directory['N']
+        self.fixed_attributes = directory['fixed_attributes']
+        self.exclude_attributes = directory['exclude_attributes']
+        self.vacuum_threshold = None
+        self._counts = directory['counts']
+        self._attributes = None
+        self._sorted = directory['sorted']
+        self._sorted_new = {}
+        self._empty = _emptyList()
+        
+        view = memoryview(self._mmap)
+        rows_offset = directory['rows_offset']
+        postings_offset = directory['postings_offset']
+        self._views = [view[rows_offset:postings_offset].cast('q'),
+                       view[postings_offset:dir_offset].cast('q')]
+        view.release()
+        self._list = _MappedRows(self._mmap,self._views[0])
+        self._lookup = dict((attrib,_MappedPostings(amap,self._views[1])) 
+                            for attrib,amap in directory['lookup'].items())
+        
+        self._bitmaps = OrderedDict() if bitmaps else None
+        self._bitmaps_memory = 0
+        self._attr_bitmaps = {}
+        self._allrows = None
+        
+        self._cache = OrderedDict() if cache_size else None
+        self._cache_deps = defaultdict(set)
+        self._cache_size = cache_size
+        self._cache_stats = dict.fromkeys(['hits','misses','evictions',
+                                           'invalidations','memory'],0)
+    
+    @property
+    def _ix(self):
+        # Only built if needed (e.g. ~ and !=) since it is O(N) memory
+        if self._allrows is None:
+            self._allrows = self._rowset(range(self.N))
+        return self._allrows
+    
+    def _posting(self,attrib,val,bitmap=True):
+        """
+        Return the set of items where attrib has val in the representation
+        used for queries. These are read from the file
+        """
+        ixs = self._lookup.get(attrib,{}).get(val)
+        if not ixs:
+            return _EMPTYSET
+        if self._bitmaps is None or not bitmap or not self._dense(len(ixs)):
+            return set(ixs)
+        return DictTable._posting(self,attrib,val) # Caches the bitmap
+    
+    def _evaluate(self,node,within=None):
+        # The posting lists are sorted so if there are fewer items left
+        # than in the posting list, search it for each rather than reading
+        # all of it
+        if node[0] == 'eq' and within is not None:
+            ixs = self._lookup.get(node[1],{}).get(node[2])
+            if not ixs:
+                return self._rowset()
+            if len(within) < len(ixs):
+                return self._rowset(ix for ix in within if _sorted_contains(ixs,ix))
+        return DictTable._evaluate(self,node,within)
+    
+    def close(self):
+        """Close the file. The MappedDictTable can not be used after"""
+        self._lookup = {}
+        self._list = []
+        for view in self._views if hasattr(self,'_views') else []:
+            view.release()
+        self._mmap.close()
+        self._file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self,*args):
+        self.close()
+    
+    def _read_only(self,*args,**kwargs):
+        raise ValueError('MappedDictTable is read-only')
+    add = update = remove = pop = reindex = vacuum = _read_only
+    add_fixed_attribute = add_sorted_attribute = __delitem__ = _read_only
+    add_string_attribute = create_index = upsert = _read_only
+    aadd = areindex = _read_only
+    
+    def save(self,path):
+        """Save as a (regular) DictTable. See DictTable.save()"""
+        self.copy().save(path)
+    
+    def copy(self):
+        """Return an in-memory DictTable of all items"""
+        return DictTable(self,
+                         exclude_attributes=copy.copy(self.exclude_attributes),
+                         fixed_attributes=copy.copy(self.fixed_attributes),
+                         sorted_attributes=list(self._sorted),
+                         bitmaps=self._bitmaps is not None,
+                         cache_size=self._cache_size)
+    __copy__ = copy
+
+class _MappedRows(object):
+    """
+    Sequence of the items of a MappedDictTable. Each item is decoded from
+    the file when it is accessed
+    """
+    def __init__(self,buf,offsets):
+        self._buf = buf
+        self._offsets = offsets
+    
+    def __len__(self):
+        return len(self._offsets) - 1
+    
+    def __getitem__(self,ix):
+        if ix < 0:
+            ix += len(self)
+        if not 0 <= ix < len(self):
+            raise IndexError('item index out of range')
+        return pickle.loads(self._buf[self._offsets[ix]:self._offsets[ix+1]])
+    
+    def __iter__(self):
+        for ix in range(len(self)):
+            yield self[ix]
+
+class _MappedPostings(Mapping):
+    """
+    {val:posting} of an attribute for a MappedDictTable where the posting
+    is a (memoryview) slice of the int64 posting lists in the file.
+    """
+    def __init__(self,directory,ints):
+        self._directory = directory # {val:(start,count)}
+        self._ints = ints
+    
+    def __getitem__(self,val):
+        start,count = self._directory[val]
+        return self._ints[start:start + count]
+    
+    def __contains__(self,val):
+        return val in self._directory
+    
+    def __len__(self):
+        return len(self._directory)
+    
+    def __iter__(self):
+        return iter(self._directory)
+
+def join(left,right,on,how='inner',left_query=None,right_query=None,merge=True):
+    """
+    Join the items of two DictTables where they have the same value of on.
+    Returns an iterator of the merged items (a new dict of the left item 
+    updated with the right item) or, if merge=False, (left,right) pairs.
+    
+        >>> for item in join(hosts,alerts,on='hostname'):
+    
+    Inputs:
+    -------
+    how ['inner'] ('inner','left')
+        'inner' only includes items with a match. 'left' also includes 
+        every left item without one (as a copy or paired with None)
+    
+    left_query,right_query [None] (dict, Query)
+        Only join the items of that side that match. See DictTable.query()
+    
+    The values of on are taken from the index of the side with fewer of 
+    them (or of the items that match its query) and the matching items of
+    the other side are looked up directly in its index. An item with a 
+    list is joined on each of its values (but each pair of items is only 
+    returned once). Items without on (or with an empty list) do not match
+    anything.
+    
+    Like query(), the matches are found as they are iterated. If either
+    DictTable is concurrent, they are all found before it returns.
+    """
+    if how not in ('inner','left'):
+        raise ValueError("how must be 'inner' or 'left'")
+    for DB in (left,right):
+        if not isinstance(DB,DictTable):
+            raise ValueError('Can only join DictTables')
+        DB._check_indexed(on)
+    
+    results = _join(left,right,on,how,left_query,right_query,merge)
+    locks = [DB._lock for DB in (left,right) if DB._lock is not None]
+    if not locks:
+        return results
+    with contextlib.ExitStack() as stack:
+        for lock in locks:
+            stack.enter_context(lock.read())
+        return iter(list(results))
+
+def _join(left,right,on,how,left_query,right_query,merge):
+    lrows = _join_rows(left,left_query)
+    rrows = _join_rows(right,right_query)
+    def result(litem,ritem):
+        if not merge:
+            return litem,ritem
+        item = dict(litem)
+        if ritem is not None:
+            item.update(ritem)
+        return item
+    
+    # Items that both have lists of values are found for each value they
+    # share. Only those pairs are remembered
+    seen = set()
+    def pairs(lixs,rixs):
+        for lix in lixs:
+            litem = left._list[lix]
+            several = _several_values(litem,on)
+            for rix in rixs:
+                ritem = right._list[rix]
+                if several and _several_values(ritem,on):
+                    if (lix,rix) in seen:
+                        continue
+                    seen.add((lix,rix))
+                yield lix,litem,ritem
+    
+    if how == 'inner' and _join_size(right,on,rrows) < _join_size(left,on,lrows):
+        for val in _join_values(right,on,rrows):
+            rixs = _join_posting(right,on,val,rrows)
+            lixs = _join_posting(left,on,val,lrows) if rixs else ()
+            for _,litem,ritem in pairs(lixs,rixs):
+                yield result(litem,ritem)
+        return
+    
+    matched = set()
+    for val in _join_values(left,on,lrows):
+        lixs = _join_posting(left,on,val,lrows)
+        rixs = _join_posting(right,on,val,rrows) if lixs else ()
+        for lix,litem,ritem in pairs(lixs if rixs else (),rixs):
+            if how == 'left':
+                matched.add(lix)
+            yield result(litem,ritem)
+    
+    if how == 'left':
+        for lix,item in enumerate(left._list):
+            if item is None or lix in matched or (lrows is not None and lix not in lrows):
+                continue
+            yield result(item,None)
+
+def _several_values(item,on):
+    value = item.get(on)
+    return isinstance(value,list) and len(value) > 1
+
+def _join_rows(DB,query):
+    """The set of items of DB matching query or None for all of them"""
+    if query is None:
+        return None
+    node = DB._query_node(query)
+    if node == _ALL:
+        return None
+    return DB._node_ixs(node)
+
+def _join_size(DB,on,rows):
+    """The number of values of on that _join_values() will return at most"""
+    size = len(DB._lookup.get(on,{}))
+    return size if rows is None else min(size,len(rows))
+
+def _join_values(DB,on,rows):
+    """
+    Return a list of the values of on of the items in rows (or all) from 
+    the index or, if there are fewer items than values, from the items
+    """
+    lookup = DB._lookup.get(on,{})
+    if rows is None or len(rows) >= len(lookup):
+        return [val for val in lookup if not isinstance(val,_emptyList)]
+    values = OrderedDict()
+    for ix in sorted(rows):
+        item = DB._list[ix]
+        if on in item:
+            for val in _makelist(item[on]):
+                values[val] = None
+    return list(values)
+
+def _join_posting(DB,on,val,rows):
+    """The sorted indices of the items in rows (or all) where on has val"""
+    ixs = DB._lookup.get(on,{}).get(val)
+    if not ixs:
+        return ()
+    if rows is not None:
+        ixs = [ix for ix in ixs if ix in rows]
+    return sorted(ixs)
+
+class ShardedDictTable(object):
+    """
+    A table of items partitioned across shards (DictTables) by the value of
+    shard_key. Each shard has its own (smaller) list and index so they can
+    be built, reindexed, and scanned separately.
+    
+    Equality queries on shard_key only go to the one shard that can have
+    matches. Everything else is run on all of the shards (in a pool of 
+    threads) and the results are combined. Items are in no particular order
+    across shards.
+    
+    Inputs:
+    -------
+    shard_key (str)
+        Attribute used to pick the shard of each item. Every item must have
+        it and it can not be a list. Updating it moves the item to its new
+        shard.
+    
+    items [None]
+        Items to add
+    
+    shards [4] (int)
+        Number of shards
+    
+    threads [None] (int)
+        Number of threads to query the shards with. Defaults to the number
+        of shards. Set to 0 or 1 to query them one at a time. Note that, 
+        with the GIL, this only helps for work that releases it (e.g. NumPy)
+    
+    Any other keyword arguments (e.g. sorted_attributes, cache_size, 
+    concurrent) are used for each shard. See DictTable. A primary_key is
+    unique across all of the shards. DB.workers is not used while the shards
+    are reindexed or vacuumed in the threads
+    
+    Queries, count, update, remove, pop, etc. are as with a DictTable except
+    that '_index' queries are not supported. The shards are in DB.shards but
+    must not be changed directly.
+    """
+    def __init__(self,shard_key,items=None,shards=4,threads=None,**kwargs):
+        if shards < 1:
+            raise ValueError('Must have at least one shard')
+        self.shard_key = shard_key
+        self.threads = shards if threads is None else threads
+        self._nshards = shards
+        self._pool = None
         
+        # Query objects are made and checked exactly as with a DictTable. 
+        # _index is not supported so nothing is ever vacuumed
+        self._id = str(uuid.uuid4()) 
+        self._c = 0
+        self._versions = {}
+        self._vacuumed = 0
+        self._lock = None
+        self._empty = _emptyList()
+        
+        self.primary_key = kwargs.get('primary_key')
+        self.shards = []
+        groups = self._group(items or [])
+        self._check_keys(itertools.chain.from_iterable(groups))
+        self.shards = [DictTable(group,**kwargs) for group in groups]
+    
+    # The same as for a DictTable
+    _query_node = DictTable.__dict__['_query_node']
+    _changed_since = DictTable.__dict__['_changed_since']
+    Query = DictTable.__dict__['Query']
+    Q = Query
+    
+    def _touched(self,*deps):
+        """Record that deps (attributes and/or _ROWS) changed"""
         self._c += 1
+        for dep in deps:
+            self._versions[dep] = self._c
+    
+    def _shard_ix(self,value):
+        """The index of the shard for items with this shard_key value"""
+        if isinstance(value,list):
+            raise ValueError('The shard key can not be a list')
+        return _stable_hash(value) % self._nshards
+    
+    def _group(self,items):
+        """Split items into a list for each shard"""
+        if isinstance(items,dict) or isinstance(items,_Record):
+            items = [items]
+        groups = [[] for _ in range(self._nshards)]
+        key = self.shard_key
+        for item in _flatten_items(items):
+            try:
+                value = item[key]
+            except KeyError:
+                raise ValueError('Items must have the shard key {!r}'.format(key))
+            groups[self._shard_ix(value)].append(item)
+        return groups
+    
+    def _route(self,node):
+        """The set of shard indices that node can match or None for all"""
+        op = node[0]
+        if op == 'eq' and node[1] == self.shard_key:
+            return {self._shard_ix(node[2])}
+        if op == 'and':
+            routes = [route for route in map(self._route,node[1]) if route is not None]
+            return set.intersection(*routes) if routes else None
+        if op == 'or':
+            routes = [self._route(child) for child in node[1]]
+            if any(route is None for route in routes):
+                return None
+            return set().union(*routes)
+        return None
+    
+    def _node(self,*args,**kwargs):
+        """Return the query node and the shards it needs to run on"""
+        node = self._query_node(*args,**kwargs)
+        if _uses_index(node):
+            raise ValueError("'_index' queries are not supported by ShardedDictTable")
+        route = self._route(node)
+        if route is None:
+            return node,self.shards
+        return node,[self.shards[ix] for ix in sorted(route)]
+    
+    def _map(self,func,shards):
+        """Return [func(shard) for shard in shards] in the thread pool"""
+        if len(shards) < 2 or self.threads < 2:
+            return [func(shard) for shard in shards]
+        if self._pool is None:
+            from multiprocessing.pool import ThreadPool
+            self._pool = ThreadPool(self.threads)
+        return self._pool.map(func,shards)
+    
+    def _check_keys(self,items):
+        """
+        Raise an error if any of items do not have a primary_key or it is 
+        not unique in all of the shards. Each shard only checks its own
+        """
+        if self.primary_key is None:
+            return
+        seen = set()
+        for item in items:
+            key = _check_key(item,self.primary_key)
+            if key in seen or any(key in shard._pk for shard in self.shards):
+                raise DuplicateKeyError('Duplicate primary key {!r}'.format(key))
+            seen.add(key)
+    
+    def add(self,item):
+        """Add an item or items. See DictTable.add()"""
+        attribs = set()
+        groups = self._group(item)
+        self._check_keys(itertools.chain.from_iterable(groups))
+        for shard,group in zip(self.shards,groups):
+            if group:
+                shard.add(group)
+                for item in group:
+                    attribs.update(item)
+        self._touched(_ROWS,*attribs)
+    
+    def query(self,*args,**kwargs):
+        """
+        Query the items. See DictTable.query(). If the query is run on more 
+        than one shard, the results are found before it returns
+        """
+        node,shards = self._node(*args,**kwargs)
+        if len(shards) == 1:
+            return shards[0].query(_shard_query(shards[0],node))
+        results = self._map(lambda shard: list(shard.query(_shard_query(shard,node))),
+                            shards)
+        return itertools.chain.from_iterable(results)
+    __call__ = query
+    
+    def query_one(self,*args,**kwargs):
+        """Return a single item from a query or None. See query()"""
+        node,shards = self._node(*args,**kwargs)
+        for shard in shards: # Stop at the first
+            item = shard.query_one(_shard_query(shard,node))
+            if item is not None:
+                return item
+        return None
+    
+    def count(self,*args,**kwargs):
+        """Return the number of items matching a query. See query()"""
+        node,shards = self._node(*args,**kwargs)
+        return sum(self._map(lambda shard: shard.count(_shard_query(shard,node)),
+                             shards))
+
+    def distinct(self,attrib,*args,**kwargs):
+        """Return a list of the unique values of attrib. See DictTable.distinct()"""
+        return list(self.value_counts(attrib,*args,**kwargs))
+
+    def value_counts(self,attrib,*args,**kwargs):
+        """Return {value:count} for attrib. See DictTable.value_counts()"""
+        node,shards = self._node(*args,**kwargs)
+        counts = defaultdict(int)
+        for result in self._map(lambda shard: shard.value_counts(attrib,_shard_query(shard,node)),
+                                shards):
+            for val,count in result.items():
+                counts[val] += count
+        return dict(counts)
+
+    def group_by(self,attrib,*args,**kwargs):
+        """Return {value:[items]} for attrib. See DictTable.group_by()"""
+        node,shards = self._node(*args,**kwargs)
+        groups = defaultdict(list)
+        for result in self._map(lambda shard: shard.group_by(attrib,_shard_query(shard,node)),
+                                shards):
+            for val,items in result.items():
+                groups[val].extend(items)
+        return dict(groups)
+
+    def aggregate(self,attrib,func,*args,of=None,**kwargs):
+        """
+        Return {value:result} of func of `of` for each value of attrib. See
+        DictTable.aggregate(). The results of each shard are combined
+        """
+        node,shards = self._node(*args,**kwargs)
+        results = self._map(lambda shard: shard.aggregate(attrib,func,_shard_query(shard,node),of=of),
+                            shards)
+        combined = {}
+        for result in results:
+            for val,res in result.items():
+                if val not in combined or combined[val] is None:
+                    combined[val] = res
+                elif res is None:
+                    continue
+                elif func in ('count','sum'):
+                    combined[val] += res
+                else:
+                    combined[val] = (min if func == 'min' else max)(combined[val],res)
+        return combined
+
+    def isin(self,*args,**kwargs):
+        """Check if any item matches a query. See query()"""
+        node,shards = self._node(*args,**kwargs)
+        return any(shard.isin(_shard_query(shard,node)) for shard in shards)
+    
+    def update(self,*args,**queryKWs):
+        """
+        Update the matching items. See DictTable.update(). If the shard_key
+        is updated, the items are moved to their new shard
+        """
+        if len(args) == 1:
+            updated_dict = args[0]
+            query = {}
+        elif len(args) == 2:
+            updated_dict,query = args
+        else:
+            raise ValueError('Incorrect number of inputs. See documentation')
+        
+        if not isinstance(updated_dict,dict):
+            raise ValueError('Must specify updated values as a dictionary')
+        if not isinstance(query,(Query,dict)):
+            raise ValueError('Unrecognized query {:s}. Must be a dict or Query'.format(type(query)))
+        node,shards = self._node(query,**queryKWs)
+        
+        if self.primary_key in updated_dict:
+            key = _check_key(updated_dict,self.primary_key)
+            items = [item for shard in shards for item in shard.query(_shard_query(shard,node))]
+            owners = [shard._list[shard._pk[key]] for shard in self.shards if key in shard._pk]
+            if len(items) > 1 or (items and owners and owners[0] is not items[0]):
+                raise DuplicateKeyError('Duplicate primary key {!r}'.format(key))
+        
+        if self.shard_key in updated_dict:
+            target = self.shards[self._shard_ix(updated_dict[self.shard_key])]
+            ixs = ()
+            if target in shards: # Before the moved items are added to it
+                ixs = tuple(target._ixs(_shard_query(target,node)))
+            
+            # Add the moved copies to target before removing them and update
+            # the items already in target last so that, if anything fails,
+            # it can all be undone
+            moves,moved = [],[]
+            for shard in shards:
+                if shard is target:
+                    continue
+                items = list(shard.query(_shard_query(shard,node)))
+                if items:
+                    moves.append((shard,items))
+                for item in items:
+                    item = dict(item) # Also for compact_rows
+                    item.update(updated_dict)
+                    moved.append(item)
+            ix0 = len(target._list)
+            if moved:
+                target.add(moved)
+            removed = []
+            try:
+                for shard,items in moves:
+                    shard.remove(_shard_query(shard,node))
+                    removed.append((shard,items))
+                if ixs:
+                    target.update(updated_dict,_index_query(target,ixs))
+            except BaseException:
+                if moved:
+                    target.remove(_index_query(target,range(ix0,ix0 + len(moved))))
+                for shard,items in removed:
+                    shard.add(items)
+                raise
+            updated = [bool(moved or ixs)]
+        else:
+            def update(shard):
+                Q = _shard_query(shard,node)
+                if not shard.isin(Q):
+                    return False
+                shard.update(updated_dict,Q)
+                return True
+            updated = self._map(update,shards)
+        
+        if not any(updated):
+            raise ValueError('Query did not match any results')
+        self._touched(*updated_dict)
+    
+    def remove(self,*args,**kwargs):
+        """Remove the items matching a query. See query()"""
+        node,shards = self._node(*args,**kwargs)
+        attribs = self.attributes
+        def remove(shard):
+            Q = _shard_query(shard,node)
+            if not shard.isin(Q):
+                return False
+            shard.remove(Q)
+            return True
+        if not any(self._map(remove,shards)):
+            raise ValueError('No matching items')
+        self._touched(_ROWS,*attribs)
+    __delitem__ = remove
+    
+    def pop(self,*args,**kwargs):
+        """
+        Query, delete, and return item. Raises a KeyError if nothing matches
+        and a ValueError if more than one item does. See DictTable.pop()
+        """
+        node,shards = self._node(*args,**kwargs)
+        counts = self._map(lambda shard: shard.count(_shard_query(shard,node)),shards)
+        if sum(counts) == 0:
+            raise KeyError('No matching query')
+        if sum(counts) > 1:
+            raise ValueError('Cannot `.pop()` more than one item`')
+        shard = shards[counts.index(1)]
+        item = shard.pop(_shard_query(shard,node))
+        self._touched(_ROWS,*item)
+        return item
+    
+    def _map_shards(self,func):
+        """
+        _map() func over all of the shards. If it is in threads, the shards'
+        workers are not used since forking them from the threads can hang
+        """
+        if len(self.shards) < 2 or self.threads < 2:
+            return [func(shard) for shard in self.shards]
+        def run(shard):
+            workers,shard.workers = shard.workers,None
+            try:
+                return func(shard)
+            finally:
+                shard.workers = workers
+        return self._map(run,self.shards)
+    
+    def reindex(self,*attributes):
+        """Reindex all shards. See DictTable.reindex()"""
+        deps = attributes or self.attributes
+        self._map_shards(lambda shard: shard.reindex(*attributes))
+        self._touched(*deps)
+    
+    def vacuum(self):
+        """Vacuum all shards. See DictTable.vacuum()"""
+        self._map_shards(lambda shard: shard.vacuum())
+    
+    def close(self):
+        """Stop the threads (if any). They are started again if needed"""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self,*args):
+        self.close()
+    
+    def __contains__(self,check_diff):
+        if not ( isinstance(check_diff,dict) or isinstance(check_diff,Query)):
+            raise ValueError('Python `in` queries should be a of {attribute:value} or Query')
+        return self.isin(check_diff)
+    
+    def __getitem__(self,item):
+        if isinstance(item,dict) or isinstance(item,Query):
+            return self.query_one(item)
+        raise ValueError("Must specify DB[{'attribute':val}]")
+    
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+    
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.shards)
+    items = __iter__
+    
+    @property
+    def N(self):
+        return len(self)
+    
+    @property
+    def attributes(self):
+        attribs = set()
+        for shard in self.shards:
+            attribs.update(shard.attributes)
+        return sorted(attribs)
+
+def _shard_query(shard,node):
+    """A Query of shard (a DictTable) for node"""
+    Q = shard.Query
+    Q._node = node
+    return Q
+
+def _index_query(shard,ixs):
+    """A Query of shard (a DictTable) for the items at ixs"""
+    return _shard_query(shard,('index',tuple(ixs)))
+
+def _stable_hash(value):
+    """
+    Hash of value that is the same in every process (unlike str) and equal
+    for equal values (e.g. 1, 1.0, and True). Used to pick shards
+    """
+    if isinstance(value,str):
+        return zlib.crc32(value.encode('utf8'))
+    if isinstance(value,bytes):
+        return zlib.crc32(value)
+    if isinstance(value,tuple):
+        h = 0x345678
+        for val in value:
+            h = (h*1000003 ^ _stable_hash(val)) & 0xffffffffffffffff
+        return h
+    return hash(value) # Numbers are already. Anything else is for this process
+
+class _StringIndex(object):
+    """
+    Index of the unique string values of an attribute. See 
+    add_string_attribute(). The values are kept sorted so those with a 
+    prefix are together and each trigram has the set of values with it
+    """
+    def __init__(self,vals=()):
+        self.keys = []
+        self.grams = defaultdict(set)
+        self.add_many(vals)
+    
+    def add(self,val):
+        if isinstance(val,str):
+            bisect.insort(self.keys,val)
+            for gram in _trigrams(val):
+                self.grams[gram].add(val)
+    
+    def add_many(self,vals):
+        vals = [val for val in vals if isinstance(val,str)]
+        self.keys = sorted(self.keys + vals)
+        for val in vals:
+            for gram in _trigrams(val):
+                self.grams[gram].add(val)
+    
+    def remove(self,val):
+        if not isinstance(val,str):
+            return
+        i = bisect.bisect_left(self.keys,val)
+        if i < len(self.keys) and self.keys[i] == val:
+            del self.keys[i]
+        for gram in _trigrams(val):
+            vals = self.grams.get(gram)
+            if vals is not None:
+                vals.discard(val)
+                if not vals:
+                    del self.grams[gram]
+    
+    def startswith(self,prefix):
+        keys = self.keys
+        i = j = bisect.bisect_left(keys,prefix)
+        while j < len(keys) and keys[j].startswith(prefix):
+            j += 1
+        return keys[i:j]
+    
+    def contains(self,sub):
+        grams = _trigrams(sub)
+        if not grams: # Too short. Check them all
+            return [val for val in self.keys if sub in val]
+        candidates = [self.grams.get(gram) for gram in grams]
+        if not all(candidates): # A trigram that no value has
+            return []
+        candidates.sort(key=len)
+        vals = candidates[0].intersection(*candidates[1:])
+        return [val for val in vals if sub in val]
+
+def _check_key(item,primary_key):
+    """Return the primary key of item or raise an error if it is invalid"""
+    try:
+        key = item[primary_key]
+    except KeyError:
+        raise ValueError('Items must have the primary key {!r}'.format(primary_key))
+    if isinstance(key,list):
+        raise ValueError('The primary key can not be a list')
+    return key
+
+def _composite_keys(item,getter,empty):
+    """
+    The keys of item in a composite index where getter is the 
+    operator.itemgetter of its attributes: every combination of its values 
+    (for lists). Empty if it does not have all of the attributes
+    """
+    try:
+        values = getter(item)
+    except KeyError:
+        return ()
+    if not any(isinstance(value,list) for value in values):
+        return (values,)
+    return itertools.product(*[(value or [empty]) if isinstance(value,list) else (value,)
+                               for value in values])
+
+def _trigrams(val):
+    return {val[i:i + 3] for i in range(len(val) - 2)}
+
+class _Column(object):
+    """
+    NumPy mirror of a numeric attribute aligned with the item indices. 
+    values are float64 with valid as the mask of items with a (non-list) 
+    real number. Items with a value that is not (e.g. lists or strings) are 
+    in other.
+    """
+    def __init__(self):
+        self.values = np.zeros(0,dtype=np.float64)
+        self.valid = np.zeros(0,dtype=bool)
+        self.other = set()
+    
+    def set_many(self,ix0,values):
+        """Set the values of items ix0,ix0+1,... None is missing"""
+        end = ix0 + len(values)
+        if end > len(self.values): # Grow by doubling
+            size = max(end,2*len(self.values),64)
+            self.values = np.resize(self.values,size)
+            self.valid = np.resize(self.valid,size)
+            self.valid[end:] = False
+        
+        floats = [0.0]*len(values)
+        valid = [False]*len(values)
+        for i,val in enumerate(values):
+            if _is_number(val):
+                floats[i] = val
+                valid[i] = True
+                self.other.discard(ix0 + i)
+            elif val is not None:
+                self.other.add(ix0 + i)
+            else:
+                self.other.discard(ix0 + i)
+        self.values[ix0:end] = floats
+        self.valid[ix0:end] = valid
+
+def _is_number(val):
+    """
+    Real numbers that are exact as float64. Also used to match the same 
+    items with or without NumPy
+    """
+    if not isinstance(val,numbers.Real):
+        return False
+    return not isinstance(val,int) or -2**53 <= val <= 2**53
+
+def _real_bounds(low,high):
+    return all(_is_number(val) or val is _UNBOUNDED for val in (low,high))
+
+def _sorted_contains(seq,val):
+    i = bisect.bisect_left(seq,val)
+    return i < len(seq) and seq[i] == val
+
+class _RWLock(object):
+    """
+    Reentrant readers/writer lock. Any number of threads may hold it for
+    reading or one for writing. A thread holding it may acquire it again
+    (either kind if it is the writer) but a reader can not become a writer.
     
-    def _remove(self,attrib,value,ix):
-        """
-        Remove from the lookup and update the modify time
-        """
-        valueL = _makelist(value)
-        for val in valueL:
+    If prefer_writers, new readers wait while a writer is waiting. 
+    Otherwise, readers only wait for an active writer
+    """
+    def __init__(self,prefer_writers=True):
+        self.prefer_writers = prefer_writers
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = {} # {thread:count}
+        self._writer = None
+        self._writes = 0
+        self._waiting = 0 # writers
+    
+    def acquire_read(self):
+        me = _get_ident()
+        with self._cond:
+            if self._writer == me or me in self._readers: # Reentrant
+                self._readers[me] = self._readers.get(me,0) + 1
+                return
+            while self._writer is not None or (self.prefer_writers and self._waiting):
+                self._cond.wait()
+            self._readers[me] = 1
+    
+    def release_read(self):
+        me = _get_ident()
+        with self._cond:
+            count = self._readers.pop(me) - 1
+            if count:
+                self._readers[me] = count
+            elif not self._readers:
+                self._cond.notify_all()
+    
+    def acquire_write(self):
+        me = _get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writes += 1
+                return
+            if me in self._readers:
+                raise RuntimeError('Cannot change the DictTable while reading it in the same thread')
+            self._waiting += 1
             try:
-                self._lookup[attrib][val].remove(ix)
-            except ValueError:
-                raise ValueError('Item not found in internal lookup. May need to first call reindex()')
-        if len(valueL) == 0:
-            self._lookup[attrib][self._empty].remove(ix) # empty list
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting -= 1
+            self._writer = me
+            self._writes = 1
     
-        self._c += 1
+    def release_write(self):
+        with self._cond:
+            self._writes -= 1
+            if not self._writes:
+                self._writer = None
+                self._cond.notify_all()
     
-    def __contains__(self,check_diff):
-        if not ( isinstance(check_diff,dict) or isinstance(check_diff,Query)):
-            raise ValueError('Python `in` queries should be a of {attribute:value} or Query')
-        return self.isin(check_diff)
+    @contextlib.contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+    
+    @contextlib.contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
 
-    def __len__(self):
-        return self.N
+class _Journal(object):
+    """
+    Append-only journal file: a header with the generation then, for each
+    entry, its length and crc32 and the pickled entry. 
+    If truncate is not None, the existing file is cut to that length 
+    (0 to start a new one).
+    
+    Each entry is flushed to the file when appended. Pending entries are 
+    synced every sync_every entries or by a timer sync_interval seconds 
+    after the first of them
+    """
+    def __init__(self,path,generation,sync_every,sync_interval,truncate=None):
+        if truncate == 0 or not os.path.exists(path):
+            with open(path,'wb') as fobj:
+                fobj.write(_JOURNAL_MAGIC + _JOURNAL_HEADER.pack(generation))
+                fobj.flush()
+                os.fsync(fobj.fileno())
+        elif truncate is not None:
+            with open(path,'r+b') as fobj:
+                fobj.truncate(truncate)
+        
+        self._file = open(path,'ab')
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.pending = 0
+        self._lock = threading.Lock() # The timer syncs from another thread
+        self._timer = None
+    
+    def append(self,entry):
+        data = pickle.dumps(entry,protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._file.write(_JOURNAL_RECORD.pack(len(data),zlib.crc32(data) & 0xffffffff))
+            self._file.write(data)
+            self._file.flush()
+            self.pending += 1
+            if self.pending >= self.sync_every:
+                self._sync()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.sync_interval,self.sync)
+                self._timer.daemon = True
+                self._timer.start()
+    
+    def sync(self):
+        with self._lock:
+            if not self._file.closed:
+                self._sync()
+    
+    def _sync(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.pending = 0
+    
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._file.close()
 
-    def __getitem__(self,item):
-        if isinstance(item,dict) or isinstance(item,Query):
-            return self.query_one(item)
-        elif isinstance(item,int): # numbered item
-            if self._list[item] is not None:
-                return self._list[item]
-            else:
-                raise ValueError("Index has been deleted")
-        else:
-            raise ValueError("Must specify DB[{'attribute':val}] or DB[index]'")
-    __call__ = query
-    __delitem__ = remove
+def _read_journal(path):
+    """
+    Read a journal and return the generation, the list of entries, and 
+    the length of the file that is valid. Stops at the first incomplete 
+    or corrupt entry
+    """
+    if not os.path.exists(path):
+        return None,[],0
+    with open(path,'rb') as fobj:
+        data = fobj.read()
     
-    def __iter__(self):
-        return (item for item in self._list if item is not None)
-    items = __iter__
+    header = len(_JOURNAL_MAGIC) + _JOURNAL_HEADER.size
+    if len(data) < header or not data.startswith(_JOURNAL_MAGIC):
+        raise ValueError('Not a DictTable journal: {}'.format(path))
+    generation, = _JOURNAL_HEADER.unpack_from(data,len(_JOURNAL_MAGIC))
     
-    @property
-    def attributes(self):
-        # The attributes are the keys of _lookup but _lookup is a defaultdict
-        # of a defaultdict(list) so need to check that it is also empy
-        if self.fixed_attributes:
-            return self.fixed_attributes
-        
-        attribs = []
-        # This seems slow but the second for-loop will break at the first non-empty
-        # item (likely the first one)
-        for attrib,val in self._lookup.items():
-            if not val: # Empty
-                continue
-            for v in val.values():
-                if v: break
-            else:
-                continue
-            
-            attribs.append(attrib)
-        attribs.sort()
-        return attribs
+    entries = []
+    pos = header
+    while pos + _JOURNAL_RECORD.size <= len(data):
+        length,crc = _JOURNAL_RECORD.unpack_from(data,pos)
+        start = pos + _JOURNAL_RECORD.size
+        record = data[start:start + length]
+        if len(record) < length or zlib.crc32(record) & 0xffffffff != crc:
+            break
+        entries.append(pickle.loads(record))
+        pos = start + length
+    return generation,entries,pos
+
+class _AsyncQuery(object):
+    """
+    Result of DB.aquery(). Await it for a list of the items or use it 
+    with `async for`
+    """
+    def __init__(self,DB,node,chunk_size):
+        self._DB = DB
+        self._node = node
+        self._chunk_size = chunk_size
+    
+    def __aiter__(self):
+        return self._DB._aiter_query(self._node,self._chunk_size)
     
+    def __await__(self):
+        return self._list().__await__()
+    
+    async def _list(self):
+        return [item async for item in self]
+
+def _chunked(seq,size):
+    """Generator of the slices of seq with size items"""
+    for start in range(0,len(seq),size):
+        yield seq[start:start + size]
+
+def _combine_maps(maps,counts,new_maps,new_counts):
+    """Combine the maps and counts of _build_maps() into the first"""
+    for attrib,new_map in new_maps.items():
+        amap = maps.get(attrib)
+        if amap is None:
+            maps[attrib] = new_map
+            continue
+        for val,ixs in new_map.items():
+            if val in amap:
+                amap[val].update(ixs)
+            else:
+                amap[val] = ixs
+    for attrib,count in new_counts.items():
+        counts[attrib] += count
+
+def _shift_maps(maps,shift):
+    """Return maps from _build_maps() with every index moved by shift"""
+    return {attrib:defaultdict(set,((val,set(ix + shift for ix in ixs)) 
+                                    for val,ixs in amap.items()))
+            for attrib,amap in maps.items()}
+
 def _makelist(input):
     if isinstance(input,list):
         return input
     return [input]
 
+@contextlib.contextmanager
+def _gc_paused():
+    """
+    The garbage collector is triggered by the number of new container
+    objects (e.g. sets) so it would otherwise run *many* times while
+    building the index. Nothing built creates cycles so it is safe to pause
+    """
+    gcenabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gcenabled:
+            gc.enable()
+
+def _build_maps(items,ix0,attributes,exclude,empty):
+    """
+    Index items (numbered from ix0) into new maps. See DictTable._build_maps
+    """
+    maps = {} # {attrib:defaultdict(set)}
+    counts = defaultdict(int)
+    for ix,item in enumerate(items,ix0):
+        if item is None: # Removed
+            continue
+        if attributes:
+            pairs = ((a,item[a]) for a in attributes if a in item)
+        else:
+            pairs = item.items()
+        for attrib,value in pairs:
+            if attrib in exclude:
+                continue
+            try:
+                amap = maps[attrib]
+            except KeyError:
+                amap = maps[attrib] = defaultdict(set)
+            if isinstance(value,list):
+                if not value:
+                    value = [empty]
+                for val in value:
+                    amap[val].add(ix)
+            else:
+                amap[value].add(ix)
+            counts[attrib] += 1
+    return maps,counts
+
+# Items being indexed by a worker process. Only set in the workers (by
+# _init_worker) which inherit the items when forked. See _build_chunk
+_WORKER_ITEMS = None
+_PARALLEL_MIN_ITEMS = 10000 # Fewer are not worth starting the processes
+
+def _init_worker(items):
+    global _WORKER_ITEMS
+    _WORKER_ITEMS = items
+
+def _build_chunk(args):
+    """
+    Index one chunk of _WORKER_ITEMS in a worker process. Each attribute is
+    sent back as (values,ixs,offsets) where the indices for values[k] are
+    ixs[offsets[k]:offsets[k+1]] since this is *much* faster to pickle
+    than a set per value
+    """
+    start,stop,ix0,attributes,exclude = args
+    with _gc_paused():
+        maps,counts = _build_maps(_WORKER_ITEMS[start:stop],ix0,attributes,
+                                  exclude,_emptyList())
+    packed = {}
+    for attrib,amap in maps.items():
+        ixs = array('q')
+        offsets = array('q',[0])
+        for ixset in amap.values():
+            ixs.extend(ixset)
+            offsets.append(len(ixs))
+        packed[attrib] = (list(amap),ixs,offsets)
+    return packed,counts
+
+def _fork_context():
+    """
+    The multiprocessing context that forks or None if not available (e.g. 
+    Windows) in which case the index is built serially
+    """
+    try:
+        import multiprocessing
+        return multiprocessing.get_context('fork')
+    except (ImportError,ValueError):
+        return None
+
+def _flatten_items(items):
+    """
+    Yield the items from nested lists, tuples, and generators 
+    """
+    for item in items:
+        if isinstance(item,(list,tuple,types.GeneratorType)):
+            for it in _flatten_items(item):
+                yield it
+        else:
+            yield item
+
+def _sort_family(value):
+    """
+    Group values that can be ordered together. All real numbers are
+    comparable so they are one family. Otherwise it is the type
+    """
+    if isinstance(value,numbers.Real):
+        return numbers.Real
+    return type(value)
+
+_EMPTYSET = frozenset()
+
+# With bitmaps, sets of items that have at least 1/_BITMAP_DENSITY of all of
+# the items are bitmaps. Smaller ones are sets. The bitmaps of postings are
+# cached up to _BITMAP_CACHE_MEMORY bytes
+_BITMAP_DENSITY = 64
+_BITMAP_CACHE_MEMORY = 64*2**20
+
+# Chunk sizes for lazy query evaluation. Start small for existence and 
+# first-match checks and grow to amortize the cost of the rest of the query
+_CHUNK_START = 64
+_CHUNK_MAX = 65536
+
+def _popcount(bits):
+    return bin(bits).count('1')
+if hasattr(int,'bit_count'): # 3.10+
+    _popcount = int.bit_count
+
+# Offsets of the set bits of every byte
+_BYTE_BITS = [tuple(b for b in range(8) if n >> b & 1) for n in range(256)]
+
+class _Bitmap(object):
+    """
+    A set of item indices stored as the bits of a (arbitrarily large) Python 
+    int. The boolean operations (&, |, -) are done by Python's int 
+    operations which work a machine word at a time.
+    
+    Supports the parts of the set interface used by queries. Treat as 
+    immutable except for add(), discard(), and update() which are only used 
+    on the DB's own universe
+    """
+    __slots__ = ('bits',)
+    
+    def __init__(self,ixs=(),bits=None):
+        if bits is not None:
+            self.bits = bits
+            return
+        self.bits = 0
+        self.update(ixs)
+    
+    def update(self,ixs):
+        if isinstance(ixs,_Bitmap):
+            self.bits |= ixs.bits
+            return
+        if isinstance(ixs,range) and ixs.step == 1:
+            if len(ixs):
+                self.bits |= ((1 << len(ixs)) - 1) << ixs.start
+            return
+        ixs = ixs if isinstance(ixs,(set,frozenset,list,tuple)) else list(ixs)
+        if not ixs:
+            return
+        # Set the bits in a bytearray and convert all at once rather than 
+        # making a new int for each
+        arr = bytearray(max(ixs)//8 + 1)
+        for ix in ixs:
+            arr[ix >> 3] |= 1 << (ix & 7)
+        self.bits |= int.from_bytes(bytes(arr),'little')
+    
+    def add(self,ix):
+        self.bits |= 1 << ix
+    
+    def discard(self,ix):
+        if self.bits >> ix & 1:
+            self.bits ^= 1 << ix
+    
+    def _other(self,other):
+        return other.bits if isinstance(other,_Bitmap) else _Bitmap(other).bits
+    
+    def _bytes(self):
+        """
+        The bits as bytes to test many indices against. `ix in self` shifts
+        (copies) the whole int each time
+        """
+        return self.bits.to_bytes((self.bits.bit_length() + 7)//8,'little')
+    
+    # With a (small) set, & and set - bitmap are sets
+    def __and__(self,other):
+        if isinstance(other,_Bitmap):
+            return _Bitmap(bits=self.bits & other.bits)
+        data = self._bytes()
+        n = len(data)
+        return set(ix for ix in other if 0 <= ix >> 3 < n and data[ix >> 3] >> (ix & 7) & 1)
+    __rand__ = __and__
+    
+    def __or__(self,other):
+        return _Bitmap(bits=self.bits | self._other(other))
+    __ror__ = __or__
+    
+    def __sub__(self,other):
+        return _Bitmap(bits=self.bits & ~self._other(other))
+    
+    def __rsub__(self,other):
+        data = self._bytes()
+        n = len(data)
+        return set(ix for ix in other 
+                   if not (0 <= ix >> 3 < n and data[ix >> 3] >> (ix & 7) & 1))
+    
+    def __len__(self):
+        return _popcount(self.bits)
+    
+    def __bool__(self):
+        return self.bits != 0
+    
+    def __contains__(self,ix):
+        return ix >= 0 and bool(self.bits >> ix & 1)
+    
+    def __iter__(self):
+        bits = self.bits
+        if not bits:
+            return
+        nwords = (bits.bit_length() + 63)//64
+        data = bits.to_bytes(8*nwords,'little')
+        words = memoryview(data).cast('Q')
+        for w,word in enumerate(words): # Skip empty words
+            if not word:
+                continue
+            for b in range(8*w,8*w + 8):
+                byte = data[b]
+                if byte:
+                    for offset in _BYTE_BITS[byte]:
+                        yield 8*b + offset
+    
+    def __eq__(self,other):
+        if isinstance(other,_Bitmap):
+            return self.bits == other.bits
+        return set(self) == set(other)
+    
+    def __ne__(self,other):
+        return not self == other
+    
+    __hash__ = None
+    
+    def __repr__(self):
+        return '_Bitmap({})'.format(sorted(self))
+
+def _sizeof(ixs):
+    """Approximate memory of a set of indices"""
+    if isinstance(ixs,_Bitmap):
+        return sys.getsizeof(ixs) + sys.getsizeof(ixs.bits)
+    return sys.getsizeof(ixs)
+
+class _Schema(object):
+    """The keys (and their position) shared by compact records"""
+    __slots__ = ('keys','index')
+    def __init__(self,keys):
+        self.keys = keys
+        self.index = dict((key,i) for i,key in enumerate(keys))
+    
+    def __getstate__(self):
+        return self.keys
+    
+    def __setstate__(self,keys):
+        self.__init__(keys)
+
+class _Record(Mapping):
+    """
+    Compact, read-only, dict-like item. See compact_rows in DictTable. 
+    Compares equal to a dict with the same items.
+    
+    Only the values are stored (as a tuple). The keys are in the shared
+    schema
+    """
+    __slots__ = ('_schema','_values')
+    def __init__(self,schema,values):
+        self._schema = schema
+        self._values = tuple(values)
+    
+    def __getitem__(self,key):
+        return self._values[self._schema.index[key]]
+    
+    def __contains__(self,key):
+        return key in self._schema.index
+    
+    def __iter__(self):
+        return iter(self._schema.keys)
+    
+    def __len__(self):
+        return len(self._values)
+    
+    def get(self,key,default=None):
+        i = self._schema.index.get(key)
+        return default if i is None else self._values[i]
+    
+    __hash__ = None
+    
+    def copy(self):
+        """Return as a dict"""
+        return dict(zip(self._schema.keys,self._values))
+    
+    def __reduce__(self):
+        return (_Record,(self._schema,self._values))
+    
+    def __repr__(self):
+        return repr(self.copy())
+
+def _as_dict(item):
+    """The item as a dict. Only compact rows are copied"""
+    return item.copy() if isinstance(item,_Record) else item
+
 class _emptyList(object):
     def __init__(self):
         pass
     def __hash__(self):
         return 9999999999999
     def __eq__(self,other):
+        if isinstance(other,_emptyList):
+            return True
         return isinstance(other,list) and len(other)==0
 
-def _new_defaultdict_list():
-    return defaultdict(list)
+def _new_defaultdict_set():
+    return defaultdict(set)
        
 class Query(object):
     """
@@ -519,8 +4076,12 @@ class Query(object):
     
     Calling
         * Q.attribute sets attribute and returns a copy
-        * Q.attribute == val (or any other comparison) set the index of elements
-        * Q1 & Q1 or other boolean perform set operations
+        * Q.attribute == val (or any other comparison) set the condition
+        * Q1 & Q1 or other boolean combine the conditions
+    
+    The conditions are stored as an expression (see _node) and are only 
+    evaluated when used in a query. This lets the DB plan the evaluation
+    (e.g. most selective first) rather than in the order written.
         
     Useful Methods:
         _filter : (or just `filter` if not an attribute): Apply a filter
@@ -528,14 +4089,33 @@ class Query(object):
     """
     def __init__(self,DB):
         self._DB = DB
-        self._ixs = DB._ix # Everything. Do *NOT* copy but also never modify in place
+        self._node = _ALL # Everything
         self._attr = None
         
         self._c = DB._c
         self._id = DB._id
+    
+    @property
+    def _ixs(self):
+        """Evaluate the query. Do *NOT* modify in place"""
+        return self._DB._evaluate(self._node)
         
     def _valid(self):
-        if self._c != self._DB._c:
+        """
+        Raise an error if anything this query depends on has changed since
+        it was created. Changes to other attributes do not matter
+        """
+        DB = self._DB
+        if self._c == DB._c:
+            return
+        if DB._lock is not None: 
+            # Concurrent. Other threads may change the DB between making and
+            # using any query. Since it is evaluated when used, it is only
+            # out of date if the item indices were changed by vacuum()
+            stale = DB._vacuumed > self._c and _uses_index(self._node)
+        else:
+            stale = DB._changed_since(_node_deps(self._node),self._c)
+        if stale:
             raise ValueError('This query object is out of date from the DB. Create a new one')
         
     def _filter(self,filter_func):
@@ -546,127 +4126,295 @@ class Query(object):
         Apply a filter to the data that returns True if it matches and False
         otherwise
         
-        Note that filters are O(N)
+        Note that filters are O(N) but when combined with & other 
+        conditions, it is only applied to the items that match them
         """
         self._valid() # Actually, these would still work but still check
-        ixs = set()
-        for ix,item in enumerate(self._DB._list): # loop all
-            if item is None:
-                continue
-            if filter_func(item):
-                ixs.add(ix)
-        self._ixs = ixs # reset it
+        self._node = ('filter',filter_func) # reset it
         return self
 
+    def _vfilter(self,func,*attributes):
+        """
+        If 'vfilter' is NOT an attribute of the DB, this can be called
+        with 'vfilter' instead of '_vfilter'
+        
+        Vectorized filter on numeric attributes. func is called with the
+        values of each attribute and must return True for a match. For 
+        example, 
+        
+        >>> DB.Q.vfilter(lambda price,qty: price*qty > 100,'price','qty')
+        
+        Only items where all of the attributes are real numbers (not lists)
+        can match. If all of the attributes are numeric_attributes, func is
+        called *once* with NumPy arrays of all values and must return a 
+        boolean array. Otherwise (or without NumPy), it is called for each 
+        item so write func with operators that work for both (use & and | 
+        rather than `and` and `or`).
+        """
+        self._valid()
+        if not attributes:
+            raise ValueError('Must specify the attributes used by vfilter')
+        self._node = ('vfilter',func,attributes)
+        return self
+    
     # Comparisons
     def __eq__(self,value):
         self._valid()
-
-        if not self._ixs:
-            return self
         
         # Account for '_index' attribute (May be deprecated in the future...)
         if self._attr == '_index':
-            self._ixs = self._ixs.intersection({value}) # replace, don't update
-            return self
-        for val in _makelist(value):
-             self._ixs = self._ixs.intersection(self._DB._lookup[self._attr][val]) # Will return [] if _attr or val not there . Replace, don't update
+            node = ('index',value)
+        else:
+            nodes = [('eq',self._attr,val) for val in _makelist(value)]
+            if not nodes:
+                return self
+            node = _and(*nodes)
+        
+        if self._node == ('attr',self._attr): # The eq is a subset of it
+            self._node = node
+        else:
+            self._node = _and(self._node,node)
         return self
      
     def __ne__(self,value):
-        self._ixs = self._DB._ix - (self == value)._ixs
+        self._node = _not((self == value)._node)
         return self
     
     def __lt__(self,value):
-        self._valid() # Actually, these would still work but still check
-        ixs = set()
-        for ix,item in enumerate(self._DB._list): # loop all
-            if item is None or self._attr not in item:
-                continue
-            for ival in _makelist(item[self._attr]):
-                if ival < value:
-                    ixs.add(ix)
-        self._ixs = ixs
-        return self
+        return self._range(high=value,high_inclusive=False)
 
     def __le__(self,value):
-        self._valid() # Actually, these would still work but still check
-        ixs = set()
-        for ix,item in enumerate(self._DB._list): # loop all
-            if item is None:
-                continue
-            if self._attr in item and item[self._attr] <= value:
-                ixs.add(ix)
-        self._ixs = ixs
-        return self
+        return self._range(high=value,high_inclusive=True)
         
     def __gt__(self,value):
-        self._valid() # Actually, these would still work but still check
-        ixs = set()
-        for ix,item in enumerate(self._DB._list): # loop all
-            if item is None:
-                continue
-            if self._attr in item and item[self._attr] > value:
-                ixs.add(ix)
-        self._ixs = ixs
-        return self
+        return self._range(low=value,low_inclusive=False)
         
     def __ge__(self,value):
+        return self._range(low=value,low_inclusive=True)
+    
+    def _between(self,low,high,inclusive=True):
+        """
+        If 'between' is NOT an attribute of the DB, this can be called
+        with 'between' instead of '_between'. Must be called after the 
+        attribute is set:
+        
+        >>> DB.Q.born.between(1940,1943)
+        
+        Matches items with low <= value <= high. Set inclusive to False to 
+        exclude both ends or to a tuple of (low_inclusive,high_inclusive)
+        
+        This is O(log N + k) for sorted attributes. O(N) otherwise
+        """
+        if isinstance(inclusive,tuple):
+            low_inclusive,high_inclusive = inclusive
+        else:
+            low_inclusive = high_inclusive = inclusive
+        return self._range(low,high,low_inclusive,high_inclusive)
+    
+    def _startswith(self,prefix):
+        """
+        If 'startswith' is NOT an attribute of the DB, this can be called
+        with 'startswith' instead of '_startswith'. Must be called after the
+        attribute is set:
+        
+        >>> DB.Q.path.startswith('/var/log/')
+        
+        Matches items where the value (or any value of a list) is a string 
+        that starts with prefix. Fast for string_attributes. Otherwise, 
+        every unique value is checked (but not every item)
+        """
+        return self._string_op('startswith',prefix)
+    
+    def _contains(self,substring):
+        """
+        If 'contains' is NOT an attribute of the DB, this can be called
+        with 'contains' instead of '_contains'. Must be called after the
+        attribute is set:
+        
+        >>> DB.Q.name.contains('ell')
+        
+        Matches items where the value (or any value of a list) is a string 
+        that contains substring. See startswith
+        """
+        return self._string_op('contains',substring)
+    
+    def _string_op(self,op,sub):
+        self._valid()
+        if not isinstance(sub,str):
+            raise ValueError('{} requires a string'.format(op))
+        self._node = (op,self._attr,sub)
+        return self
+    
+    def _range(self,low=_UNBOUNDED,high=_UNBOUNDED,low_inclusive=True,high_inclusive=True):
         self._valid() # Actually, these would still work but still check
-        ixs = set()
-        for ix,item in enumerate(self._DB._list): # loop all
-            if item is None:
-                continue
-            if self._attr in item and item[self._attr] >= value:
-                ixs.add(ix)
-        self._ixs = ixs
+        self._node = ('range',self._attr,low,high,low_inclusive,high_inclusive)
         return self
     
     # Logic
     def __and__(self,Q2):
-        self._ixs = self._ixs.intersection(Q2._ixs)
+        self._combine(Q2)
+        self._node = _and(self._node,Q2._node)
         return self
         
     def __or__(self,Q2):
-        self._ixs = self._ixs.union(Q2._ixs)
+        self._combine(Q2)
+        self._node = _or(self._node,Q2._node)
         return self
         
     def __invert__(self):
-        self._ixs = self._DB._ix - self._ixs
+        self._node = _not(self._node)
         return self
     
+    def _combine(self,Q2):
+        if Q2._id != self._id:
+            raise ValueError("Cannot use another DictTable's Query object")
+        DB = self._DB
+        if (DB._changed_since(_node_deps(self._node),self._c) 
+            or DB._changed_since(_node_deps(Q2._node),Q2._c)):
+            self._c = min(self._c,Q2._c) # Out of date if either is
+        else:
+            self._c = DB._c # Both are up-to-date so combined is too
+    
     # Attributes
     def __getattr__(self,attr):
         if self._attr is not None:
+            if attr == 'between':
+                return self._between
+            if attr == 'startswith':
+                return self._startswith
+            if attr == 'contains':
+                return self._contains
             raise ValueError('Already set attribute')
         if attr == 'filter' and 'filter' not in self._DB.attributes:
             return self._filter
+        if attr == 'vfilter' and 'vfilter' not in self._DB.attributes:
+            return self._vfilter
         
         self._attr = attr
         if attr == '_index':
             return self
-            
-        ixs = set()
-        for vals in self._DB._lookup[attr].values():
-            ixs.update(vals)
-        self._ixs = ixs
+        
+        # Do not evaluate. If it is followed by == this is replaced
+        self._node = ('attr',attr)
         return self
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
+
+# Query expression nodes are tuples of (op,*args):
+#   ('all',)                    Every item
+#   ('attr',attrib)             Items that have attrib
+#   ('eq',attrib,val)           Items where attrib has val
+#   ('index',ix)                The item at ix (or a tuple of ixs, internally)
+#   ('range',attrib,low,high,low_inclusive,high_inclusive)
+#   ('startswith',attrib,prefix), ('contains',attrib,substring)
+#   ('filter',func)             Items where func(item) is True
+#   ('composite',attribs,key)   Only made by the planner. See DictTable._plan
+#   ('vfilter',func,attribs)    Items where func(*values) is True. Vectorized
+#   ('and',(node,...)), ('or',(node,...)), ('not',node)
+_ALL = ('all',)
+
+class _Rows(object):
+    """Sentinel dependency of queries that depend on which items exist"""
+    def __repr__(self):
+        return '_ROWS'
+    def __reduce__(self):
+        return '_ROWS' # The module-level singleton
+_ROWS = _Rows()
+
+def _node_deps(node):
+    """
+    Return the set of attributes (and _ROWS if it depends on which items
+    exist) that node depends on. Returns None if it depends on everything
+    (i.e. filters)
+    """
+    op = node[0]
+    if op in ('and','or'):
+        deps = set()
+        for child in node[1]:
+            cdeps = _node_deps(child)
+            if cdeps is None:
+                return None
+            deps.update(cdeps)
+        return deps
+    if op == 'not':
+        deps = _node_deps(node[1])
+        if deps is None:
+            return None
+        return deps | {_ROWS}
+    if op == 'filter': # Depends on the items, not the index
+        return None
+    if op == 'vfilter':
+        return set(node[2])
+    if op in ('all','index'):
+        return {_ROWS}
+    return {node[1]} # eq, attr, and range
+
+def _uses_index(node):
+    """Whether node has an '_index' query"""
+    op = node[0]
+    if op in ('and','or'):
+        return any(_uses_index(child) for child in node[1])
+    if op == 'not':
+        return _uses_index(node[1])
+    return op == 'index'
+
+def _uses_vfilter(node):
+    """Whether node has a 'vfilter' query"""
+    op = node[0]
+    if op in ('and','or'):
+        return any(_uses_vfilter(child) for child in node[1])
+    if op == 'not':
+        return _uses_vfilter(node[1])
+    return op == 'vfilter'
+
+def _cache_key(node):
+    """
+    Return a hashable, normalized (order of 'and' and 'or' do not matter) 
+    form of node and the set of attributes (or _ROWS) it depends on.
+    Returns (None,None) if it can't be cached
+    """
+    deps = _node_deps(node)
+    if deps is None or _uses_vfilter(node): # func may depend on more
+        return None,None
+    try:
+        key = _normalize(node)
+        hash(key)
+    except TypeError: # e.g. unhashable range bounds
+        return None,None
+    return key,deps
+
+def _normalize(node):
+    """Order of 'and' and 'or' children do not matter"""
+    op = node[0]
+    if op in ('and','or'):
+        return (op,frozenset(_normalize(child) for child in node[1]))
+    if op == 'not':
+        return (op,_normalize(node[1]))
+    return node
+
+def _and(*nodes):
+    """And the nodes together. Flatten nested ands and drop 'all'"""
+    children = []
+    for node in nodes:
+        if node[0] == 'and':
+            children.extend(node[1])
+        elif node != _ALL:
+            children.append(node)
+    if not children:
+        return _ALL
+    if len(children) == 1:
+        return children[0]
+    return ('and',tuple(children))
+
+def _or(*nodes):
+    """Or the nodes together. Flatten nested ors"""
+    children = []
+    for node in nodes:
+        if node[0] == 'or':
+            children.extend(node[1])
+        else:
+            children.append(node)
+    return ('or',tuple(children))
+
+def _not(node):
+    if node[0] == 'not':
+        return node[1]
+    return ('not',node)
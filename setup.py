@@ -1,7 +1,5 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from __future__ import division, print_function, unicode_literals, absolute_import
-
 from setuptools import setup
 
 with open('dicttable.py','rt') as file:
@@ -20,6 +18,8 @@ setup(
     name='dicttable',
     py_modules=['dicttable'],
     install_requires=[],
+    python_requires='>=3.6',
+    extras_require={'numpy':['numpy']},
     long_description=open('readme.md').read(),
     entry_points = {},
     version=__version__,
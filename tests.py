@@ -3,6 +3,13 @@ import sys
 import time
 import copy
 import os
+import tempfile
+import json
+import subprocess
+import threading
+import asyncio
+import numbers
+from collections import defaultdict
 
 import pytest
 
@@ -707,6 +714,1707 @@ def test_adding_fixed_attrib_to_dynamic():
     DB.add_fixed_attribute('e',force=True)
     assert set(DB.attributes) == set('e')
     
+def test_sorted_attributes():
+    """
+    Range queries with the sorted index must match the O(N) version
+    """
+    items = [
+        {'first':'John', 'last':'Lennon','born':1940,'role':'guitar'},
+        {'first':'Paul', 'last':'McCartney','born':1942,'role':'bass'},
+        {'first':'George','last':'Harrison','born':[1943,1950],'role':'guitar'},
+        {'first':'Ringo','last':'Starr','born':1940,'role':'drums'},
+        {'first':'George','last':'Martin','born':1926.5,'role':'producer'},
+        {'first':'Brian','last':'Epstein','born':'1934'}, # Not comparable
+        {'first':'Pete','last':'Best','born':[]}, 
+    ]
+    DBs = DictTable(copy.deepcopy(items),sorted_attributes='born')
+    DBu = DictTable(copy.deepcopy(items[:5])) # Can't compare '1934' < 1940
+    
+    assert DBs.sorted_attributes == ['born']
+    
+    def check():
+        for val in [1900,1926.5,1940,1941,1943,1950,2000]:
+            for op in ['<','<=','>','>=']:
+                exp = 'sorted(DB.query(DB.Q.born {} {}),key=repr)'.format(op,val)
+                assert eval(exp,{'DB':DBs}) == eval(exp,{'DB':DBu}),exp
+        for low,high,inc in [(1926.5,1940,True),(1926.5,1940,False),
+                             (1940,1950,(True,False)),(1941,1949,True)]:
+            res = [sorted(DB.query(DB.Q.born.between(low,high,inclusive=inc)),key=repr)
+                   for DB in [DBs,DBu]]
+            assert res[0] == res[1]
+    check()
+    
+    assert DBs.count(DBs.Q.born > 1942) == 1 # The list
+    assert DBs.count(DBs.Q.born.between(1944,1949)) == 0
+    assert DBs.count(DBs.Q.born.between(1940,1942)) == 3
+    assert DBs.count(DBs.Q.born < '2') == 1 # Only compares strings
+    assert DBs.count(DBs.Q.born < None) == 0
+    
+    # Keep it up to date
+    for DB in [DBs,DBu]:
+        DB.update({'born':1945},first='Paul')
+        DB.remove(last='Starr')
+        DB.add({'first':'Stuart','last':'Sutcliffe','born':1940})
+    check()
+    assert DBs.count(DBs.Q.born == 1942) == 0
+    assert DBs.count(DBs.Q.born.between(1940,1942)) == 2
+    
+    # Reindex and adding it later
+    DBs.reindex()
+    check()
+    DBu.add_sorted_attribute('born')
+    check()
+    
+    with pytest.raises(ValueError):
+        DictTable(exclude_attributes='born',sorted_attributes='born')
+    with pytest.raises(ValueError):
+        DictTable(fixed_attributes='first',sorted_attributes='born')
+    
+    # And an attribute named 'between'
+    DB = DictTable([{'between':1},{'between':2}],sorted_attributes='between')
+    assert DB.count(DB.Q.between == 1) == 1
+    assert DB.count(DB.Q.between.between(1,2)) == 2
+    
+    # Unorderable values are not range indexed but do not raise an error
+    DB = DictTable([{'a':object()},{'a':object()},{'a':1}],sorted_attributes='a')
+    assert DB.count(DB.Q.a >= 0) == 1
+    DB.remove(DB.Q.a)
+    DB.add([{'a':object()},{'a':2}])
+    DB.add({'a':object()})
+    assert DB.count(DB.Q.a >= 0) == 1
+
+    # New keys are only merged in by the next range query
+    DB = DictTable([{'t':t} for t in range(0,100,2)],sorted_attributes='t')
+    for t in [51,7,99,7.5]:
+        DB.add({'t':t})
+    DB.remove(t=99) # Before it was merged
+    assert DB._sorted_new['t'] == {51,7,7.5} and 51 not in DB._sorted['t'][numbers.Real]
+    assert DB.count(DB.Q.t.between(7,51)) == 25
+    assert not DB._sorted_new and DB._sorted['t'][numbers.Real][3:7] == [6,7,7.5,8]
+    DB.remove(t=7.5)
+    assert 7.5 not in DB._sorted['t'][numbers.Real] and DB.count(DB.Q.t > 98) == 0
+
+def test_repeated_list_values():
+    DB = DictTable([{'a':['x','x','y']},{'a':'x'}])
+    assert DB.count(a='x') == 2
+    DB.update({'a':'y'},DB.Q._index == 0)
+    assert DB.count(a='x') == 1
+    assert DB.count(a='y') == 1
+    DB.update({'a':['x','x']},a='y')
+    DB.remove(a='x')
+    assert len(DB) == 0
+
+def test_hot_value_performance():
+    """
+    Updating and removing items that share a value with many others
+    should not depend on how many share it
+    """
+    def timeit(N):
+        DB = DictTable({'ii':ii,'status':'hot'} for ii in range(N))
+        t0 = time.time()
+        for ii in range(N-200,N): # Last ones are the worst case for a list
+            DB.update({'status':'cold'},ii=ii)
+            DB.remove(ii=ii)
+        return time.time() - t0
+    
+    tA = timeit(1000)
+    tB = timeit(100000)
+    print('Time Ratio:',tB/tA)
+    assert tB/tA < 3, 'Should not scale with the number of items matching'
+
+def test_attribute_catalog():
+    items = [
+        {'first':'John', 'last':'Lennon','born':1940,'role':['guitar','strings']},
+        {'first':'Paul', 'last':'McCartney','born':1942,'role':['bass','strings']},
+        {'first':'George','last':'Harrison','born':1943,'role':['guitar','strings']},
+        {'first':'Ringo','last':'Starr','born':1940,'role':'drums'},
+        {'first':'George','last':'Martin','born':1926,'role':'producer','extra':[]}
+    ]
+    DB = DictTable(items)
+    assert DB.attributes == ['born','extra','first','last','role']
+    assert DB.cardinality('first') == 4
+    assert DB.cardinality('role') == 5
+    assert DB.cardinality('extra') == 1
+    assert DB.cardinality('nope') == 0
+    assert DB.density('first') == 1.0
+    assert DB.density('extra') == 0.2
+    
+    # Queries for missing values should not change anything
+    assert DB.count(first='Pete') == 0
+    assert DB.count(DB.Q.nope) == 0
+    assert DB.cardinality('first') == 4
+    assert 'nope' not in DB.attributes
+    
+    DB.remove(last='Martin')
+    assert DB.attributes == ['born','first','last','role']
+    assert DB.cardinality('first') == 4 # Still George Harrison
+    assert DB.cardinality('last') == 4
+    assert DB.cardinality('role') == 4
+    
+    DB.update({'born':1941},first='George')
+    assert DB.cardinality('born') == 3
+    DB.add({'extra':'yes'})
+    assert DB.density('extra') == 0.2
+    
+    DB.reindex()
+    assert DB.attributes == ['born','extra','first','last','role']
+    assert DB.cardinality('born') == 3
+    
+    DB = DictTable(items,fixed_attributes=['first'])
+    assert DB.density('first') == 1.0
+    assert DB.density('last') == 0.0
+    assert DictTable().density('first') == 0.0
+    
+def sorted_index(DB):
+    """DB._sorted with any new keys merged in"""
+    for attrib in list(DB._sorted_new):
+        DB._sorted_merge(attrib)
+    return DB._sorted
+
+@pytest.mark.parametrize("kwargs", [{},
+                                    {'fixed_attributes':['first','role']},
+                                    {'exclude_attributes':['last']},
+                                    {'sorted_attributes':['born']}])
+def test_bulk_add(kwargs):
+    """Bulk adding must be the same as one-at-a-time"""
+    items = [
+        {'first':'John', 'last':'Lennon','born':1940,'role':['guitar','strings']},
+        {'first':'Paul', 'last':'McCartney','born':1942,'role':['bass','strings']},
+        {'first':'George','last':'Harrison','born':1943,'role':['guitar','guitar']},
+        {'first':'Ringo','last':'Starr','born':1940,'role':'drums'},
+        {'first':'George','last':'Martin','born':1926.0,'role':[],'extra':'test'}
+    ]
+    DB0 = DictTable(**kwargs)
+    for item in items:
+        DB0.add(item)
+    
+    DB1 = DictTable.from_records(items,**kwargs)
+    DB2 = DictTable(items[:2],**kwargs)
+    DB2.add(item for item in items[2:]) # Generator onto a non-empty DB
+    DB3 = DictTable([items[:2],(items[2:4],)],**kwargs) # Nested
+    DB3.add([items[4]])
+    
+    for DB in [DB1,DB2,DB3]:
+        assert DB._lookup == DB0._lookup
+        assert sorted_index(DB) == sorted_index(DB0)
+        assert DB.attributes == DB0.attributes
+        assert DB._counts == DB0._counts
+        assert DB._ix == DB0._ix
+        assert DB.N == DB0.N == 5
+        assert list(DB) == list(DB0)
+        assert DB.count(role=[]) == DB0.count(role=[])
+    
+    # Errors should not change the DB
+    DB = DictTable(items,**kwargs)
+    with pytest.raises(TypeError):
+        DB.add([{'first':'Pete'},{'first':{}}]) # unhashable
+    assert DB._lookup == DB0._lookup
+    assert len(DB) == 5
+    
+def test_vacuum():
+    items = [{'i':i,'i//2':i//2,'l':[i%3,i%5],'e':[]} for i in range(20)]
+    DB = DictTable(items,sorted_attributes='i')
+    DB.vacuum() # Nothing to do
+    assert len(DB._list) == 20
+    
+    DB.remove(DB.Q.i >= 10)
+    DB.pop(i=3)
+    Q = DB.Q.l == 4
+    assert len(DB._list) == 20 and len(DB) == 9
+    
+    before = sorted(DB.query(DB.Q.l == 1),key=lambda item:item['i'])
+    DB.vacuum()
+    
+    assert len(DB._list) == len(DB) == 9
+    assert DB._ix == set(range(9))
+    assert all(item is not None for item in DB._list)
+    assert sorted(DB.query(DB.Q.l == 1),key=lambda item:item['i']) == before
+    assert DB.count(DB.Q.i.between(2,5)) == 3
+    assert DB.count(e=[]) == 9
+    assert DB[3] == {'i':4,'i//2':2,'l':[1,4],'e':[]}
+    with pytest.raises(ValueError):
+        DB.count(Q) # Out of date
+    
+    # Can keep going
+    DB.add({'i':100})
+    DB.update({'i//2':-1},i=100)
+    assert DB[9]['i'] == 100
+    assert DB.query_one(i=100)['i//2'] == -1
+    
+    # Automatic
+    DB = DictTable(items,vacuum_threshold=0.5)
+    DB.remove(DB.Q.i < 10)
+    assert len(DB._list) == 20 # Exactly half
+    DB.pop(i=10)
+    assert len(DB._list) == len(DB) == 9
+    assert DB.query_one(i=11) is DB[0]
+    assert DB.copy().vacuum_threshold == 0.5
+    
+    # Not while a query is being iterated. Then once it is done
+    for concurrent in [False,True]:
+        DB = DictTable([{'id':i,'a':i%2} for i in range(20)],vacuum_threshold=0.2,
+                       concurrent=concurrent)
+        removed = []
+        for item in DB.query(a=0):
+            assert item['a'] == 0
+            removed.append(item['id'])
+            DB.remove(id=item['id'])
+        assert removed == list(range(0,20,2))
+        assert DB.count(a=0) == 0 and DB.count(a=1) == len(DB) == 10
+        if concurrent: # The query was found all at once
+            continue
+        assert len(DB._list) == 10 # Once the loop was done
+        assert all(DB[ix]['id'] == item['id'] for ix,item in enumerate(DB))
+        
+        items = DB.query(a=1)
+        next(items)
+        DB.remove(id=1)
+        DB.remove(id=3)
+        DB.remove(id=5)
+        assert len(DB._list) == 10 # Waiting
+        del items
+        assert len(DB._list) == len(DB) == 7
+        
+        # Also iterating the DB. An iterator that is closed is done
+        items = iter(DB)
+        assert next(items)['id'] == 7
+        DB.remove(id=7)
+        DB.remove(id=9)
+        assert len(DB._list) == 7
+        assert next(items)['id'] == 11 # Not removed ones
+        items.close()
+        assert len(DB._list) == len(DB) == 5
+        assert DB._iterators == 0
+    
+def test_bitmap_object():
+    _Bitmap = dicttable._Bitmap
+    A = _Bitmap([0,3,64,65,1000])
+    B = _Bitmap(range(60,70))
+    assert list(A) == [0,3,64,65,1000]
+    assert len(A) == 5 and len(B) == 10
+    assert set(A & B) == {64,65}
+    assert set(A | B) == {0,3,1000} | set(range(60,70))
+    assert set(A - B) == {0,3,1000}
+    assert A & {3,4} == {3} and {3,4} & A == {3} # Sets with a set
+    assert {3,4} - A == {4} and set(A - {3}) == {0,64,65,1000}
+    assert A & {-1,1000,5000} == {1000} and {-1,1000,5000} - A == {-1,5000}
+    assert set({4} | A) == {0,3,4,64,65,1000}
+    assert 1000 in A and 999 not in A and -1 not in A
+    assert not _Bitmap() and A
+    assert list(_Bitmap()) == []
+    A.discard(1000); A.discard(1001); A.add(7)
+    assert A == _Bitmap([0,3,7,64,65])
+    assert A != B
+    assert repr(A) == '_Bitmap([0, 3, 7, 64, 65])'
+    
+def test_bitmap_sparse_performance():
+    """
+    A sparse query and a dense one should be no slower with bitmaps. The
+    sparse set is not tested against the bitmap one index at a time
+    """
+    items = [{'a':i%100,'b':i%2} for i in range(200000)]
+    times = []
+    for bitmaps in [False,True]:
+        DB = DictTable(items,bitmaps=bitmaps)
+        t0 = time.time()
+        for a in range(20):
+            assert DB.count((DB.Q.a == a) & (DB.Q.b == a%2)) == 2000
+            assert DB.count((DB.Q.a == a) & (DB.Q.b != a%2)) == 0
+        times.append(time.time() - t0)
+    assert times[1] < 3*times[0] + 0.01, times
+    
+    B = dicttable._Bitmap(range(0,2000000,2))
+    S = set(range(0,2000000,66))
+    t0 = time.time()
+    assert len(B & S) == len(S) and not S - B
+    assert time.time() - t0 < 0.5
+
+@pytest.mark.parametrize("sorted_attributes", [None,'i'])
+def test_bitmaps(sorted_attributes):
+    """Everything should be the same with sets or bitmaps"""
+    items = [{'i':i,'i%3':i%3,'l':[i%4,i%5],'e':[]} for i in range(300)]
+    items.append({'other':1})
+    kw = dict(sorted_attributes=sorted_attributes)
+    DBs = [DictTable(copy.deepcopy(items),**kw),DictTable(copy.deepcopy(items),bitmaps=True,**kw)]
+    assert isinstance(DBs[1]._ix,dicttable._Bitmap)
+    assert DBs[1].copy()._bitmaps is not None
+    
+    queries = [
+        lambda DB:DB.Q.l == 3,
+        lambda DB:DB.Q.l != 3,
+        lambda DB:~(DB.Q.l == 3),
+        lambda DB:DB.Q.l == [3,4],
+        lambda DB:(DB.Q.l == 3) | (DB.Q.i < 10),
+        lambda DB:(DB.Q.l == 3) & (DB.Q.i >= 100),
+        lambda DB:DB.Q.i.between(10,200) & ~(DB.Q.l == 0),
+        lambda DB:DB.Q.filter(lambda item:item.get('i',0) % 7 == 0),
+        lambda DB:DB.Q.l,
+        lambda DB:~DB.Q.e,
+        lambda DB:DB.Q._index == 10,
+        lambda DB:DB.Q._index == -1,
+        lambda DB:DB.Q,
+        lambda DB:{'l':[]},
+        lambda DB:{'e':[]},
+        lambda DB:{'nope':1},
+    ]
+    def check():
+        for query in queries:
+            res = [sorted(DB._ixs(query(DB))) for DB in DBs]
+            assert res[0] == res[1]
+            assert DBs[0].count(query(DBs[0])) == DBs[1].count(query(DBs[1]))
+    check()
+    
+    for DB in DBs:
+        DB.remove(DB.Q.i < 50)
+        DB.update({'l':[1,2,3]},DB.Q.i > 250)
+        DB.pop(i=100)
+        DB.add([{'i':i,'l':0} for i in range(1000,1010)])
+    check()
+    for DB in DBs:
+        DB.reindex()
+    check()
+    for DB in DBs:
+        DB.vacuum()
+    check()
+    
+    # Only postings with enough of the items are bitmaps. The cache of 
+    # them is limited
+    DB = DBs[1]
+    assert isinstance(DB._posting('i%3',1),dicttable._Bitmap)
+    assert type(DB._posting('i',200)) is set
+    assert all(attrib != 'i' for attrib,_ in DB._bitmaps)
+    memory = dicttable._BITMAP_CACHE_MEMORY
+    try:
+        dicttable._BITMAP_CACHE_MEMORY = 1
+        DB.count(DB.Q.l != 3)
+        DB.count(DB.Q.l != 2)
+        assert list(DB._bitmaps) == [('l',2)] # Least recently used are evicted
+        assert DB._bitmaps_memory == DB._bitmaps[('l',2)][1]
+        check()
+    finally:
+        dicttable._BITMAP_CACHE_MEMORY = memory
+    DB.count(l=2)
+    DB.add({'i':2000,'l':2})
+    assert ('l',2) not in DB._bitmaps and DB.count(l=2) == DBs[0].count(l=2) + 1
+    assert DB._bitmaps_memory == sum(size for _,size in DB._bitmaps.values())
+    
+def test_query_planner():
+    DB = DictTable({'i':i,'two':i%2,'ten':i%10} for i in range(1000))
+    
+    calls = []
+    def filt(item):
+        calls.append(item['i'])
+        return item['i'] % 3 == 0
+    
+    # The filter is only applied to what is left after the rest of the query
+    assert DB.count(DB.Q.filter(filt) & (DB.Q.ten == 3) & (DB.Q.i < 100)) == 4
+    assert len(calls) == 10
+    
+    del calls[:]
+    assert DB.count(DB.Q.filter(filt),{'two':0},i=[10]) == 0
+    assert calls == [10]
+    
+    # Short-circuit once nothing is left
+    del calls[:]
+    assert DB.count(DB.Q.filter(filt),{'two':0},i=1) == 0
+    assert calls == []
+    assert DB.query_one(DB.Q.filter(filt) & ~(DB.Q.i >= 0)) is None
+    assert calls == []
+    
+    # Order of arguments doesn't matter
+    assert DB.count((DB.Q.i < 100) & (DB.Q.two == 1) & (DB.Q.i != 7)) == 49
+    assert DB.count((DB.Q.i != 7) & (DB.Q.two == 1) & (DB.Q.i < 100)) == 49
+    assert DB.count(~((DB.Q.i < 100) | (DB.Q.i > 900)) & (DB.Q.ten == 0)) == 81
+    
+    # Equality does not need every item with the attribute
+    attr_rows = DB._attr_rows
+    DB._attr_rows = None
+    assert DB.count(DB.Q.i == 4) == 1
+    assert DB.count((DB.Q.i == 4) | (DB.Q.two != 1)) == 500
+    with pytest.raises(TypeError):
+        DB.count(DB.Q.i) # Needs them all
+    DB._attr_rows = attr_rows
+    assert DB.count(DB.Q.i) == 1000
+    
+    # Nodes are simplified
+    assert (~~(DB.Q.i == 1))._node == ('eq','i',1)
+    assert (DB.Q & (DB.Q.i == 1))._node == ('eq','i',1)
+    assert DB.Q.i._node == ('attr','i')
+    assert (DB.Q.i == [1,2])._node == ('and',(('eq','i',1),('eq','i',2)))
+    
+    with pytest.raises(ValueError):
+        DB.Q & DictTable().Q
+
+@pytest.mark.parametrize("bitmaps", [False,True])
+def test_lazy_queries(bitmaps):
+    DB = DictTable(({'i':i,'two':i%2} for i in range(10000)),bitmaps=bitmaps)
+    
+    calls = []
+    def filt(item):
+        calls.append(item['i'])
+        return item['two'] == 1
+    
+    # Existence and first match stop early
+    assert DB.isin(DB.Q.filter(filt))
+    assert {'two':1} in DB
+    assert (DB.Q.filter(filt) & (DB.Q.i != 3)) in DB
+    assert DB.query_one(DB.Q.filter(filt),two=1)['two'] == 1
+    assert next(DB.query(DB.Q.filter(filt)))['two'] == 1
+    assert 0 < len(calls) < 500
+    
+    del calls[:]
+    assert not DB.isin(DB.Q.filter(filt),two=0) # Has to check them all
+    assert len(calls) == 5000
+    assert DB.query_one(DB.Q.filter(filt),two=0) is None
+    assert not DB.isin(DB.Q.filter(filt),two=3)
+    
+    with pytest.raises(KeyError):
+        DB.pop(DB.Q.filter(filt),two=0)
+    with pytest.raises(ValueError):
+        DB.pop(~(DB.Q.i == 3))
+    assert DB.pop((DB.Q.i < 10) & (DB.Q.i > 8))['i'] == 9
+    
+    # Can change the DB while iterating a query
+    for item in DB.query(two=1):
+        if item['i'] % 3 == 0:
+            DB.remove(i=item['i'])
+        else:
+            DB.update({'two':-1},i=item['i'])
+    assert DB.count(two=1) == 0
+    assert DB.count(two=-1) == 3333
+    assert len(DB) == 10000 - 1 - 1666 # 9 was popped
+    
+    for item in DB.query(DB.Q.two != 0):
+        DB.add({'i':-item['i'],'two':2})
+    assert DB.count(two=2) == 3333
+    
+    # Full queries still match count
+    assert len(list(DB.query((DB.Q.two != 0) & DB.Q.filter(filt)))) == 0
+    assert len(list(DB.query(~(DB.Q.two == 0)))) == DB.count(DB.Q.two != 0) == 3333*2
+
+@pytest.mark.parametrize("bitmaps", [False,True])
+def test_query_cache(bitmaps):
+    DB = DictTable(({'i':i,'two':i%2,'three':i%3} for i in range(100)),
+                   bitmaps=bitmaps,cache_size=3)
+    
+    assert DB.count(two=1) == 50
+    assert DB.count(two=1) == 50
+    info = DB.cache_info()
+    assert (info['hits'],info['misses'],info['size']) == (1,1,1)
+    assert info['maxsize'] == 3 and info['memory'] > 0
+    
+    # Order of 'and' does not matter. Filters are not cached
+    assert DB.count((DB.Q.three == 0) & (DB.Q.two == 1)) == 17
+    assert DB.count((DB.Q.two == 1) & (DB.Q.three == 0)) == 17
+    assert DB.count(DB.Q.filter(lambda item:item['two'])) == 50
+    info = DB.cache_info()
+    assert (info['hits'],info['misses'],info['size']) == (2,2,2)
+    
+    # Only invalidated by changes to dependencies
+    DB.update({'three':-1},i=0)
+    info = DB.cache_info()
+    assert info['invalidations'] == 1 and info['size'] == 2 # Added i=0
+    assert DB.count(two=1) == 50
+    assert DB.cache_info()['hits'] == 3
+    assert DB.count((DB.Q.three == 0) & (DB.Q.two == 1)) == 17 # i=0 has two=0
+    
+    # Negations depend on the items
+    assert DB.count(DB.Q.two != 1) == 50
+    DB.add({'i':100,'two':0})
+    assert DB.count(DB.Q.two != 1) == 51
+    assert DB.count(two=1) == 50 
+    
+    # Can modify while iterating a cached result
+    assert DB.count(two=0) == 51
+    for item in DB.query(two=0):
+        DB.remove(i=item['i'])
+    assert DB.count(two=0) == 0
+    
+    # LRU eviction
+    for v in range(5):
+        DB.count(three=v)
+    info = DB.cache_info()
+    assert info['size'] == 3 and info['evictions'] > 0
+    
+    DB.vacuum()
+    assert DB.cache_info()['size'] == DB.cache_info()['memory'] == 0
+    assert DB.count(two=1) == 50
+    
+    DB.cache_clear()
+    assert DB.cache_info()['size'] == 0
+    assert DB.copy().cache_info()['maxsize'] == 3
+    assert DictTable().cache_info()['maxsize'] == 0
+    
+    # Changes to attributes that are not indexed are not tracked so 
+    # queries on them are not cached
+    for kwargs in [{'fixed_attributes':['a']},{'exclude_attributes':['b']}]:
+        DB = DictTable([{'a':1,'b':5}],bitmaps=bitmaps,cache_size=10,**kwargs)
+        assert DB.count(DB.Q.b > 3) == 1
+        assert DB.count(DB.Q.vfilter(lambda b: b > 3,'b')) == 1
+        DB.add({'a':2,'b':10})
+        assert DB.count(DB.Q.b > 3) == 2
+        assert DB.count(DB.Q.vfilter(lambda b: b > 3,'b')) == 2
+        DB.update({'b':0},a=1)
+        assert DB.count(DB.Q.b > 3) == 1
+        assert DB.count(DB.Q.vfilter(lambda b: b > 3,'b')) == 1
+        assert DB.count((DB.Q.b > 3) & (DB.Q.a == 2)) == 1
+        assert DB.count(DB.Q.a == 2) == DB.count(DB.Q.a == 2) == 1
+        assert all('b' not in dicttable._node_deps(key) for key in DB._cache)
+
+    # Nor vfilters since the function may depend on other state
+    DB = DictTable([{'b':i} for i in range(10)],bitmaps=bitmaps,cache_size=10)
+    limit = [3]
+    vf = lambda b: b > limit[0]
+    assert DB.count(DB.Q.vfilter(vf,'b') & (DB.Q.b != 0)) == 6
+    limit[0] = 7
+    assert DB.count(DB.Q.vfilter(vf,'b') & (DB.Q.b != 0)) == 2
+    assert DB.cache_info()['size'] == 0
+
+def test_query_versions():
+    DB = DictTable([{'i':i,'two':i%2,'three':i%3} for i in range(30)],
+                   sorted_attributes=['i'])
+    
+    Qtwo = DB.Q.two == 1
+    Qi = DB.Q.i < 10
+    Qnot = DB.Q.three != 0
+    Qfilt = DB.Q.filter(lambda item:item['two'] == 1)
+    
+    # Changes to other attributes do not invalidate
+    DB.update({'three':-1},DB.Q.i==0)
+    DB.add_fixed_attribute('new',0)
+    assert DB.count(Qtwo) == 15
+    assert DB.count(Qi) == 10
+    
+    # Combining with a newer query is also up-to-date
+    Qthree = DB.Q.three == 2
+    DB.update({'i':-1},i=29)
+    Qcomb = (DB.Q.two == 1) & Qthree
+    assert DB.count(Qcomb) == 5
+    
+    for Q in [Qi,Qnot,Qfilt]: # i changed, filters depend on everything
+        with pytest.raises(ValueError):
+            DB.count(Q)
+    
+    # Adding or removing items invalidates negations but not equality
+    Qnot = DB.Q.three != 0
+    DB.add({'i':100})
+    with pytest.raises(ValueError):
+        DB.count(Qnot)
+    assert DB.count(Qtwo) == 15
+    del DB[DB.Q.i == 100]
+    assert DB.count(Qtwo & (DB.Q.three == 1)) == 5 
+    
+    # Vacuum changes the indices so everything is out of date
+    DB.vacuum()
+    with pytest.raises(ValueError):
+        DB.count(Qtwo)
+    with pytest.raises(ValueError):
+        DB.count(Qcomb & (DB.Q.two == 1))
+    
+@pytest.mark.parametrize("bitmaps", [False,True])
+def test_save_load(bitmaps):
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir,'db.dt')
+    
+    items = [{'i':i,'two':i%2,'l':[i%3,'x'],'e':[]} for i in range(20)]
+    DB = DictTable(items,exclude_attributes='e',sorted_attributes='i',
+                   bitmaps=bitmaps,cache_size=4)
+    DB.add_fixed_attribute('new',0)
+    del DB[DB.Q.i==3]
+    assert DB.count(two=1) == 9
+    DB.save(path)
+    
+    DB2 = DictTable.load(path)
+    assert DB2._lookup == DB._lookup
+    assert list(DB2) == list(DB)
+    assert DB2._list[3] is None
+    assert DB2.exclude_attributes == {'e'}
+    assert DB2.fixed_attributes == DB.fixed_attributes
+    assert DB2.sorted_attributes == ['i']
+    assert DB2.cache_info()['size'] == 0
+    
+    # Works the same and is independent
+    assert DB2.count(DB2.Q.i < 5) == 4
+    assert DB2.count(DB2.Q.two != 1) == 10
+    assert DB2.count(l=[]) == 0
+    with pytest.raises(ValueError): # Another DB's Query
+        DB2.count(DB.Q.two==1)
+    DB2.update({'two':5},i=0)
+    DB2.add({'i':100})
+    assert DB2.count(two=5) == 1 and len(DB2) == 20
+    assert DB.count(two=5) == 0 and len(DB) == 19
+    DB2.vacuum()
+    assert DB2.query_one(two=5)['i'] == 0
+    
+    # Not a DictTable
+    with open(path,'wb') as fobj:
+        fobj.write(b'not a dicttable')
+    with pytest.raises(ValueError):
+        DictTable.load(path)
+    
+@pytest.mark.parametrize("bitmaps", [False,True])
+def test_mapped(bitmaps):
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir,'db.dtm')
+    
+    items = [{'i':i,'two':i%2,'l':[i%3,'x'],'e':[]} for i in range(200)]
+    DB = DictTable(items,sorted_attributes='i')
+    del DB[DB.Q.i==3]
+    DB.save_mapped(path)
+    DB.vacuum() # Same indices as saved
+    
+    M = dicttable.MappedDictTable(path,bitmaps=bitmaps,cache_size=2)
+    assert len(M) == len(DB) == 199
+    assert list(M) == list(DB)
+    assert M.attributes == DB.attributes
+    assert M.sorted_attributes == ['i']
+    assert M[3] == DB[3]
+    
+    for Q in ['two','i','l','e']:
+        assert M.cardinality(Q) == DB.cardinality(Q)
+    
+    queries = [lambda D: D.Q.two == 1,
+               lambda D: D.Q.two != 1,
+               lambda D: (D.Q.l == 1) | (D.Q.two == 0),
+               lambda D: (D.Q.l == 'x') & (D.Q.i == 7),
+               lambda D: D.Q.i.between(10,20),
+               lambda D: ~(D.Q.l == 2) & (D.Q.i > 150),
+               lambda D: D.Q.filter(lambda item:item['i'] % 7 == 0),
+               lambda D: D.Q.l,
+               lambda D: D.Q.missing == 1]
+    key = lambda item:item['i']
+    for query in queries:
+        assert sorted(M.query(query(M)),key=key) == sorted(DB.query(query(DB)),key=key)
+        assert M.count(query(M)) == DB.count(query(DB))
+        assert M.isin(query(M)) == DB.isin(query(DB))
+    assert M.query_one(two=0,l=2)['i'] == 2
+    assert M.count(e=[]) == 199
+    assert {'i':3} not in M
+    
+    for method in [M.add,M.remove,M.pop,M.update,M.reindex,M.add_fixed_attribute]:
+        with pytest.raises(ValueError):
+            method({'i':1})
+    with pytest.raises(ValueError):
+        del M[{'i':2}]
+    
+    # Copy is a normal DictTable
+    DB2 = M.copy()
+    DB2.add({'i':1000})
+    assert len(DB2) == 200
+    assert DB2.count(DB2.Q.i > 500) == 1
+    
+    M.close()
+    with open(path,'wb') as fobj:
+        fobj.write(b'not a mapped dicttable')
+    with pytest.raises(ValueError):
+        dicttable.MappedDictTable(path)
+    
+def test_journal():
+    tmpdir = tempfile.mkdtemp()
+    snapshot = os.path.join(tmpdir,'db.dt')
+    journal = os.path.join(tmpdir,'db.journal')
+    
+    DB = DictTable([{'i':i,'two':i%2} for i in range(10)],vacuum_threshold=0.3)
+    DB.open_journal(snapshot,journal,sync_every=3)
+    
+    DB.add({'i':10,'two':0})
+    DB.add([{'i':11,'two':1},{'i':12,'two':0,'new':[]}])
+    DB.update({'two':5,'other':1},i=1)
+    DB.add_sorted_attribute('i')
+    del DB[DB.Q.i < 3]
+    DB.pop(i=4) # Auto vacuum
+    DB.add_fixed_attribute('i')
+    assert DB._journal.pending > 0 # Not all synced
+    DB.sync()
+    assert DB._journal.pending == 0
+    
+    def check(DB2):
+        assert sorted(DB2,key=lambda item:item['i']) == sorted(DB,key=lambda item:item['i'])
+        assert DB2._lookup == DB._lookup
+        assert list(DB2) == list(DB)
+        assert DB2.sorted_attributes == DB.sorted_attributes
+        assert DB2.fixed_attributes == DB.fixed_attributes
+        assert DB2.count(DB2.Q.i > 10) == 2
+        
+    # Recover from a "crash" (nothing closed)
+    DB2 = DictTable.recover(snapshot,journal)
+    check(DB2)
+    
+    # A partial last entry is dropped and the journal continues after it
+    DB2.close_journal()
+    size = os.path.getsize(journal)
+    with open(journal,'ab') as fobj:
+        fobj.write(b'\x10\x00\x00\x00partial')
+    DB2 = DictTable.recover(snapshot,journal)
+    check(DB2)
+    assert os.path.getsize(journal) == size
+    DB2.add({'i':100})
+    DB2.close_journal()
+    DB3 = DictTable.recover(snapshot,journal)
+    assert len(DB3) == len(DB) + 1
+    DB3.close_journal()
+    
+    # Checkpoint saves a snapshot and empties the journal
+    DB.checkpoint()
+    assert os.path.getsize(journal) == 16
+    DB.update({'two':6},i=3)
+    DB.close_journal()
+    DB.update({'two':7},i=3) # Not journaled
+    DB4 = DictTable.recover(snapshot,journal)
+    assert DB4.query_one(i=3)['two'] == 6
+    
+    # A journal from before the snapshot (crash during checkpoint) is 
+    # not replayed again
+    DB4.close_journal()
+    with open(journal,'rb') as fobj:
+        old_journal = fobj.read()
+    DB4.checkpoint()
+    with open(journal,'wb') as fobj:
+        fobj.write(old_journal)
+    DB5 = DictTable.recover(snapshot,journal)
+    assert DB5._lookup == DB4._lookup
+    DB5.close_journal()
+
+    # Everything listed in open_journal() is replayed
+    DB = DictTable([{'i':i,'s':'v%d' % i} for i in range(10)],primary_key='i')
+    DB.open_journal(snapshot,journal)
+    DB.upsert({'i':3,'s':'new'})
+    DB.add_string_attribute('s')
+    DB.add_numeric_attribute('i')
+    DB.create_index(['i','s'])
+    DB2 = DictTable.recover(snapshot,journal)
+    assert DB2._lookup == DB._lookup and DB2.get(3)['s'] == 'new'
+    assert DB2.string_attributes == ['s'] and DB2.numeric_attributes == ['i']
+    assert list(DB2._composites) == list(DB._composites) == [('i','s')]
+    DB.close_journal()
+    DB2.close_journal()
+
+    with pytest.raises(ValueError):
+        DictTable().checkpoint()
+    
+def test_journal_killed():
+    tmpdir = tempfile.mkdtemp()
+    snapshot = os.path.join(tmpdir,'db.dt')
+    journal = os.path.join(tmpdir,'db.journal')
+    
+    # Changes are in the journal right away even if the process is killed
+    # before they are synced
+    code = '''
+import sys,time
+sys.path.insert(0,{path!r})
+from dicttable import DictTable
+DB = DictTable([{{'i':0}}])
+DB.open_journal({snapshot!r},{journal!r},sync_every=100,sync_interval=60)
+for i in range(1,11):
+    DB.add({{'i':i}})
+print('ready',flush=True)
+time.sleep(60)
+'''.format(path=os.path.dirname(os.path.abspath(dicttable.__file__)),
+             snapshot=snapshot,journal=journal)
+    proc = subprocess.Popen([sys.executable,'-c',code],stdout=subprocess.PIPE)
+    try:
+        assert proc.stdout.readline().strip() == b'ready'
+    finally:
+        proc.kill()
+        proc.wait()
+        proc.stdout.close()
+    DB = DictTable.recover(snapshot,journal)
+    assert sorted(item['i'] for item in DB) == list(range(11))
+    
+    # And synced by the timer when idle
+    DB.close_journal()
+    DB.open_journal(snapshot,journal,sync_every=100,sync_interval=0.05)
+    DB.add({'i':11})
+    assert DB._journal.pending == 1
+    for _ in range(100):
+        if not DB._journal.pending:
+            break
+        time.sleep(0.02)
+    assert DB._journal.pending == 0
+    DB.close_journal()
+    assert DB._journal is None
+    
+def test_compact_rows():
+    items = [{'i':i,'two':i%2,'l':[i%3,'x']} for i in range(20)]
+    items.append({'i':20,'other':'a'})
+    DB = DictTable(items,compact_rows=True,sorted_attributes='i')
+    DB.add({'i':21,'two':1,'l':[]})
+    DB.add([{'i':22,'two':0,'l':[1]}])
+    
+    assert len(DB._schemas) == 2 # Shared
+    assert list(DB) == items + [{'i':21,'two':1,'l':[]},{'i':22,'two':0,'l':[1]}]
+    
+    item = DB.query_one(i=3)
+    assert item == {'i':3,'two':1,'l':[0,'x']}
+    assert item['two'] == 1 and item.get('missing') is None and 'l' in item
+    assert dict(item) == item.copy() == items[3]
+    assert type(item.copy()) is dict
+    assert sorted(item.keys()) == ['i','l','two']
+    with pytest.raises(KeyError):
+        item['missing']
+    with pytest.raises(TypeError): # read-only
+        item['two'] = 3
+    
+    # Queries
+    assert DB.count(two=1) == 11
+    assert DB.count(l=0) == 7
+    assert DB.count(l=[]) == 1
+    assert DB.count(DB.Q.filter(lambda item:item.get('other') == 'a')) == 1
+    assert DB.count(DB.Q.i >= 20) == 3
+    
+    # update replaces the record (and may change the schema)
+    DB.update({'two':5,'new':True},i=3)
+    assert DB.query_one(two=5) == {'i':3,'two':5,'l':[0,'x'],'new':True}
+    assert len(DB._schemas) == 3
+    assert items[3]['two'] == 1 # The original is not changed
+    
+    assert DB.pop(i=4) == items[4]
+    DB.remove(i=5)
+    DB.vacuum()
+    assert len(DB) == 21
+    
+    DB2 = DB.copy()
+    assert DB2._schemas is not None
+    assert list(DB2) == list(DB)
+    
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir,'db.dt')
+    DB.save(path)
+    DB3 = DictTable.load(path)
+    assert list(DB3) == list(DB)
+    DB3.update({'two':6},i=6)
+    assert DB3.query_one(two=6)['i'] == 6
+    
+    # Not a tuple (so not mistaken for a list of items) and real dicts
+    # when asked
+    assert not isinstance(item,tuple) and not hasattr(item,'__dict__')
+    with pytest.raises(TypeError):
+        json.dumps(item)
+    dumped = json.dumps(list(DB.items(dicts=True)))
+    assert json.loads(dumped) == list(DB)
+    assert list(DictTable(json.loads(dumped),compact_rows=True)) == list(DB)
+    assert all(type(item) is dict for item in DB.query(DB.Q.i < 10,dicts=True))
+    assert [item['i'] for item in DB.query(two=0,dicts=True)] == \
+           [item['i'] for item in DB.query(two=0)]
+    DB4 = DictTable(compact_rows=True)
+    DB4.add(tuple(DB)) # Records can be added
+    assert list(DB4) == list(DB)
+    
+@pytest.mark.parametrize("compact_rows", [False,True])
+def test_intern_values(compact_rows):
+    def make(i):
+        # Build new (equal) strings each time
+        return {'i':i,'host':''.join(['h',str(i%3)]),'tags':[''.join(['t',str(i%2)])],
+                'num':1.0 if i == 0 else 1,'skip':''.join(['s','1'])}
+    DB = DictTable([make(i) for i in range(10)],exclude_attributes='skip',
+                   intern_values=True,compact_rows=compact_rows)
+    DB.add(make(10))
+    DB.add([make(11)])
+    
+    hosts = [item['host'] for item in DB.query(host='h1')]
+    assert len(hosts) == 4 and all(host is hosts[0] for host in hosts)
+    tags = [item['tags'][0] for item in DB.query(tags='t1')]
+    assert len(tags) == 6 and all(tag is tags[0] for tag in tags)
+    assert DB[0]['skip'] is not DB[1]['skip'] # Not indexed
+    
+    # Equal values of different types are not mixed
+    assert type(DB[0]['num']) is float and type(DB[1]['num']) is int
+    assert DB.count(num=1) == 12
+    
+    # Update values too
+    DB.update({'host':''.join(['h','2'])},i=0)
+    assert DB[0]['host'] is DB[2]['host']
+    assert DB.count(host='h2') == 5
+    
+    if not compact_rows: # Changed in place and reindexed
+        DB[1]['host'] = ''.join(['h','2'])
+        DB.reindex('host')
+        assert DB[1]['host'] is DB[2]['host']
+    
+    # Values that are no longer used are dropped eventually
+    for i in range(3000):
+        DB.add({'i':-1,'host':'other{}'.format(i)})
+        DB.remove(i=-1)
+    assert len(DB._interned) < 2100
+    assert DB.copy()._interned is not None
+    
+@pytest.mark.parametrize("bitmaps", [False,True])
+def test_numeric_attributes(bitmaps):
+    items = [{'i':i,'price':i*0.5,'qty':i%7} for i in range(200)]
+    items += [{'i':200,'price':[1,150]},
+              {'i':201,'price':'free','qty':1},
+              {'i':202,'qty':3},
+              {'i':203,'price':2**60,'qty':1},
+              {'i':204,'price':True,'qty':2}]
+    
+    queries = [lambda D: D.Q.price < 10,
+               lambda D: D.Q.price.between(5,20,inclusive=(False,True)),
+               lambda D: D.Q.price >= 90,
+               lambda D: (D.Q.price > 10) & (D.Q.qty == 3),
+               lambda D: (D.Q.i < 50) & (D.Q.price <= 5),
+               lambda D: ~(D.Q.price < 50)]
+    
+    def check(DB):
+        # Same as with a sorted index (only numbers are compared)
+        ref = DictTable(list(DB),sorted_attributes=['price','qty'])
+        for query in queries:
+            assert (sorted(item['i'] for item in DB.query(query(DB))) 
+                    == sorted(item['i'] for item in ref.query(query(ref))))
+            assert DB.count(query(DB)) == ref.count(query(ref))
+        
+        vf = DB.Q.vfilter(lambda price,qty: (price*qty > 300) | (qty == 6),'price','qty')
+        expected = [item['i'] for item in DB 
+                    if all(dicttable._is_number(item.get(a)) for a in ['price','qty']) 
+                    and (item['price']*item['qty'] > 300 or item['qty'] == 6)]
+        assert sorted(item['i'] for item in DB.query(vf)) == sorted(expected)
+        vf = DB.Q.vfilter(lambda price:price > 95,'price')
+        assert DB.count(vf & (DB.Q.qty == 2)) == 2 # i = 198 and 2**60 
+        
+    DB = DictTable(items,numeric_attributes=['price','qty'],bitmaps=bitmaps)
+    assert DB.numeric_attributes == ['price','qty']
+    if dicttable.np is not None:
+        assert not DB._is_scan(('range','price',1,2,True,True))
+    check(DB)
+    
+    # Changes 
+    DB.update({'price':1000},i=3)
+    DB.update({'price':[3,4]},i=4)
+    DB.update({'price':'x'},i=5)
+    DB.remove(DB.Q.price < 2)
+    DB.add({'i':300,'price':7,'qty':6})
+    DB.add([{'i':301,'price':8},{'i':302}])
+    check(DB)
+    DB.vacuum()
+    check(DB)
+    DB[0]['price'] = 2000
+    DB.reindex('price')
+    check(DB)
+    check(DB.copy())
+    
+    # Without NumPy
+    np = dicttable.np
+    try:
+        dicttable.np = None
+        DB = DictTable(items,numeric_attributes=['price','qty'],bitmaps=bitmaps)
+        assert not DB._columns and DB.numeric_attributes == ['price','qty']
+        check(DB)
+    finally:
+        dicttable.np = np
+    
+    with pytest.raises(ValueError):
+        DB.Q.vfilter(lambda: True)
+    
+@pytest.mark.parametrize("bitmaps", [False,True])
+def test_parallel_build(bitmaps):
+    items = [{'i':i,'a':i%7,'b':[i%3,i%5],'c':[] if i%4 else 'x%d' % (i%11)} 
+             for i in range(500)]
+    items[10]['d'] = 1
+    
+    minitems = dicttable._PARALLEL_MIN_ITEMS
+    try:
+        dicttable._PARALLEL_MIN_ITEMS = 0 # So it is used for this size
+        for kwargs in [{},{'fixed_attributes':['i','b','c']},
+                       {'sorted_attributes':['i','c'],'exclude_attributes':['a']}]:
+            DB0 = DictTable(items,bitmaps=bitmaps,**kwargs)
+            DB = DictTable(items,bitmaps=bitmaps,workers=3,**kwargs)
+            assert DB._lookup == DB0._lookup
+            assert DB._counts == DB0._counts
+            assert DB._sorted == DB0._sorted
+            
+            # Uses this DB's [] and then the index is ready to be added to
+            if 'c' in DB._lookup:
+                assert any(val is DB._empty for val in DB._lookup['c'])
+            DB.add(items)
+            DB0.add(items)
+            assert DB._lookup == DB0._lookup
+            
+            DB.remove(i=3)
+            DB0.remove(i=3)
+            DB.reindex()
+            DB0.reindex()
+            assert DB._lookup == DB0._lookup
+            
+            for D in [DB,DB0]:
+                assert D.count(i=3) == 0
+                if 'd' in D._lookup: # Not with fixed_attributes
+                    assert D.query_one(d=1)['i'] == 10
+            q = lambda D: (D.Q.b == 2) & (D.Q.c == [])
+            assert list(DB.query(q(DB))) == list(DB0.query(q(DB0)))
+            assert list(DB.query(c='x3')) == list(DB0.query(c='x3'))
+        assert DB.copy().workers == 3
+        
+        # Builds from several threads at once each index their own items
+        DBs = [DictTable([{'i':i + 1000*n,'n':n} for i in range(300)],
+                         bitmaps=bitmaps,workers=2) for n in range(4)]
+        threads = [threading.Thread(target=D.reindex) for D in DBs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for n,D in enumerate(DBs):
+            assert D._lookup == DictTable(list(D))._lookup
+            assert D.count(n=n) == 300 and D.count(i=1000*n + 5) == 1
+    finally:
+        dicttable._PARALLEL_MIN_ITEMS = minitems
+    
+@pytest.mark.parametrize("threads", [None,0])
+def test_sharded(threads):
+    items = [{'i':i,'a':i%7,'b':[i%3,i%5],'k':'key%d' % (i%13)} for i in range(300)]
+    DB0 = DictTable(copy.deepcopy(items))
+    DB = dicttable.ShardedDictTable('k',copy.deepcopy(items),shards=4,
+                                    threads=threads,sorted_attributes=['i'])
+    assert len(DB) == len(DB0) == 300
+    assert sum(len(shard) > 0 for shard in DB.shards) == 4
+    assert DB.attributes == DB0.attributes
+    
+    def check():
+        queries = [lambda D: D.Q.k == 'key3',
+                   lambda D: (D.Q.k == 'key3') | (D.Q.k == 'key4'),
+                   lambda D: (D.Q.k == 'key3') & (D.Q.a == 2),
+                   lambda D: (D.Q.k == 'key3') & (D.Q.k == 'key4'),
+                   lambda D: D.Q.a == 2,
+                   lambda D: (D.Q.i >= 100) & (D.Q.b != 2),
+                   lambda D: D.Q.filter(lambda item: item['i'] % 10 == 0),
+                   lambda D: {'b':[1,2]}]
+        for q in queries:
+            items0 = sorted(DB0.query(q(DB0)),key=lambda item: item['i'])
+            assert sorted(DB.query(q(DB)),key=lambda item: item['i']) == items0
+            assert DB.count(q(DB)) == len(items0)
+            assert DB.isin(q(DB)) == bool(items0)
+            assert (DB.query_one(q(DB)) is None) == (not items0)
+        assert sorted(DB,key=lambda item: item['i']) == sorted(DB0,key=lambda item: item['i'])
+    check()
+    
+    # Routed to one shard
+    node,shards = DB._node(k='key3',a=2)
+    assert len(shards) == 1 and 'key3' in [item['k'] for item in shards[0]]
+    assert len(DB._node((DB.Q.k == 'key3') & (DB.Q.k == 'key4'))[1]) <= 1
+    assert len(DB._node(a=2)[1]) == 4
+    
+    for D in [DB,DB0]:
+        D.add([{'i':300,'a':1,'b':[],'k':'key1'},{'i':301,'a':1,'b':2,'k':'new'}])
+        D.update({'a':100},k='key5')
+        D.update({'k':'key6','a':101},D.Q.i < 20) # Moves shards
+        D.remove(a=3)
+        assert D.pop(i=301)['k'] == 'new'
+        D.reindex('a')
+    assert len(DB) == len(DB0)
+    assert DB.count(k='key6') == DB0.count(k='key6')
+    assert all(item['k'] == 'key6' for item in DB.shards[DB._shard_ix('key6')].query(a=101))
+    check()
+    
+    with pytest.raises(KeyError):
+        DB.pop(i=301)
+    with pytest.raises(ValueError):
+        DB.pop(a=101)
+    with pytest.raises(ValueError):
+        DB.remove(i=-1)
+    with pytest.raises(ValueError):
+        DB.update({'a':1},i=-1)
+    with pytest.raises(ValueError):
+        DB.add({'i':1000})
+    with pytest.raises(ValueError):
+        DB.add({'i':1000,'k':['key1']})
+    with pytest.raises(ValueError):
+        DB.count(DB.Q._index == 0)
+    assert {'k':'key6'} in DB
+    assert DB[{'i':5}]['k'] == 'key6'
+    
+    # Query objects are only out of date if what they use changed
+    q = DB.Q.a == 1
+    DB.update({'i':-2},i=2)
+    assert DB.count(q) == DB0.count(a=1)
+    DB.update({'a':1},i=-2)
+    with pytest.raises(ValueError):
+        DB.count(q)
+    with pytest.raises(ValueError):
+        DB.count(DB0.Q.a == 1)
+    
+    assert dicttable._stable_hash('key1') == dicttable._stable_hash(u'key1')
+    assert dicttable._stable_hash(1) == dicttable._stable_hash(1.0) == dicttable._stable_hash(True)
+    assert dicttable._stable_hash((1,'a')) == dicttable._stable_hash((1.0,'a'))
+    DB.close()
+
+    # primary_key is unique across shards
+    PDB = dicttable.ShardedDictTable('k',copy.deepcopy(items),shards=4,threads=threads,
+                                     primary_key='i')
+    with pytest.raises(dicttable.DuplicateKeyError):
+        PDB.add({'i':5,'k':'other%d' % PDB._shard_ix('key5')})
+    with pytest.raises(dicttable.DuplicateKeyError):
+        PDB.add([{'i':1000,'k':'key1'},{'i':1000,'k':'key2'}])
+    with pytest.raises(dicttable.DuplicateKeyError):
+        PDB.update({'i':6},i=7)
+    with pytest.raises(dicttable.DuplicateKeyError):
+        PDB.update({'i':6,'k':'key9'},i=7)
+    with pytest.raises(dicttable.DuplicateKeyError):
+        dicttable.ShardedDictTable('k',[{'i':1,'k':'key1'},{'i':1,'k':'key2'}],primary_key='i')
+    PDB.update({'i':-7,'k':'key9'},i=7)
+    assert PDB.query_one(i=-7)['k'] == 'key9' and PDB.count(i=7) == 0
+
+    # A failed move is rolled back
+    source = PDB.shards[PDB._shard_ix('key3')]
+    target = PDB.shards[PDB._shard_ix('key4')]
+    remove = source.remove
+    def fail(*args,**kwargs):
+        raise RuntimeError('failed')
+    source.remove = fail
+    ntarget = len(target)
+    with pytest.raises(RuntimeError):
+        PDB.update({'k':'key4'},k='key3')
+    source.remove = remove
+    assert PDB.count(k='key3') == 23 and PDB.count(k='key4') == 23 and len(PDB) == 300
+    assert len(target) == ntarget and target.count(k='key3') == 0
+    
+    # Or adding to the target or updating the items already in it
+    before = copy.deepcopy(sorted(PDB,key=lambda item: item['i']))
+    for method in ['add','update']:
+        setattr(target,method,fail)
+        with pytest.raises(RuntimeError):
+            PDB.update({'k':'key4','a':-1},(PDB.Q.k == 'key3') | (PDB.Q.k == 'key4'))
+        delattr(target,method)
+        assert sorted(PDB,key=lambda item: item['i']) == before
+        assert PDB.count(a=-1) == 0 and len(target) == ntarget
+    PDB.update({'k':'key4'},k='key3')
+    assert PDB.count(k='key3') == 0 and PDB.count(k='key4') == 46 and len(PDB) == 300
+
+    # Shards are not reindexed with workers from the threads
+    workers = []
+    for shard in PDB.shards:
+        shard.workers = 2
+        shard._build_maps = lambda items,ix0,attributes=None,shard=shard: (
+            workers.append(shard.workers) or DictTable._build_maps(shard,items,ix0,attributes))
+    PDB.reindex()
+    assert workers == ([None]*4 if PDB.threads > 1 else [2]*4)
+    assert all(shard.workers == 2 for shard in PDB.shards)
+    PDB.close()
+
+@pytest.mark.parametrize("bitmaps", [False,True])
+def test_string_queries(bitmaps):
+    names = ['Hello','Shell','yellow','he','Bell','ell',u'caf\xe9s']
+    items = [{'i':i,'path':'/var/log/{}'.format(i) if i % 3 else '/usr/{}'.format(i),
+              'name':names[i % len(names)]} for i in range(100)]
+    items += [{'i':100,'path':['/var/x','/tmp/x'],'name':5},
+              {'i':101,'path':[],'name':None},
+              {'i':102}]
+    
+    def expected(D,attrib,func):
+        return sorted(item['i'] for item in D if attrib in item 
+                      and any(isinstance(val,str) and func(val) 
+                              for val in (item[attrib] if isinstance(item[attrib],list) else [item[attrib]])))
+    def check(D):
+        tests = [('path','startswith','/var/'),('path','startswith','/var/log/1'),
+                 ('path','startswith',''),('path','startswith','/nope'),
+                 ('path','contains','log/2'),('path','contains','x'),
+                 ('name','contains','ell'),('name','contains','el'),
+                 ('name','contains','Hell'),('name','contains','zzz'),
+                 ('name','contains',u'\xe9s'),('name','startswith','he')]
+        for attrib,op,sub in tests:
+            if op == 'startswith':
+                func = lambda val: val.startswith(sub)
+            else:
+                func = lambda val: sub in val
+            q = getattr(getattr(D.Q,attrib),op)(sub)
+            assert sorted(item['i'] for item in D.query(q)) == expected(D,attrib,func)
+        
+        # Combines with other conditions
+        q = (D.Q.path.startswith('/var/') & D.Q.name.contains('ell')) | (D.Q.i == 0)
+        assert sorted(item['i'] for item in D.query(q)) == sorted(
+            set(expected(D,'path',lambda val: val.startswith('/var/'))) 
+              & set(expected(D,'name',lambda val: 'ell' in val)) | {0})
+        q = ~D.Q.name.contains('ell')
+        assert D.count(q) == len(D) - len(expected(D,'name',lambda val: 'ell' in val))
+    
+    for kwargs in [{},{'string_attributes':['path','name']}]:
+        DB = DictTable(copy.deepcopy(items),bitmaps=bitmaps,**kwargs)
+        check(DB)
+        DB.add([{'i':200,'path':'/var/new','name':'fell'},{'i':201,'path':'/var/new'}])
+        DB.update({'name':'smell'},i=1)
+        DB.update({'path':['/var/a','/opt/b']},i=2)
+        DB.remove(DB.Q.name == 'Shell')
+        check(DB)
+        if kwargs:
+            strings = DB._strings
+            DB.add_string_attribute('path')
+            DB.add_string_attribute('name')
+            for attrib in ['path','name']:
+                assert strings[attrib].keys == DB._strings[attrib].keys
+                assert strings[attrib].grams == DB._strings[attrib].grams
+            DB.reindex()
+            check(DB)
+            assert DB.copy().string_attributes == ['name','path']
+    
+    with pytest.raises(ValueError):
+        DB.Q.name.contains(3)
+    with pytest.raises(ValueError):
+        DictTable(fixed_attributes=['i']).add_string_attribute('name')
+    
+@pytest.mark.parametrize("bitmaps", [False,True])
+def test_composite_index(bitmaps):
+    items = [{'i':i,'a':i%5,'b':i%7,'c':[i%2,i%3] if i % 4 else [],'d':i%11} 
+             for i in range(300)]
+    items.append({'i':300,'a':1}) # Missing b
+    
+    def check(DB):
+        DB0 = DictTable(list(DB))
+        queries = [lambda D: {'a':1,'b':2},
+                   lambda D: {'a':1,'b':2,'d':3},
+                   lambda D: {'a':1,'c':1},
+                   lambda D: {'a':1,'c':[0,1]},
+                   lambda D: {'a':1,'c':[]},
+                   lambda D: (D.Q.a == 1) & (D.Q.b == 2) & (D.Q.i > 50),
+                   lambda D: (D.Q.a == 1) & ((D.Q.b == 2) | (D.Q.b == 3)),
+                   lambda D: ~((D.Q.a == 1) & (D.Q.b == 2)),
+                   lambda D: {'a':1,'b':'x'}]
+        for q in queries:
+            assert sorted(item['i'] for item in DB.query(q(DB))) == \
+                   sorted(item['i'] for item in DB0.query(q(DB0)))
+        
+        # Same as building it again
+        for attribs,cmap in DB._composites.items():
+            DB._build_composite(attribs) 
+            assert DB._composites[attribs] == cmap
+    
+    DB = DictTable(copy.deepcopy(items),composite_indexes=[('a','b')],bitmaps=bitmaps)
+    DB.create_index(['a','c'])
+    assert DB.composite_indexes == [('a','b'),('a','c')]
+    check(DB)
+    
+    # The planner uses it
+    node = DB._query_node(a=1,b=2,d=3)
+    plan = DB._plan(node[1])
+    assert ('composite',('a','b'),(1,2)) in plan and len(plan) == 2
+    plan = DB._plan(DB._query_node(a=1,c=[0,1])[1])
+    assert set(plan) == {('composite',('a','c'),(1,0)),('composite',('a','c'),(1,1))}
+    
+    DB.add({'i':301,'a':1,'b':2,'c':[5,5]})
+    DB.add([{'i':302,'a':1,'b':2},{'i':303,'a':2,'b':2}])
+    DB.update({'b':2},a=3)
+    DB.update({'c':[1,7]},i=5)
+    DB.remove(a=4)
+    assert DB.pop(i=301)['i'] == 301
+    check(DB)
+    DB.vacuum()
+    check(DB)
+    for item in DB:
+        item['a'] = 1 - item['a']
+    DB.reindex('a')
+    check(DB)
+    assert DB.copy().composite_indexes == DB.composite_indexes
+    
+    for bad in [('a',),('a','a'),'ab']:
+        with pytest.raises(ValueError):
+            DB.create_index(bad)
+    with pytest.raises(ValueError):
+        DictTable(exclude_attributes=['b']).create_index(('a','b'))
+    
+def test_primary_key():
+    items = [{'id':'u%d' % i,'a':i%5,'b':[i%3],'name':'n%d' % i} for i in range(100)]
+    DB = DictTable(copy.deepcopy(items),primary_key='id',sorted_attributes=['a'],
+                   composite_indexes=[('a','b')],string_attributes=['name'],
+                   numeric_attributes=['a'])
+    assert DB.get('u5')['a'] == 0
+    assert DB.get('nope') is None and DB.get('nope',1) == 1
+    
+    with pytest.raises(dicttable.DuplicateKeyError):
+        DB.add({'id':'u5'})
+    with pytest.raises(dicttable.DuplicateKeyError):
+        DB.add([{'id':'new'},{'id':'new'}])
+    with pytest.raises(ValueError):
+        DB.add({'a':1})
+    with pytest.raises(ValueError):
+        DB.add({'id':['u1000']})
+    assert len(DB) == 100 and DB.get('new') is None # Not changed
+    with pytest.raises(ValueError):
+        DictTable([{'id':1},{'id':1}],primary_key='id')
+    
+    # Insert then replace. Only what changed is reindexed
+    DB.upsert({'id':'u100','a':1,'b':[2],'name':'n100'})
+    assert DB.get('u100')['name'] == 'n100' and len(DB) == 101
+    ix = DB._pk['u5']
+    c = dict(DB._versions)
+    DB.upsert({'id':'u5','a':0,'b':[2,1],'new':1})
+    assert DB._pk['u5'] == ix and len(DB) == 101
+    assert DB._versions['a'] == c['a'] and DB._versions['id'] == c['id'] 
+    assert DB.get('u5') == {'id':'u5','a':0,'b':[2,1],'new':1}
+    assert DB.query_one(new=1)['id'] == 'u5'
+    assert DB.count(name='n5') == 0 and DB.count(DB.Q.name.startswith('n5')) == 10
+    
+    DB0 = DictTable(list(DB))
+    for q in [lambda D: {'a':0,'b':1},lambda D: D.Q.a < 2,lambda D: {'b':2},
+              lambda D: D.Q.name.contains('9')]:
+        assert sorted(item['id'] for item in DB.query(q(DB))) == \
+               sorted(item['id'] for item in DB0.query(q(DB0)))
+    
+    # Changing the key
+    DB.update({'id':'u5b'},id='u5')
+    assert DB.get('u5') is None and DB.get('u5b')['a'] == 0
+    with pytest.raises(dicttable.DuplicateKeyError):
+        DB.update({'id':'u6'},id='u7')
+    with pytest.raises(dicttable.DuplicateKeyError):
+        DB.update({'id':'x'},a=1)
+    
+    DB.remove(a=1)
+    assert DB.get('u1') is None
+    assert DB.pop(id='u2')['id'] == 'u2'
+    DB.vacuum()
+    assert all(DB[DB._pk[item['id']]] is item for item in DB)
+    assert DB.get('u3')['id'] == 'u3'
+    DB.get('u3')['id'] = 'u3b'
+    DB.reindex()
+    assert DB.get('u3') is None and DB.get('u3b')['a'] == 3
+    assert DB.copy().get('u3b')['a'] == 3
+    
+    # Upserts are journaled
+    tmpdir = tempfile.mkdtemp()
+    snapshot = os.path.join(tmpdir,'db.dt')
+    journal = os.path.join(tmpdir,'db.journal')
+    DB.open_journal(snapshot,journal)
+    DB.upsert({'id':'u3b','a':4})
+    DB.upsert({'id':'u200','a':4})
+    DB.close_journal()
+    DB2 = DictTable.recover(snapshot,journal)
+    assert DB2.get('u3b') == {'id':'u3b','a':4} and DB2.get('u200')['a'] == 4
+    assert DB2._pk == DB._pk and DB2._lookup == DB._lookup
+    
+    with pytest.raises(ValueError):
+        DictTable().get(1)
+    with pytest.raises(ValueError):
+        DictTable(exclude_attributes=['id'],primary_key='id')
+    
+@pytest.mark.parametrize("bitmaps", [False,True])
+def test_aggregation(bitmaps):
+    items = [{'i':i,'a':i%5,'b':[i%3,i%4] if i % 6 else [],'c':i*0.5,'s':'s%d' % (i%9)} 
+             for i in range(300)]
+    items.append({'i':300,'b':[1,1],'s':'s0'}) # Missing a. Repeated value
+    DB = DictTable(copy.deepcopy(items),bitmaps=bitmaps,cache_size=4)
+    
+    def expected(attrib,func='count',of=None,q=lambda item: True):
+        groups = defaultdict(list)
+        for item in items:
+            if q(item) and attrib in item:
+                for val in set(dicttable._makelist(item[attrib])):
+                    groups[val].append(item)
+        if func == 'count':
+            return {val:sum(of is None or of in item for item in group) 
+                    for val,group in groups.items()}
+        res = {}
+        for val,group in groups.items():
+            vals = [v for item in group if of in item for v in set(dicttable._makelist(item[of]))]
+            res[val] = sum(vals) if func == 'sum' else ({'min':min,'max':max}[func](vals) if vals else None)
+        return res
+    
+    # 'a' has fewer values than matches and 's' or 'i' more
+    queries = [(lambda D: [],lambda item: True),
+               (lambda D: [D.Q.i < 40],lambda item: item['i'] < 40),
+               (lambda D: [{'a':2}],lambda item: item.get('a') == 2),
+               (lambda D: [D.Q.i == 7],lambda item: item['i'] == 7),
+               (lambda D: [D.Q.i == -1],lambda item: False)]
+    for qD,qi in queries:
+        for attrib in ['a','b','s','i']:
+            assert DB.value_counts(attrib,*qD(DB)) == expected(attrib,q=qi)
+            assert sorted(DB.distinct(attrib,*qD(DB))) == sorted(expected(attrib,q=qi))
+            groups = DB.group_by(attrib,*qD(DB))
+            assert {val:len(group) for val,group in groups.items()} == expected(attrib,q=qi)
+            for val,group in groups.items():
+                assert all(val in dicttable._makelist(item[attrib]) for item in group)
+            for func,of in [('count','b'),('sum','c'),('sum','b'),('min','i'),('max','b')]:
+                assert DB.aggregate(attrib,func,*qD(DB),of=of) == expected(attrib,func,of,qi)
+    assert DB.value_counts('a',(DB.Q.a == 1) | (DB.Q.a == 2)) == {1:60,2:60}
+    assert DB.aggregate('a','count') == DB.value_counts('a')
+    assert DB.value_counts('nope') == {} and DB.group_by('nope') == {}
+    
+    # Kept up to date
+    DB.remove(a=1)
+    DB.update({'a':7},i=2)
+    assert DB.value_counts('a') == {0:60,2:59,3:60,4:60,7:1}
+    assert DB.aggregate('a','max',of='i')[7] == 2
+    
+    with pytest.raises(ValueError):
+        DB.aggregate('a','mean',of='c')
+    with pytest.raises(ValueError):
+        DB.aggregate('a','sum')
+    with pytest.raises(dicttable.ExcludedAttributeError):
+        DictTable(items,exclude_attributes=['c']).aggregate('a','sum',of='c')
+    with pytest.raises(ValueError):
+        DictTable(items,fixed_attributes=['i']).value_counts('a')
+    assert DictTable().value_counts('a') == DictTable().group_by('a',a=1) == {}
+    
+    # Sharded
+    SDB = dicttable.ShardedDictTable('s',copy.deepcopy(items),shards=3,bitmaps=bitmaps)
+    for qD,qi in queries:
+        assert SDB.value_counts('b',*qD(SDB)) == expected('b',q=qi)
+        assert SDB.aggregate('b','min',*qD(SDB),of='c') == expected('b','min','c',qi)
+        assert SDB.aggregate('b','sum',*qD(SDB),of='i') == expected('b','sum','i',qi)
+    assert sorted(SDB.distinct('s')) == sorted(expected('s'))
+    assert sorted(item['i'] for item in SDB.group_by('a',s='s3')[3]) == \
+           [i for i in range(300) if i % 9 == 3 and i % 5 == 3]
+
+@pytest.mark.parametrize("bitmaps", [False,True])
+def test_join(bitmaps):
+    hosts = [{'host':'h%d' % i,'dc':i%3} for i in range(20)]
+    hosts.append({'host':['h1','h2'],'dc':5}) # Joined on both
+    hosts.append({'dc':6}) # No host
+    alerts = [{'a':i,'host':'h%d' % (i%30),'level':i%4} for i in range(100)]
+    alerts.append({'a':100,'host':[]})
+    alerts.append({'a':101,'host':['h1','h2','h25']}) # Shares two with a host
+    H = DictTable(copy.deepcopy(hosts),bitmaps=bitmaps)
+    A = DictTable(copy.deepcopy(alerts),bitmaps=bitmaps,cache_size=2)
+    
+    def expected(how='inner',lq=lambda item: True,rq=lambda item: True):
+        res = []
+        for h in hosts:
+            if not lq(h):
+                continue
+            matches = [(h,a) for a in alerts if rq(a) and 
+                       set(dicttable._makelist(h.get('host',[]))) & set(dicttable._makelist(a['host']))]
+            res.extend(matches)
+            if how == 'left' and not matches:
+                res.append((h,None))
+        return res
+    
+    def key(pair):
+        return (repr(pair[0]),repr(pair[1]))
+    
+    for how in ['inner','left']:
+        for lq,rq,lqi,rqi in [(None,None,lambda h: True,lambda a: True),
+                              ({'dc':1},None,lambda h: h['dc'] == 1,lambda a: True),
+                              (None,A.Q.level == 2,lambda h: True,lambda a: a.get('level') == 2),
+                              (H.Q.dc != 0,{'a':7},lambda h: h['dc'] != 0,lambda a: a['a'] == 7),
+                              ({'dc':9},None,lambda h: False,lambda a: True)]:
+            exp = sorted(expected(how,lqi,rqi),key=key)
+            # Both directions of the iteration
+            for L,R,swap in [(H,A,False),(A,H,True)]:
+                if swap and how == 'left':
+                    continue
+                pairs = list(dicttable.join(L,R,'host',how=how,merge=False,
+                                            left_query=rq if swap else lq,
+                                            right_query=lq if swap else rq))
+                if swap:
+                    pairs = [(h,a) for a,h in pairs]
+                assert sorted(pairs,key=key) == exp
+    
+    # Items with several shared values are paired once
+    L = DictTable([{'k':['a','b'],'i':0},{'k':'a','i':1}],bitmaps=bitmaps)
+    R = DictTable([{'k':['a','b'],'j':0},{'k':['b','c'],'j':1}],bitmaps=bitmaps)
+    for how in ['inner','left']:
+        pairs = [(l['i'],r['j']) for l,r in dicttable.join(L,R,'k',how=how,merge=False)]
+        assert sorted(pairs) == [(0,0),(0,1),(1,0)]
+        pairs = [(l['j'],r['i']) for l,r in dicttable.join(R,L,'k',how=how,merge=False)]
+        assert sorted(pairs) == [(0,0),(0,1),(1,0)]
+    
+    merged = list(dicttable.join(H,A,'host',how='left',left_query={'dc':6}))
+    assert merged == [{'dc':6}] and merged[0] is not H[21]
+    merged = list(dicttable.join(H,A,on='host',right_query={'a':7}))
+    assert merged == [{'host':'h7','dc':1,'a':7,'level':3}]
+    
+    # Kept up to date. Mapped, compact, and concurrent sides
+    A.remove(host='h7')
+    assert not list(dicttable.join(H,A,on='host',right_query={'a':7}))
+    tmpdir = tempfile.mkdtemp()
+    H.save_mapped(os.path.join(tmpdir,'hosts.map'))
+    with dicttable.MappedDictTable(os.path.join(tmpdir,'hosts.map'),bitmaps=bitmaps) as M:
+        C = DictTable(list(A),compact_rows=True,concurrent=True)
+        assert sorted(dicttable.join(M,C,'host',merge=False),key=key) == \
+               sorted(dicttable.join(H,A,'host',merge=False),key=key)
+    
+    with pytest.raises(ValueError):
+        dicttable.join(H,A,'host',how='outer')
+    with pytest.raises(dicttable.ExcludedAttributeError):
+        dicttable.join(H,DictTable(alerts,exclude_attributes=['host']),'host')
+
+@pytest.mark.parametrize("bitmaps", [False,True])
+def test_async(bitmaps):
+    items = [{'i':i,'a':i%7,'b':[i%3,i%5]} for i in range(500)]
+    DB0 = DictTable(copy.deepcopy(items),sorted_attributes=['i'])
+    byi = lambda items: sorted(items,key=lambda item: item['i'])
+    
+    async def ticker(ticks):
+        while True:
+            ticks.append(1)
+            await asyncio.sleep(0)
+    
+    async def run():
+        ticks = []
+        task = asyncio.ensure_future(ticker(ticks))
+        DB = DictTable(bitmaps=bitmaps,sorted_attributes=['i'],cache_size=2)
+        await DB.aadd(copy.deepcopy(items),chunk_size=50)
+        assert DB._lookup == DB0._lookup and DB._sorted == DB0._sorted
+        assert len(ticks) >= 10 # Yielded between chunks
+        
+        queries = [lambda D: D.Q.a == 2,
+                   lambda D: (D.Q.i >= 100) & (D.Q.b != 2),
+                   lambda D: D.Q.filter(lambda item: item['i'] % 10 == 0),
+                   lambda D: {'b':[1,2]}]
+        for q in queries:
+            del ticks[:]
+            assert byi(await DB.aquery(q(DB),chunk_size=20)) == byi(DB0.query(q(DB0)))
+            assert len(ticks) >= 1
+            assert byi([item async for item in DB.aquery(q(DB))]) == byi(DB0.query(q(DB0)))
+        list(DB.query(a=3)) # Cached
+        assert byi(await DB.aquery(a=3,chunk_size=10)) == byi(DB0.query(a=3))
+        
+        # Removed while iterating are skipped
+        n = 0
+        async for item in DB.aquery(a=4,chunk_size=10):
+            n += 1
+            if n == 1:
+                DB.remove(a=4)
+        assert n <= 10
+        DB0.remove(a=4)
+        
+        # Changed while building. Still correct and not added all at once
+        def blocking(*args):
+            raise AssertionError('Should not add all at once')
+        DB._bulk_add = blocking
+        add = asyncio.ensure_future(DB.aadd([{'i':1000,'a':1}]*30,chunk_size=5))
+        await asyncio.sleep(0)
+        DB.add({'i':1001,'a':1})
+        await add
+        del DB._bulk_add
+        DB0.add({'i':1001,'a':1})
+        DB0.add([{'i':1000,'a':1}]*30)
+        assert DB._lookup == DB0._lookup
+        
+        for item in DB:
+            item['a'] += 1
+        for item in DB0:
+            item['a'] += 1
+        old = DB.count(a=1)
+        reindex = asyncio.ensure_future(DB.areindex('a',chunk_size=50))
+        await asyncio.sleep(0)
+        assert DB.count(a=1) == old # Not yet replaced
+        await reindex
+        DB0.reindex('a')
+        assert DB._lookup == DB0._lookup
+        
+        # Restarted (without blocking) if what it reindexes changes. Not 
+        # for other attributes
+        def blocking(*attributes):
+            raise AssertionError('Should not reindex all at once')
+        DB.reindex = blocking
+        builds = []
+        build_maps = dicttable._build_maps
+        def counted(items,ix0,*args):
+            builds.append(ix0)
+            return build_maps(items,ix0,*args)
+        dicttable._build_maps = counted
+        DB._build_maps = blocking # Not with workers
+        for change in [lambda D: D.update({'b':100},i=1001),
+                       lambda D: D.add({'i':2000,'b':7}),
+                       lambda D: D.remove(i=2000)]:
+            del builds[:]
+            reindex = asyncio.ensure_future(DB.areindex(chunk_size=50))
+            await asyncio.sleep(0)
+            change(DB)
+            change(DB0)
+            await reindex
+            assert DB._lookup == DB0._lookup
+            assert builds.count(0) == 2 # Started again
+        
+        del builds[:]
+        reindex = asyncio.ensure_future(DB.areindex('a',chunk_size=50))
+        await asyncio.sleep(0)
+        DB.update({'b':5},i=1001)
+        DB0.update({'b':5},i=1001)
+        await reindex
+        assert builds.count(0) == 1 # Kept going
+        
+        # Until it has started again too many times
+        del builds[:]
+        reindex = asyncio.ensure_future(DB.areindex('b',chunk_size=50))
+        for n in range(dicttable._ASYNC_RESTARTS + 1):
+            await asyncio.sleep(0)
+            DB.update({'b':n},i=1001)
+            DB0.update({'b':n},i=1001)
+        with pytest.raises(AssertionError,match='all at once'):
+            await reindex
+        assert builds.count(0) == dicttable._ASYNC_RESTARTS + 1
+        del DB.reindex,DB._build_maps
+        reindex = asyncio.ensure_future(DB.areindex('b',chunk_size=50))
+        for n in range(dicttable._ASYNC_RESTARTS + 1):
+            await asyncio.sleep(0)
+            DB.update({'b':n + 10},i=1001)
+            DB0.update({'b':n + 10},i=1001)
+        await reindex
+        dicttable._build_maps = build_maps
+        assert DB._lookup == DB0._lookup
+        task.cancel()
+    asyncio.run(run())
+    
+@pytest.mark.parametrize("prefer_writers", [True,False])
+def test_concurrent(prefer_writers):
+    DB = DictTable([{'i':i,'two':i%2} for i in range(1000)],concurrent=True,
+                   prefer_writers=prefer_writers,cache_size=10)
+    errors = []
+    stop = []
+    
+    def reader():
+        try:
+            while not stop:
+                with DB._lock.read(): # Several reads at once are consistent
+                    assert DB.count(two=0) + DB.count(two=1) == len(DB)
+                for item in DB.query(DB.Q.two == 1):
+                    assert item is not None
+                DB.isin(i=5)
+                list(DB)
+                if not prefer_writers: # Let the writers in
+                    time.sleep(0.001)
+        except Exception as error:
+            errors.append(error)
+    
+    def writer(n):
+        try:
+            for j in range(300):
+                i = 1000 + n*1000 + j
+                DB.add({'i':i,'two':i%2})
+                DB.update({'two':(i + 1)%2},i=i)
+                if j % 3 == 0:
+                    DB.remove(i=i)
+                if j % 100 == 0:
+                    DB.vacuum()
+        except Exception as error:
+            errors.append(error)
+    
+    readers = [threading.Thread(target=reader) for _ in range(4)]
+    writers = [threading.Thread(target=writer,args=(n,)) for n in range(2)]
+    for thread in readers + writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    stop.append(True)
+    for thread in readers:
+        thread.join()
+    assert not errors
+    
+    assert len(DB) == 1000 + 2*200
+    DB.vacuum()
+    assert DB._lookup == DictTable(list(DB))._lookup
+    assert DB._ix == set(range(len(DB)))
+    
+    # Changes while iterating a query are fine. Changes while holding the
+    # read lock are not
+    for item in DB.query(two=1):
+        DB.update({'other':1},i=item['i'])
+    with DB._lock.read():
+        with pytest.raises(RuntimeError):
+            DB.add({'i':-1})
+    with DB._lock.write(): # Reentrant
+        DB.add({'i':-1})
+        assert DB.count(i=-1) == 1
+    
+    # Query objects are only out of date if vacuum() changed the indices
+    Q = DB.Q.two == 1
+    Qix = DB.Q._index == 0
+    DB.update({'two':1},i=-1)
+    assert DB.count(Q) == DB.count(two=1)
+    DB.remove(i=0)
+    DB.vacuum()
+    with pytest.raises(ValueError):
+        DB.count(Qix)
+    
+    DB2 = DB.copy()
+    assert DB2._lock.prefer_writers == prefer_writers
+    
 def test_performance():
     """
     This test is far from perfect but the goal is to make sure that
@@ -764,6 +2472,50 @@ if __name__ == '__main__':
     test_copy('function')
     test_uncommon_attributes()
     test_adding_fixed_attrib_to_dynamic()
+    test_sorted_attributes()
+    test_repeated_list_values()
+    test_hot_value_performance()
+    test_attribute_catalog()
+    test_bulk_add({})
+    test_vacuum()
+    test_bitmap_object()
+    test_bitmaps(None)
+    test_bitmaps('i')
+    test_bitmap_sparse_performance()
+    test_query_planner()
+    test_lazy_queries(False)
+    test_lazy_queries(True)
+    test_query_cache(False)
+    test_query_cache(True)
+    test_query_versions()
+    test_save_load(False)
+    test_save_load(True)
+    test_mapped(False)
+    test_mapped(True)
+    test_journal()
+    test_journal_killed()
+    test_compact_rows()
+    test_intern_values(False)
+    test_intern_values(True)
+    test_numeric_attributes(False)
+    test_numeric_attributes(True)
+    test_concurrent(True)
+    test_concurrent(False)
+    test_parallel_build(False)
+    test_parallel_build(True)
+    test_sharded(None)
+    test_sharded(0)
+    test_async(False)
+    test_async(True)
+    test_string_queries(False)
+    test_string_queries(True)
+    test_composite_index(False)
+    test_composite_index(True)
+    test_primary_key()
+    test_aggregation(False)
+    test_aggregation(True)
+    test_join(False)
+    test_join(True)
     test_performance()
     
     print('-='*25)